@@ -0,0 +1,122 @@
+# Image quality metrics for pix2pix / CycleGAN test results
+#
+# Python versions of the scores computed by getssims.m and get_psnr_vals.m,
+# so results can be scored on the cluster without copying them to a desktop.
+# Both follow the MATLAB defaults: SSIM uses an 11x11 gaussian window with
+# sigma 1.5 and K = (0.01, 0.03), PSNR uses a peak value of 255 for 8 bit images.
+# Colour images are scored per channel and averaged, so SSIM values can differ
+# slightly from MATLAB's 3-D ssim() in the third decimal.
+# CW-SSIM is computed with pyssim like get_cw_ssim.ipynb, when it is installed
+# (pip install pyssim).
+
+import os
+import re
+
+import cv2
+import numpy as np
+
+REAL_SUFFIX = "_real_B.png"
+FAKE_SUFFIX = "_fake_B.png"
+
+
+def psnr(a, b, peak=255.0):
+    """Peak signal to noise ratio of two images of the same shape.
+
+    Parameters
+    ----------
+    a: np.ndarray
+        Image to score (the generated image).
+    b: np.ndarray
+        Reference image.
+    peak: float
+        Largest possible pixel value, 255 for 8 bit images.
+    """
+    diff = a.astype(np.float64) - b.astype(np.float64)
+    mse = np.mean(diff * diff)
+    if mse == 0:
+        return float("inf")
+    return float(10.0 * np.log10(peak * peak / mse))
+
+
+def ssim(a, b, peak=255.0, sigma=1.5):
+    """Mean structural similarity index of two images of the same shape.
+
+    Parameters
+    ----------
+    a: np.ndarray
+        Image to score (the generated image), HxW or HxWxC.
+    b: np.ndarray
+        Reference image.
+    peak: float
+        Dynamic range of the pixel values, 255 for 8 bit images.
+    sigma: float
+        Standard deviation of the gaussian weighting window.
+    """
+    c1 = (0.01 * peak) ** 2
+    c2 = (0.03 * peak) ** 2
+    ksize = (2 * int(np.ceil(3 * sigma)) + 1,) * 2
+
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+
+    # cv2 filters every channel of a multi channel image independently,
+    # so the whole computation is done once for all channels.
+    def blur(x):
+        return cv2.GaussianBlur(x, ksize, sigma, borderType=cv2.BORDER_REPLICATE)
+
+    mu_a = blur(a)
+    mu_b = blur(b)
+    mu_aa = mu_a * mu_a
+    mu_bb = mu_b * mu_b
+    mu_ab = mu_a * mu_b
+    var_a = blur(a * a) - mu_aa
+    var_b = blur(b * b) - mu_bb
+    cov = blur(a * b) - mu_ab
+
+    ssim_map = ((2 * mu_ab + c1) * (2 * cov + c2)) / (
+        (mu_aa + mu_bb + c1) * (var_a + var_b + c2)
+    )
+    return float(ssim_map.mean())
+
+
+def has_cw_ssim():
+    """Whether pyssim, needed for CW-SSIM, is installed."""
+    import importlib.util
+
+    return importlib.util.find_spec("ssim") is not None
+
+
+def cw_ssim(a, b, width=30):
+    """Complex wavelet SSIM of two images as get_cw_ssim.ipynb computes it.
+
+    The arrays go to PIL as cv2 read them (BGR), the same as in the notebook,
+    so values match its results.
+    """
+    import ssim.ssimlib as pyssim
+    from PIL import Image
+
+    return float(pyssim.SSIM(Image.fromarray(a)).cw_ssim_value(Image.fromarray(b), width))
+
+
+def image_number(filename):
+    """Number embedded in a result file name, e.g. 116708 for 116708_fake_B.png."""
+    match = re.search(r"\d+", os.path.basename(filename))
+    return int(match.group()) if match else -1
+
+
+def score_pair(real_path, fake_path, with_cw_ssim=False):
+    """Read a real/fake pair and score it.
+
+    Returns (number, ssim, psnr), with cw_ssim added if ``with_cw_ssim`` is
+    set, or None if either image can't be decoded yet (for example because
+    test.py is still writing it).
+    """
+    real = cv2.imread(real_path)
+    fake = cv2.imread(fake_path)
+    if real is None or fake is None or real.shape != fake.shape:
+        return None
+
+    scores = (image_number(fake_path), ssim(fake, real), psnr(fake, real))
+    if with_cw_ssim:
+        scores += (cw_ssim(real, fake),)
+    return scores
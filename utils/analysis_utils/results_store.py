@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# Columnar store for per image metric results, with fast aggregate reports
+#
+# Replaces hand editing path1/path2 in disp_ssims.m and disp_psnr_vals.m. Every
+# scored run is appended once with its run, direction, model and condition, and
+# reports group, histogram and tabulate any combination of runs in one pass.
+#
+# A store is a directory of parts. Each part is a directory holding one .npy
+# file per column plus a json file with the row count and the dictionaries of
+# the string columns, which are saved as small integer codes. Columns are
+# memory mapped when read, so reports over millions of rows only touch the
+# columns they use.
+#
+# usage:
+#   python results_store.py append STORE --csv ssim_psnr.csv --run ab_night
+#   python results_store.py append STORE --images results/ba_day/test_latest/images/dusk --run ba_day --condition dusk
+#   python results_store.py report STORE --by direction condition --metric ssim --hist 20 --plot ssim.png
+
+import argparse
+import csv
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+STRING_COLUMNS = ("run", "direction", "model", "condition")
+NUMBER_COLUMNS = {"number": np.int64, "ssim": np.float32, "psnr": np.float32, "cw_ssim": np.float32}
+METRICS = ("ssim", "psnr", "cw_ssim")
+
+CONDITIONS = ("daynight", "day", "night", "dusk")
+
+
+def parse_run_name(run):
+    """Guess direction, model and condition from a run name like ab_daynight_cycle.
+
+    Our runs are named <direction>_<condition>[_cycle]; anything that doesn't
+    fit comes back as an empty string so it can be given on the command line.
+    """
+    parts = run.lower().split("_")
+    direction = parts[0] if parts[0] in ("ab", "ba") else ""
+    model = "cycle_gan" if "cycle" in parts else "pix2pix"
+    condition = ""
+    for part in parts[1:]:
+        if part in CONDITIONS:
+            condition = part
+            break
+    return direction, model, condition
+
+
+def append(store, columns):
+    """Append one part holding ``columns`` to the store.
+
+    Parameters
+    ----------
+    store: str
+        Store directory, created if needed.
+    columns: dict
+        Column name to sequence of values. String columns may be given as a
+        single string, which is repeated for every row.
+    """
+    rows = len(columns["number"])
+    os.makedirs(store, exist_ok=True)
+
+    # named by time, so parts sort in the order they were added, plus a random
+    # suffix so appends running at the same time never pick the same name
+    part = os.path.join(store, "part-%d-%s" % (time.time_ns(), uuid.uuid4().hex[:8]))
+    tmp = part + ".tmp"
+    os.mkdir(tmp)
+
+    meta = {"rows": rows, "dictionaries": {}}
+    for name in STRING_COLUMNS:
+        values = columns.get(name, "")
+        if isinstance(values, str):
+            dictionary = [values]
+            codes = np.zeros(rows, dtype=np.int16)
+        else:
+            dictionary, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+            dictionary = dictionary.tolist()
+            codes = codes.astype(np.int16)
+        meta["dictionaries"][name] = dictionary
+        np.save(os.path.join(tmp, name + ".npy"), codes)
+
+    for name, dtype in NUMBER_COLUMNS.items():
+        values = columns.get(name)
+        if values is None:
+            values = np.full(rows, np.nan if dtype is np.float32 else -1, dtype=dtype)
+        np.save(os.path.join(tmp, name + ".npy"), np.asarray(values, dtype=dtype))
+
+    with open(os.path.join(tmp, "part.json"), "w") as file:
+        json.dump(meta, file)
+
+    # a part only becomes visible once it is complete
+    os.rename(tmp, part)
+    return part
+
+
+def load(store, names):
+    """Read columns from every part of the store.
+
+    String columns come back as (codes, dictionary) with codes into one shared
+    dictionary; number columns come back as arrays.
+    """
+    parts = sorted(name for name in os.listdir(store) if name.startswith("part-") and not name.endswith(".tmp"))
+    chunks = {name: [] for name in names}
+    dictionaries = {name: {} for name in names if name in STRING_COLUMNS}
+
+    for part in parts:
+        path = os.path.join(store, part)
+        with open(os.path.join(path, "part.json")) as file:
+            meta = json.load(file)
+
+        for name in names:
+            data = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            if name in STRING_COLUMNS:
+                # remap this part's codes into the shared dictionary
+                shared = dictionaries[name]
+                lookup = np.array([shared.setdefault(value, len(shared))
+                                   for value in meta["dictionaries"][name]], dtype=np.int32)
+                data = lookup[data]
+            chunks[name].append(data)
+
+    columns = {}
+    for name in names:
+        data = np.concatenate(chunks[name]) if chunks[name] else np.empty(0)
+        if name in STRING_COLUMNS:
+            dictionary = sorted(dictionaries[name], key=dictionaries[name].get)
+            columns[name] = (data.astype(np.int32), dictionary)
+        else:
+            columns[name] = np.asarray(data)
+    return columns
+
+
+def group_stats(keys, values, bins=None, value_range=None):
+    """Per group count, mean, sample stdev, min, max and optional histograms.
+
+    Everything is computed with one bincount per statistic over all rows,
+    rather than one pass per group.
+
+    Parameters
+    ----------
+    keys: np.ndarray
+        Group index of every row, 0..n_groups-1.
+    values: np.ndarray
+        Metric value of every row. Non finite values are ignored.
+    bins: Optional[int]
+        Number of histogram bins.
+    value_range: Optional[Tuple[float, float]]
+        Histogram range, the range of the data if not given. Values outside
+        it are left out of the histograms.
+    """
+    n_groups = int(keys.max()) + 1 if keys.size else 0
+    valid = np.isfinite(values)
+    keys = keys[valid]
+    values = values[valid].astype(np.float64)
+
+    count = np.bincount(keys, minlength=n_groups)
+    total = np.bincount(keys, weights=values, minlength=n_groups)
+    mean = total / np.maximum(count, 1)
+    # second pass over the deviations is still vectorized and avoids the
+    # cancellation of the sum of squares formula
+    dev = values - mean[keys]
+    sq = np.bincount(keys, weights=dev * dev, minlength=n_groups)
+    std = np.sqrt(sq / np.maximum(count - 1, 1))
+
+    low = np.full(n_groups, np.inf)
+    high = np.full(n_groups, -np.inf)
+    np.minimum.at(low, keys, values)
+    np.maximum.at(high, keys, values)
+
+    stats = {"count": count, "mean": mean, "std": std, "min": low, "max": high}
+
+    if bins:
+        if value_range is None:
+            value_range = (values.min(), values.max()) if values.size else (0.0, 1.0)
+        edges = np.linspace(value_range[0], value_range[1], bins + 1)
+        inside = (values >= edges[0]) & (values <= edges[-1])
+        # the last bin includes its upper edge, as in np.histogram
+        index = np.minimum(np.searchsorted(edges, values[inside], side="right") - 1, bins - 1)
+        hist = np.bincount(keys[inside] * bins + index, minlength=n_groups * bins)
+        stats["hist"] = hist.reshape(n_groups, bins)
+        stats["edges"] = edges
+
+    return stats
+
+
+def report(store, by, metrics, where=(), bins=None, value_range=None, plot=None):
+    """Print mean/stdev tables of ``metrics`` grouped by the ``by`` columns."""
+    filters = [item.split("=", 1) for item in where]
+    names = sorted(set(by) | {name for name, _ in filters} | set(metrics))
+    columns = load(store, names)
+
+    rows = len(columns[metrics[0]])
+    mask = np.ones(rows, dtype=bool)
+    for name, value in filters:
+        if name in STRING_COLUMNS:
+            codes, dictionary = columns[name]
+            mask &= codes == (dictionary.index(value) if value in dictionary else -1)
+            continue
+        column = columns[name]
+        try:
+            value = column.dtype.type(value)
+        except ValueError:
+            raise SystemExit("--where %s=%s: not a %s" % (name, value, column.dtype))
+        mask &= column == value
+
+    if not mask.any():
+        print("no rows" + (" matching " + " ".join(where) if where and rows else " in " + store))
+        return [], {}
+
+    # combine the group columns into one key, then number the keys present
+    key = np.zeros(rows, dtype=np.int64)
+    for name in by:
+        codes, dictionary = columns[name]
+        key = key * len(dictionary) + codes
+    present, keys = np.unique(key[mask], return_inverse=True)
+
+    labels = []
+    for value in present:
+        label = []
+        for name in reversed(by):
+            dictionary = columns[name][1]
+            label.append(dictionary[value % len(dictionary)])
+            value //= len(dictionary)
+        labels.append(" ".join(reversed(label)) or "all")
+
+    results = {}
+    for metric in metrics:
+        stats = group_stats(keys, columns[metric][mask], bins, value_range)
+        results[metric] = stats
+
+        print("%s by %s" % (metric.upper(), ", ".join(by) or "all"))
+        width = max([len(label) for label in labels] + [5])
+        print("%-*s %8s %10s %10s %10s %10s" % (width, "group", "count", "mean", "stdev", "min", "max"))
+        for i, label in enumerate(labels):
+            print("%-*s %8d %10.4f %10.4f %10.4f %10.4f" % (
+                width, label, stats["count"][i], stats["mean"][i], stats["std"][i],
+                stats["min"][i], stats["max"][i]))
+        if bins and plot is None:
+            print("histogram edges: " + " ".join("%.4g" % edge for edge in stats["edges"]))
+            for i, label in enumerate(labels):
+                print("%-*s %s" % (width, label, " ".join(str(n) for n in stats["hist"][i])))
+        print()
+
+    if plot is not None and bins:
+        import matplotlib.pyplot as plt
+
+        fig, axes = plt.subplots(len(metrics), len(labels), squeeze=False,
+                                 figsize=(4 * len(labels), 3 * len(metrics)))
+        for row, metric in enumerate(metrics):
+            stats = results[metric]
+            edges = stats["edges"]
+            for col, label in enumerate(labels):
+                ax = axes[row][col]
+                ax.stairs(stats["hist"][col], edges, fill=True)
+                ax.set_title(label)
+                ax.set_xlabel("%s Score" % metric.upper())
+                ax.set_ylabel("Number of Occurrences")
+                ax.legend(["Mean: %G StDev: %G" % (stats["mean"][col], stats["std"][col])])
+        fig.tight_layout()
+        fig.savefig(plot)
+
+    return labels, results
+
+
+def read_csv(path):
+    """Read a number,ssim,psnr[,cw_ssim] csv as written by watch_results.py."""
+    with open(path, newline="") as file:
+        reader = csv.DictReader(file)
+        rows = list(reader)
+    columns = {"number": [int(row["number"]) for row in rows]}
+    for metric in METRICS:
+        if rows and metric in rows[0]:
+            columns[metric] = [float(row[metric]) for row in rows]
+    return columns
+
+
+def score_images(path, workers):
+    """Score every real/fake pair in a results directory on a process pool."""
+    from image_metrics import FAKE_SUFFIX, REAL_SUFFIX, score_pair
+
+    prefixes = sorted(name[: -len(FAKE_SUFFIX)] for name in os.listdir(path) if name.endswith(FAKE_SUFFIX))
+    reals = [os.path.join(path, prefix + REAL_SUFFIX) for prefix in prefixes]
+    fakes = [os.path.join(path, prefix + FAKE_SUFFIX) for prefix in prefixes]
+
+    with ProcessPoolExecutor(workers) as pool:
+        results = [result for result in pool.map(score_pair, reals, fakes, chunksize=64) if result is not None]
+
+    return {
+        "number": [result[0] for result in results],
+        "ssim": [result[1] for result in results],
+        "psnr": [result[2] for result in results],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per image metric store and reports.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("append", help="add one run's scores to the store")
+    add.add_argument("store")
+    source = add.add_mutually_exclusive_group(required=True)
+    source.add_argument("--csv", help="csv written by watch_results.py")
+    source.add_argument("--images", help="results directory to score")
+    add.add_argument("--run", required=True, help="run name, e.g. ab_daynight_cycle")
+    add.add_argument("--direction", default=None, help="ab or ba, guessed from the run name")
+    add.add_argument("--model", default=None, help="pix2pix or cycle_gan, guessed from the run name")
+    add.add_argument("--condition", default=None, help="test condition, guessed from the run name")
+    add.add_argument("--workers", type=int, default=os.cpu_count())
+
+    rep = commands.add_parser("report", help="grouped statistics and histograms")
+    rep.add_argument("store")
+    rep.add_argument("--by", nargs="*", default=["run"], choices=STRING_COLUMNS)
+    rep.add_argument("--metric", nargs="+", default=["ssim", "psnr"], choices=METRICS)
+    rep.add_argument("--where", nargs="*", default=[], help="filters like condition=night")
+    rep.add_argument("--hist", type=int, default=None, help="number of histogram bins")
+    rep.add_argument("--range", type=float, nargs=2, default=None, help="histogram range")
+    rep.add_argument("--plot", default=None, help="save histograms to this image")
+
+    args = parser.parse_args()
+
+    if args.command == "append":
+        columns = read_csv(args.csv) if args.csv else score_images(args.images, args.workers)
+        direction, model, condition = parse_run_name(args.run)
+        columns["run"] = args.run
+        columns["direction"] = args.direction or direction
+        columns["model"] = args.model or model
+        columns["condition"] = args.condition or condition
+        part = append(args.store, columns)
+        print("added %d rows to %s" % (len(columns["number"]), part))
+    else:
+        report(args.store, args.by, args.metric, args.where, args.hist, args.range, args.plot)
+
+
+if __name__ == "__main__":
+    main()
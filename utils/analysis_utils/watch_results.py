@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Streaming evaluation of pix2pix / CycleGAN test results
+#
+# Watches a results directory (e.g. results/ab_night/test_latest/images) while
+# test.py is still writing to it, pairs every *_real_B.png with its *_fake_B.png
+# as soon as both exist and scores SSIM and PSNR on a pool of worker processes.
+# Scores are appended to a csv as they finish, so the final statistics are ready
+# a few seconds after test.py exits instead of after a separate evaluation pass.
+#
+# The directory is polled (os.scandir is cheap even for tens of thousands of
+# files); inotify is not available on every system we run on.
+#
+# usage:
+#   python watch_results.py RESULTS_DIR --out ssim_psnr.csv --stop-file DONE
+# and create the stop file (touch DONE) once test.py has finished. Without a
+# stop file the watcher exits after --idle seconds with no new images.
+# With --store and --run the scores are also added to a results_store.py store.
+
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from image_metrics import FAKE_SUFFIX, REAL_SUFFIX, score_pair
+
+
+def scan(path, sizes, settled=False):
+    """Return the pair prefixes whose real and fake images are both complete.
+
+    A file counts as complete once its size has not changed between two
+    consecutive scans, or as soon as it exists if ``settled`` is set (test.py
+    has exited). ``sizes`` holds the sizes seen on the previous scan and is
+    updated in place.
+    """
+    real = set()
+    fake = set()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith(REAL_SUFFIX):
+                prefix = name[: -len(REAL_SUFFIX)]
+                group = real
+            elif name.endswith(FAKE_SUFFIX):
+                prefix = name[: -len(FAKE_SUFFIX)]
+                group = fake
+            else:
+                continue
+
+            size = entry.stat().st_size
+            if size > 0 and (settled or sizes.get(name) == size):
+                group.add(prefix)
+            sizes[name] = size
+
+    return real & fake
+
+
+def summarize(values):
+    """Mean and sample standard deviation, as MATLAB's mean()/std() report them."""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return {"count": 0, "mean": float("nan"), "std": float("nan")}
+    std = float(values.std(ddof=1)) if values.size > 1 else 0.0
+    return {"count": int(values.size), "mean": float(values.mean()), "std": std}
+
+
+def watch(path, out, workers, poll, stop_file, idle, retries=5):
+    """Score pairs in ``path`` as they appear until the run is over.
+
+    Parameters
+    ----------
+    path: str
+        Directory test.py writes its images to.
+    out: str
+        CSV file to append (number, ssim, psnr) rows to.
+    workers: int
+        Number of scoring processes.
+    poll: float
+        Seconds between directory scans.
+    stop_file: Optional[str]
+        File whose existence means test.py has finished.
+    idle: float
+        Stop after this many seconds without a new pair if there is no stop file.
+    retries: int
+        How many times to rescore a pair whose images can't be decoded yet.
+    """
+    sizes = {}
+    submitted = set()
+    attempts = {}
+    retry = set()
+    pending = {}
+    ssims = []
+    psnrs = []
+    last_new = time.monotonic()
+    finishing = False
+
+    def submit(prefix):
+        submitted.add(prefix)
+        retry.discard(prefix)
+        real = os.path.join(path, prefix + REAL_SUFFIX)
+        fake = os.path.join(path, prefix + FAKE_SUFFIX)
+        pending[pool.submit(score_pair, real, fake)] = prefix
+
+    with open(out, "w", newline="") as file, ProcessPoolExecutor(workers) as pool:
+        writer = csv.writer(file)
+        writer.writerow(["number", "ssim", "psnr"])
+
+        while True:
+            # once the stop file shows up do a last scan, then drain the pool
+            if stop_file is not None and os.path.exists(stop_file):
+                finishing = True
+
+            if os.path.isdir(path):
+                for prefix in scan(path, sizes, finishing) - submitted:
+                    last_new = time.monotonic()
+                    submit(prefix)
+
+            if stop_file is None and time.monotonic() - last_new > idle:
+                finishing = True
+
+            done, _ = wait(list(pending), timeout=poll / 10.0 if finishing else poll,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix = pending.pop(future)
+                result = future.result()
+                if result is None:
+                    # not readable yet, give it another go on a later scan
+                    attempts[prefix] = attempts.get(prefix, 0) + 1
+                    if attempts[prefix] < retries:
+                        submitted.discard(prefix)
+                        retry.add(prefix)
+                    else:
+                        print("could not read pair: " + prefix)
+                    continue
+
+                writer.writerow(result)
+                ssims.append(result[1])
+                psnrs.append(result[2])
+                if len(ssims) % 500 == 0:
+                    file.flush()
+                    print(len(ssims))
+
+            # the scan at the top of this pass already picked up everything
+            # written before the stop, so an empty pool means we are done once
+            # the pairs sent back for another go have had it
+            if finishing and not pending:
+                if not retry:
+                    break
+                for prefix in sorted(retry):
+                    submit(prefix)
+
+    return summarize(ssims), summarize(psnrs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score test.py results while they are written.")
+    parser.add_argument("path", help="results directory, e.g. results/ab_night/test_latest/images")
+    parser.add_argument("--out", default="ssim_psnr.csv", help="csv file for per image scores")
+    parser.add_argument("--summary", default=None, help="json file for the final statistics")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between directory scans")
+    parser.add_argument("--stop-file", default=None, help="stop once this file exists")
+    parser.add_argument("--idle", type=float, default=600.0,
+                        help="without a stop file, stop after this many idle seconds")
+    parser.add_argument("--store", default=None, help="results_store.py store to add the scores to")
+    parser.add_argument("--run", default=None, help="run name for the store, e.g. ab_night")
+    args = parser.parse_args()
+
+    ssim_stats, psnr_stats = watch(args.path, args.out, args.workers, args.poll,
+                                   args.stop_file, args.idle)
+
+    print("SSIM  Mean: %G StDev: %G (%d images)" % (ssim_stats["mean"], ssim_stats["std"], ssim_stats["count"]))
+    print("PSNR  Mean: %G StDev: %G (%d images)" % (psnr_stats["mean"], psnr_stats["std"], psnr_stats["count"]))
+
+    if args.summary is not None:
+        with open(args.summary, "w") as file:
+            json.dump({"ssim": ssim_stats, "psnr": psnr_stats}, file, indent=2)
+
+    if args.store is not None:
+        import results_store
+
+        columns = results_store.read_csv(args.out)
+        columns["run"] = args.run or os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(args.path))))
+        columns["direction"], columns["model"], columns["condition"] = results_store.parse_run_name(columns["run"])
+        results_store.append(args.store, columns)
+
+
+if __name__ == "__main__":
+    main()
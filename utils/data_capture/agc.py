@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Offline AGC (histogram equalization) for 16 bit pre-AGC TIR frames
+#
+# combinedHDR.py and hdrTIR.py bracket three histeq_agc_gain_limit settings
+# because the camera bakes AGC into its 8 bit output, which costs three frames
+# per pair. With PRE_AGC capture the 16 bit frames before AGC are recorded once
+# and any gain limit can be rendered afterwards, in batch, on every core:
+#   python agc.py render TIRfull202408181354 outdir --gains 0.15 0.45 0.85 --crop 0 240 20 260 --size 256
+# The frames are read from a folder of 16 bit <pair>.png files (lossless and
+# compressed, what the capture scripts write by default) or a frame stack (.raw).
+#
+# The AGC is plateau histogram equalization. The gain limit g sets the plateau
+# each histogram bin is clipped to, N / occupied_bins / (1 - g). At g = 0 the
+# plateau is the mean count of the occupied bins, so the most common levels
+# get at most an average share of the output range and sparse ones keep theirs;
+# this is not a linear stretch. As g goes to 1 the plateau rises above every
+# bin and it becomes full histogram equalization. This follows the intent of
+# the camera's histeq_agc_gain_limit but is not bit exact with the camera's AGC.
+#
+# The histograms, look up tables and their application are computed for a
+# whole batch of frames at once with numpy, no per pixel or per frame loops.
+
+import argparse
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from framestack import FrameStackReader
+
+BITS = 16
+SHIFT = 4  # 16 bit values are binned into 4096 histogram bins
+
+PAIR_PNG = re.compile(r"^(\d+)\.png$")
+
+
+class PngFrames:
+    """A folder of 16 bit <pair>.png frames, read like a FrameStackReader.
+
+    ``frames[first:last]`` loads just those frames as one array.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.pairs = sorted(int(match.group(1)) for match in map(PAIR_PNG.match, os.listdir(folder)) if match)
+        self.frames = self
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, index):
+        return np.stack([cv2.imread(os.path.join(self.folder, "%d.png" % pair), cv2.IMREAD_UNCHANGED)
+                         for pair in self.pairs[index]])
+
+
+def open_frames(path):
+    """The pre-AGC frames of a folder of 16 bit pngs or of a frame stack."""
+    return PngFrames(path) if os.path.isdir(path) else FrameStackReader(path)
+
+
+def agc_luts(binned, gain_limit, bins, levels=256):
+    """Per frame look up tables from bin index to output level.
+
+    Parameters
+    ----------
+    binned: np.ndarray
+        (frames, pixels) bin index of every pixel.
+    gain_limit: float
+        0..1, how far towards full histogram equalization to go.
+    bins: int
+        Number of histogram bins.
+    levels: int
+        Number of output levels, 256 for 8 bit output.
+    """
+    frames, pixels = binned.shape
+    offsets = (np.arange(frames) * bins)[:, None]
+    hist = np.bincount((binned + offsets).ravel(), minlength=frames * bins).reshape(frames, bins)
+    hist = hist.astype(np.float64)
+
+    occupied = np.count_nonzero(hist, axis=1)
+    plateau = pixels / np.maximum(occupied, 1) / max(1.0 - gain_limit, 1e-3)
+    clipped = np.minimum(hist, plateau[:, None])
+
+    cdf = np.cumsum(clipped, axis=1)
+    # the lowest occupied bin maps to 0 and the highest to levels - 1
+    first = np.take_along_axis(cdf, np.argmax(hist > 0, axis=1)[:, None], axis=1)
+    scale = (levels - 1) / np.maximum(cdf[:, -1:] - first, 1e-9)
+    return np.clip(np.rint((cdf - first) * scale), 0, levels - 1)
+
+
+def histeq_agc(frames, gain_limit, out_dtype=np.uint8):
+    """Apply AGC to a batch of 16 bit frames.
+
+    Parameters
+    ----------
+    frames: np.ndarray
+        (frames, height, width) or (height, width) uint16 pre-AGC data.
+    gain_limit: float
+        0..1, like the camera's histeq_agc_gain_limit.
+    out_dtype: np.dtype
+        uint8 for normal images, uint16 for 16 bit output.
+    """
+    single = frames.ndim == 2
+    if single:
+        frames = frames[None]
+    count, height, width = frames.shape
+    bins = 1 << (BITS - SHIFT)
+    levels = np.iinfo(out_dtype).max + 1
+
+    binned = (np.asarray(frames, dtype=np.uint16) >> SHIFT).reshape(count, -1).astype(np.intp)
+    luts = agc_luts(binned, gain_limit, bins, levels).astype(out_dtype)
+    out = np.take_along_axis(luts, binned, axis=1).reshape(count, height, width)
+    return out[0] if single else out
+
+
+def render_range(path, outdir, gains, start, stop, crop, size, batch=64):
+    """Render frames start..stop-1 of pre-AGC frames at every gain limit."""
+    stack = open_frames(path)
+    for first in range(start, stop, batch):
+        last = min(first + batch, stop)
+        frames = stack.frames[first:last]
+        if crop is not None:
+            top, bottom, left, right = crop
+            frames = frames[:, top:bottom, left:right]
+        for mode, gain in enumerate(gains):
+            images = histeq_agc(frames, gain)
+            for offset, img in enumerate(images):
+                if size is not None:
+                    img = cv2.resize(img, (size, size), interpolation = cv2.INTER_AREA)
+                name = "%d_%d.png" % (stack.pairs[first + offset], mode)
+                cv2.imwrite(os.path.join(outdir, name), img)
+    return stop - start
+
+
+def render(path, outdir, gains, crop=None, size=None, workers=None, chunk=512):
+    """Render all pre-AGC frames of a png folder or stack at several gain limits on a process pool.
+
+    Files are named <pair>_<gain index>.png, the same as combinedHDR.py's.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    total = len(open_frames(path))
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(render_range, path, outdir, gains, start, min(start + chunk, total), crop, size)
+                for start in range(0, total, chunk)]
+        return sum(job.result() for job in jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render pre-AGC TIR frames at any AGC gain limit.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("render")
+    run.add_argument("stack", help="pre-AGC folder of 16 bit pngs or frame stack (.raw) from combinedHDR.py or "
+                                   "unifiedCapture.py")
+    run.add_argument("outdir")
+    run.add_argument("--gains", type=float, nargs="+", default=[0.45, 0.85, 0.15])
+    run.add_argument("--crop", type=int, nargs=4, default=None, help="top bottom left right")
+    run.add_argument("--size", type=int, default=None, help="resize to size x size")
+    run.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    count = render(args.stack, args.outdir, args.gains, args.crop, args.size, args.workers)
+    print("rendered %d frames at %d gain limits" % (count, len(args.gains)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# asyncio runtime for the SeekThermal capture scripts
+#
+# The SDK calls on_frame on its own delivery thread, and anything slow done
+# there (np.savetxt, rgb.read(), image writes) holds up the next frame. Here
+# the callback only copies the frame data it needs and hands it to an asyncio
+# event loop with call_soon_threadsafe, then returns. On the loop:
+#   - an optional grab function (e.g. rgb.read) starts on its own thread as soon
+#     as a frame arrives, so the RGB frame is taken close to the TIR frame even
+#     when writes are behind
+#   - frames wait in a bounded asyncio.Queue; when it is full new frames are
+#     dropped and counted instead of blocking the SDK thread
+#   - one task hands the frames to the script's handler in order, which runs
+#     its file I/O on an executor with runtime.io(...)
+#   - SIGINT/SIGTERM stop the camera, drain the queue, finish the writes and
+#     close everything
+#
+# Usage, from a capture script:
+#   runtime = CaptureRuntime(SeekCameraFrameFormat.CORRECTED, extract, handle)
+#   runtime.run()
+# with extract(camera_frame) -> data (runs on the SDK thread, keep it to a copy)
+# and async handle(runtime, frame) -> None.
+
+import asyncio
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from seekcamera import (
+    SeekCameraIOType,
+    SeekCameraColorPalette,
+    SeekCameraManager,
+    SeekCameraManagerEvent,
+)
+
+from startup import milestone
+from telemetry import Telemetry
+import tracing
+
+
+class Frame:
+    """One camera frame as handed to the handler."""
+
+    def __init__(self, number, timestamp, data, grabbed=None):
+        self.number = number
+        self.timestamp = timestamp
+        self.data = data
+        # future with the result of the grab function for this frame, if any
+        self.grabbed = grabbed
+
+
+class CaptureRuntime:
+    """Runs a capture session on an asyncio event loop.
+
+    Parameters
+    ----------
+    frame_format: SeekCameraFrameFormat
+        Format(s) to start the capture session with.
+    extract: Callable[[SeekCameraFrame], Any]
+        Called on the SDK thread; must return a copy of the data to keep, since
+        the SDK reuses its frame buffers once the callback returns.
+    handle: Callable[[CaptureRuntime, Frame], Awaitable[None]]
+        Processes and saves one frame on the event loop.
+    grab: Optional[Callable[[], Any]]
+        Started on a dedicated thread when each frame arrives, e.g. rgb.read.
+    maxsize: int
+        Frames that can wait for the handler before new ones are dropped.
+    io_workers: int
+        Threads for runtime.io. One keeps writes in frame order.
+    telemetry: Optional[Telemetry]
+        Where frames, drops, queue depth and camera events are counted.
+    """
+
+    def __init__(self, frame_format, extract, handle, grab=None, maxsize=64, io_workers=1, telemetry=None):
+        self.frame_format = frame_format
+        self.extract = extract
+        self.handle = handle
+        self.grab = grab
+        self.maxsize = maxsize
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.io_executor = ThreadPoolExecutor(io_workers, thread_name_prefix="capture-io")
+        self.grab_executor = ThreadPoolExecutor(1, thread_name_prefix="capture-grab") if grab else None
+        self.loop = None
+        self.queue = None
+        self.stopping = None
+        self.count = 0
+        self.camera = None
+
+    def io(self, function, *args):
+        """Run a blocking function on the I/O executor; await the result."""
+        return self.loop.run_in_executor(self.io_executor, function, *args)
+
+    # SDK thread side
+
+    def on_frame(self, _camera, camera_frame, _user_data):
+        began = tracing.begin()
+        self.telemetry.inc("frames_received")
+        data = self.extract(camera_frame)
+        try:
+            self.loop.call_soon_threadsafe(self.arrived, data, time.time())
+        except RuntimeError:
+            # a last frame delivered while the loop is closing
+            self.telemetry.inc("drops", reason="shutdown")
+        tracing.end("on_frame", began)
+
+    def on_event(self, camera, event_type, event_status, _user_data):
+        print("{}: {}".format(str(event_type), camera.chipid))
+        self.telemetry.inc("camera_events", event=str(event_type))
+        tracing.instant("camera event", event=str(event_type))
+
+        if event_type == SeekCameraManagerEvent.CONNECT:
+            milestone("thermal camera connected")
+            if self.camera is not None:
+                return
+            self.camera = camera
+            camera.color_palette = SeekCameraColorPalette.WHITE_HOT
+            camera.register_frame_available_callback(self.on_frame, None)
+            camera.capture_session_start(self.frame_format)
+
+        elif event_type == SeekCameraManagerEvent.DISCONNECT:
+            if self.camera == camera:
+                camera.capture_session_stop()
+                self.camera = None
+
+        elif event_type == SeekCameraManagerEvent.ERROR:
+            print("{}: {}".format(str(event_status), camera.chipid))
+
+    # event loop side
+
+    def arrived(self, data, timestamp):
+        if self.stopping.is_set():
+            return
+        if self.queue.qsize() >= self.maxsize:
+            self.telemetry.inc("drops", reason="queue_full")
+            return
+        self.count += 1
+        grabbed = None
+        if self.grab is not None:
+            grabbed = self.loop.run_in_executor(self.grab_executor, self.grab)
+        self.queue.put_nowait(Frame(self.count, timestamp, data, grabbed))
+        self.telemetry.set("queue_depth", self.queue.qsize())
+
+    async def consume(self):
+        while True:
+            frame = await self.queue.get()
+            if frame is None:
+                return
+            began = tracing.begin()
+            try:
+                await self.handle(self, frame)
+            except Exception as e:
+                # one bad frame shouldn't end the session
+                self.telemetry.inc("write_errors", stream="handler")
+                print("failed to handle frame {}: {}".format(frame.number, e))
+            tracing.end("handle", began, frame=frame.number)
+            self.telemetry.set("queue_depth", self.queue.qsize())
+
+    def stop(self):
+        """Ask the runtime to shut down; safe to call from any thread or a signal handler."""
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows event loops don't support add_signal_handler
+                signal.signal(signum, lambda *_: self.stop())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.maxsize + 1)  # room for the end marker
+        self.stopping = asyncio.Event()
+        self.install_signal_handlers()
+        consumer = asyncio.create_task(self.consume())
+
+        # Create a context structure responsible for managing all connected USB cameras.
+        with SeekCameraManager(SeekCameraIOType.USB) as manager:
+            manager.register_event_callback(self.on_event, None)
+            while not self.stopping.is_set():
+                # wake up now and then so signals are seen on every platform
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+            if self.camera is not None:
+                self.camera.capture_session_stop()
+
+        # frames already queued are still saved
+        self.queue.put_nowait(None)
+        await consumer
+
+    def run(self):
+        """Capture until SIGINT/SIGTERM, then finish all writes."""
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.io_executor.shutdown(wait=True)
+            if self.grab_executor is not None:
+                self.grab_executor.shutdown(wait=True)
+        print("{} frames captured".format(self.count))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# One entry point for all the capture scripts
+#
+#   python capture.py combined
+#   python capture.py combined --profile video
+#   python capture.py thermography --set THERMOGRAPHY_OUTPUT=stack
+#   python capture.py list
+#
+# The subcommand picks the script, a profile sets a group of its settings (the
+# upper case constants at the top of the script) and --set KEY=VALUE sets one,
+# with VALUE read as JSON when it parses and as a plain string otherwise.
+# Profiles of your own go in a JSON file passed with --profiles, e.g.
+#   {"night": {"script": "combined", "settings": {"STATS": false}}}
+#
+# Only the chosen script is imported, after the arguments are checked, so
+# argparse errors and `list` come back at once and no script pays for the
+# modules of another (matplotlib, http.server, asyncio, ...). startup.py is
+# imported first so the [startup] lines count from process start, through the
+# rgb camera opening and the thermal camera pairing, to the first saved pair.
+
+import startup
+
+import argparse
+import importlib
+import json
+import os
+
+SCRIPTS = {
+    "combined": "combined",
+    "hdr": "combinedHDR",
+    "hdrtir": "hdrTIR",
+    "processed": "processedTIR",
+    "corrected": "correctedTIR",
+    "thermography": "thermography",
+    "webcam": "webcamRGB",
+    "unified": "unifiedCapture",
+}
+
+PROFILES = {
+    "field": {"script": "combined", "settings": {"OUTPUT_MODE": "images", "STATS": True}},
+    "video": {"script": "combined", "settings": {"OUTPUT_MODE": "video"}},
+    "raw": {"script": "combined", "settings": {"OUTPUT_MODE": "video", "RAW_RGB": True}},
+    "calibrate": {"script": "combined", "settings": {"REGISTRATION": True}},
+    "pre-agc": {"script": "hdr", "settings": {"PRE_AGC": True}},
+    "radiometric": {"script": "thermography", "settings": {"THERMOGRAPHY_OUTPUT": "stack"}},
+}
+
+
+def parse_setting(text):
+    """KEY=VALUE to (KEY, value), with the value parsed as JSON when it can be."""
+    key, sep, value = text.partition("=")
+    if not sep or not key:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE, got " + repr(text))
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def load_profiles(path):
+    profiles = dict(PROFILES)
+    if path is not None:
+        with open(path) as file:
+            profiles.update(json.load(file))
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a capture script with a profile and setting overrides.")
+    parser.add_argument("--profiles", default=None, help="JSON file of extra profiles")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the scripts and profiles")
+    for command, module in SCRIPTS.items():
+        run = commands.add_parser(command, help="run " + module + ".py")
+        run.add_argument("--profile", default=None, help="named group of settings")
+        run.add_argument("--set", dest="settings", type=parse_setting, action="append", default=[],
+                         metavar="KEY=VALUE", help="set one of the script's constants, may be repeated")
+    args = parser.parse_args()
+    profiles = load_profiles(args.profiles)
+
+    if args.command == "list":
+        for command, module in SCRIPTS.items():
+            print("{:<14}{}.py".format(command, module))
+        print()
+        for name, profile in profiles.items():
+            print("{:<14}{} {}".format(name, profile["script"], json.dumps(profile["settings"])))
+        return
+
+    settings = {}
+    if args.profile is not None:
+        if args.profile not in profiles:
+            parser.error("unknown profile {} (see: capture.py list)".format(args.profile))
+        profile = profiles[args.profile]
+        if profile["script"] != args.command:
+            parser.error("profile {} is for {}, not {}".format(args.profile, profile["script"], args.command))
+        settings.update(profile["settings"])
+    settings.update(args.settings)
+
+    # the Seek SDK looks for its library here; the scripts that use it set this too
+    os.environ.setdefault("SEEKTHERMAL_LIB_DIR", os.getcwd())
+    script = importlib.import_module(SCRIPTS[args.command])
+    startup.milestone("imports done")
+    for key, value in settings.items():
+        if not key.isupper() or not hasattr(script, key):
+            parser.error("{}.py has no setting {}".format(SCRIPTS[args.command], key))
+        setattr(script, key, value)
+    script.main()
+
+
+if __name__ == "__main__":
+    main()
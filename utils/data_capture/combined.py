@@ -11,6 +11,7 @@
 # As a note, this requires the seekcamera.dll file provided in the seek thermal programming kit
 
 from threading import Condition
+import time
 
 import cv2
 import os
@@ -26,16 +27,85 @@ from seekcamera import (
     SeekFrame,
 )
 
+from framebuffers import FrameBuffers
+from graytir import GrayFrames
+from journal import Journal, latest
+from rgbgrab import RgbGrabber, open_camera
+from startup import Background, milestone
+from telemetry import Telemetry
+import tracing
+# diskout, mjpeg, registration, sessionstats and videostore are imported where
+# the settings that need them are checked, so startup skips what isn't used
+
+# "images" saves one file per frame into the four folders below, "video" encodes
+# each of the four streams into one lossless video with a frame index next to it
+# in a single session folder (see videostore.py)
+OUTPUT_MODE = "images"
+
+# RAW_RGB stores the webcam's MJPEG frames untouched (see mjpeg.py) instead of
+# decoding, rotating, cropping and resizing them during capture. The RGB folders
+# are then made afterwards with: python mjpeg.py process <file> <outdir>
+RAW_RGB = False
+
+# REGISTRATION replaces the hand picked TIR crop below with a TIR to RGB
+# homography estimated from the first CALIBRATION_PAIRS pairs of the session and
+# cached in the session folder as registration.json (see registration.py). Set
+# REGISTRATION_FROM to an earlier session folder of the same rig to reuse its
+# registration instead of calibrating again; one made for another frame size is
+# dropped and the session calibrates. The estimate runs on a thread, and pairs
+# keep the hand picked crop until it is ready.
+REGISTRATION = False
+CALIBRATION_PAIRS = 30
+REGISTRATION_FROM = None
+
+# STATS keeps running mean/std, histograms and min/max of every saved TIR and
+# RGB image and writes them to stats.json in the session folder (see
+# sessionstats.py), so normalization needs no extra pass over the images
+STATS = True
+
+# TELEMETRY_PORT serves live counters (frames, pairs, drops, write latency,
+# free disk, camera events) on http://127.0.0.1:<port>/metrics, None to turn
+# the endpoint off. Snapshots also go to telemetry.jsonl in the session folder
+# and a summary line is printed every TELEMETRY_INTERVAL seconds (see telemetry.py)
+TELEMETRY_PORT = 9108
+TELEMETRY_INTERVAL = 5.0
+
+# In "images" mode the folders move on to the next of SPILL_VOLUMES (other
+# drives or folders) when the current disk gets low, and WRITE_BUDGET (bytes per
+# second, None for no limit) caps the write rate by dropping the full size BMPs
+# first. Failed and dropped writes are counted in telemetry (see diskout.py)
+SPILL_VOLUMES = []
+WRITE_BUDGET = None
+
+# "images" mode journals pairs in the session folder and RESUME continues a
+# crashed session there (see journal.py)
+RESUME = True
+FSYNC_EVERY = 30
+
+# one 8 bit channel for WHITE_HOT TIR frames instead of BGRA (see graytir.py)
+GRAY_TIR = True
+
+# webcam mode, a name in rgbgrab.PROFILES or a dict (see rgbgrab.py)
+RGB_PROFILE = "default"
+
+# REUSE_BUFFERS decodes the webcam frames and does the flips, rotations and
+# resizes of every pair into arrays allocated once, so memory stays flat over
+# long sessions (see framebuffers.py and soak.py)
+REUSE_BUFFERS = True
+
 
 class Renderer:
     """Contains camera and image data required to render images to the screen."""
 
-    def __init__(self):
+    def __init__(self, telemetry):
         self.busy = False
         self.frame = SeekFrame()
         self.camera = SeekCamera()
         self.frame_condition = Condition()
         self.first_frame = True
+        self.gray = GRAY_TIR
+        self.pending = False
+        self.telemetry = telemetry
 
 
 def on_frame(_camera, camera_frame, renderer):
@@ -55,9 +125,17 @@ def on_frame(_camera, camera_frame, renderer):
     # Acquire the condition variable and notify the main thread
     # that a new frame is ready to render. This is required since
     # all rendering done by OpenCV needs to happen on the main thread.
-    with renderer.frame_condition:
+    began = tracing.begin()
+    renderer.telemetry.inc("frames_received")
+    with tracing.locked(renderer.frame_condition, "on_frame lock"):
+        if renderer.pending:
+            # the main loop didn't take the previous frame in time
+            renderer.telemetry.inc("drops", reason="overwritten")
         renderer.frame = camera_frame.color_argb8888
+        renderer.pending = True
+        renderer.telemetry.set("queue_depth", 1)
         renderer.frame_condition.notify()
+    tracing.end("on_frame", began)
 
 
 def on_event(camera, event_type, event_status, renderer):
@@ -76,8 +154,11 @@ def on_event(camera, event_type, event_status, renderer):
         but in this case it is a reference to the Renderer object.
     """
     print("{}: {}".format(str(event_type), camera.chipid))
+    renderer.telemetry.inc("camera_events", event=str(event_type))
+    tracing.instant("camera event", event=str(event_type))
 
     if event_type == SeekCameraManagerEvent.CONNECT:
+        milestone("thermal camera connected")
         if renderer.busy:
             return
 
@@ -94,6 +175,10 @@ def on_event(camera, event_type, event_status, renderer):
         # Other options can set in a similar fashion.
         camera.color_palette = SeekCameraColorPalette.WHITE_HOT
         # WHITE_HOT, TYRIAN
+        # GRAY_TIR only holds for WHITE_HOT, whose three color channels are equal
+        renderer.gray = GRAY_TIR and camera.color_palette == SeekCameraColorPalette.WHITE_HOT
+        if GRAY_TIR and not renderer.gray:
+            print("GRAY_TIR needs the WHITE_HOT palette, keeping color frames")
 
         # Start imaging and provide a custom callback to be called
         # every time a new frame is received.
@@ -128,84 +213,242 @@ def main():
 
     pairNum = 1
 
-    # Set up folder to save new capture data in
-    now = datetime.now()
-    date_time = now.strftime("%Y%m%d%H%M")
-    dir1 = os.path.join(os.getcwd(),"RGB" + date_time)
-    os.mkdir(dir1)
-    dir2 = os.path.join(os.getcwd(),"TIR" + date_time)
-    os.mkdir(dir2)
-    dir3 = os.path.join(os.getcwd(),"RGBfull" + date_time)
-    os.mkdir(dir3)
-    dir4 = os.path.join(os.getcwd(),"TIRfull" + date_time)
-    os.mkdir(dir4)
-
-    rgb = cv2.VideoCapture(0) # video capture source camera
+    # Set up folder to save new capture data in, or continue the last session
+    previous = None
+    if OUTPUT_MODE == "images" and RESUME:
+        previous = latest(os.path.join(os.getcwd(), "capture*", "journal.jsonl"))
+    if previous is not None:
+        journal = Journal(previous, root=os.getcwd(), fsync_every=FSYNC_EVERY)
+        date_time = journal.header["date_time"]
+    else:
+        now = datetime.now()
+        date_time = now.strftime("%Y%m%d%H%M")
+    # session folder for everything that isn't a frame (videos, registration, ...)
+    session = os.path.join(os.getcwd(),"capture" + date_time)
+    os.makedirs(session, exist_ok=True)
+    if OUTPUT_MODE == "images" and previous is None:
+        journal = Journal(os.path.join(session, "journal.jsonl"), root=os.getcwd(),
+                          fsync_every=FSYNC_EVERY, header={"date_time": date_time})
+    telemetry = Telemetry()
+    if OUTPUT_MODE == "video":
+        from videostore import VideoStreamWriter
+        videos = {
+            name: VideoStreamWriter(os.path.join(session, name))
+            # with RAW_RGB the webcam's jpegs go to the .mjpeg stream instead
+            for name in (("TIR", "TIRfull") if RAW_RGB else ("TIR", "RGB", "TIRfull", "RGBfull"))
+        }
+    else:
+        from diskout import DiskOutput
+        output = DiskOutput([os.getcwd()] + SPILL_VOLUMES, budget=WRITE_BUDGET, telemetry=telemetry,
+                            journal=journal)
+        dir1 = "RGB" + date_time
+        dir2 = "TIR" + date_time
+        dir3 = "RGBfull" + date_time
+        dir4 = "TIRfull" + date_time
+        for name in (dir1, dir2, dir3, dir4):
+            output.folder(name)
+
+        pairNum = journal.next_pair
+        if journal.resumed:
+            folders = [os.path.join(volume, name) for volume in output.volumes
+                       for name in (dir1, dir2, dir3, dir4)]
+            removed = journal.discard_incomplete(folders)
+            print("resuming session {} at pair {} ({} files of incomplete pairs removed)".format(
+                date_time, pairNum, removed))
+
+    if STATS:
+        from sessionstats import SessionStats
+        if OUTPUT_MODE == "images":
+            # saved whenever the journal syncs, so after a crash they agree with it
+            stats = SessionStats(session, save_every=None)
+            journal.on_sync = stats.save
+        else:
+            stats = SessionStats(session)
+    registration = None
+    calibration = []
+    fitting = None
+    if REGISTRATION:
+        from registration import Registration, estimate
+        if REGISTRATION_FROM is not None:
+            registration = Registration.load(REGISTRATION_FROM)
+            registration.save(session)
+
+    # the webcam opens on a thread while the thermal camera pairs (see startup.py)
+    if RAW_RGB:
+        from mjpeg import MjpegWriter, is_jpeg, open_raw_capture, transform_combined
+        rgb_opening = Background("rgb camera open", lambda: RgbGrabber(open_raw_capture(0)[0], telemetry,
+                                                                       REUSE_BUFFERS))
+        # a resumed session carries on its stream after the last complete pair
+        rgbstream = MjpegWriter(os.path.join(os.getcwd(), "RGBraw" + date_time), append=previous is not None,
+                                resume_at=pairNum)
+    else:
+        # video capture source camera
+        rgb_opening = Background("rgb camera open", lambda: RgbGrabber(open_camera(0, RGB_PROFILE), telemetry,
+                                                                       REUSE_BUFFERS))
+    rgb = None
+
+    gray = GrayFrames()
+    buffers = FrameBuffers(REUSE_BUFFERS)
 
     # Create a context structure responsible for managing all connected USB cameras.
     # Cameras with other IO types can be managed by using a bitwise or of the
     # SeekCameraIOType enum cases.
     with SeekCameraManager(SeekCameraIOType.USB) as manager:
         # Start listening for events.
-        renderer = Renderer()
+        renderer = Renderer(telemetry)
+        if TELEMETRY_PORT is not None:
+            try:
+                telemetry.serve(TELEMETRY_PORT)
+            except OSError as e:
+                print("metrics endpoint not started: %s" % str(e))
+        telemetry.report(os.path.join(session, "telemetry.jsonl"), TELEMETRY_INTERVAL, session)
         manager.register_event_callback(on_event, renderer)
 
         while True:
             # Wait a maximum of 150ms for each frame to be received.
             # A condition variable is used to synchronize the access to the renderer;
             # it will be notified by the user defined frame available callback thread.
-            with renderer.frame_condition:
-                if renderer.frame_condition.wait(150.0 / 1000.0):
+            # (tracing.locked is the condition itself unless TRI2I_TRACE is set, see tracing.py)
+            with tracing.locked(renderer.frame_condition, "main lock"):
+                with tracing.span("frame wait"):
+                    # a frame may have come in while the last pair was made
+                    ready = renderer.frame_condition.wait_for(lambda: renderer.pending, 150.0 / 1000.0)
+                if ready:
+                    renderer.pending = False
+                    telemetry.set("queue_depth", 0)
+
                     #get images into img (TIR) and frame (RGB)
-                    img = renderer.frame.data
-                    pureTIR = img;#tir normal
-                    img = img[0:240, 20:260]#tir square was 40:280 on second one
-                    #img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                    
+                    # a copy of the frame is taken and the lock let go, so the
+                    # SDK can hand over the next frame while this pair is made
+                    img = gray.convert(renderer.frame.data) if renderer.gray else buffers.copy("frame", renderer.frame.data)
+
+            if ready:
+                pureTIR = img;#tir normal
+                img = img[0:240, 20:260]#tir square was 40:280 on second one
+                
+                if rgb is None:
+                    rgb = rgb_opening.result()
+                with tracing.span("rgb read"):
                     ret,ogrgb = rgb.read()
-                    rgbimg = cv2.flip(ogrgb, 1)#flip horizontally
-                    rgbimg = cv2.rotate(rgbimg, cv2.ROTATE_90_COUNTERCLOCKWISE)
-                    pureRGB = rgbimg[140:500, 0:480]#480x640->480x360
-                    pureDim = (320,240)
-                    pureRGBr = cv2.resize(pureRGB, pureDim, interpolation = cv2.INTER_AREA)
-                    rgbimg = rgbimg[64:576, 0:512]
+                if not ret:
+                    telemetry.inc("drops", reason="rgb_read")
+                else:
+                    began = tracing.begin()
+                    if not RAW_RGB:
+                        rgbimg = buffers.flip("flip", ogrgb, 1)#flip horizontally
+                        rgbimg = buffers.rotate("rotate", rgbimg, cv2.ROTATE_90_COUNTERCLOCKWISE)
+                        pureRGB = rgbimg[140:500, 0:480]#480x640->480x360
+                        pureDim = (320,240)
+                        pureRGBr = buffers.resize("RGBfull", pureRGB, pureDim)
+                        rgbimg = rgbimg[64:576, 0:512]
 
 
-                    filename = str(pairNum) + ".jpg"
-                    #TIR img to file here
-                    os.chdir(dir1)
                     dim = (256, 256)
-                    resizedt = cv2.resize(img, dim, interpolation = cv2.INTER_AREA)
-                    cv2.imwrite(filename, resizedt)
-                    
-                    #RGB img to file here
-                    os.chdir(dir2)
-                    resizedr = cv2.resize(rgbimg, dim, interpolation = cv2.INTER_AREA)
-                    cv2.imwrite(filename, resizedr)
-
-                    #saving pure versions
-                    filename = str(pairNum) + ".bmp"
-                    os.chdir(dir3)
-                    cv2.imwrite(filename, pureTIR)
-                    os.chdir(dir4)
-                    cv2.imwrite(filename, pureRGBr)
+                    if not RAW_RGB:
+                        resizedr = buffers.resize("RGB", rgbimg, dim)
+
+                    if registration is not None and not registration.fits(pureTIR.shape):
+                        print("registration is for {} frames, not {}".format(
+                            tuple(registration.source_shape), pureTIR.shape[:2]))
+                        registration = None
+                    if registration is not None:
+                        # one remap from the full frame does both crop and resize
+                        resizedt = registration.apply(pureTIR, buffers.get("TIR", (dim[1], dim[0]) + pureTIR.shape[2:],
+                                                                           pureTIR.dtype))
+                        img = resizedt
+                    else:
+                        resizedt = buffers.resize("TIR", img, dim)
+
+                    if REGISTRATION and registration is None and fitting is None:
+                        # calibration segment, frames are still saved with the hand crop
+                        if RAW_RGB:
+                            decoded = cv2.imdecode(ogrgb.reshape(-1), cv2.IMREAD_COLOR) if is_jpeg(ogrgb) else ogrgb
+                            calrgb = transform_combined(decoded)["RGB"]
+                        else:
+                            calrgb = resizedr.copy()
+                        calibration.append((pureTIR.copy(), calrgb))
+                        if len(calibration) == CALIBRATION_PAIRS:
+                            # ECC over every pair takes seconds, so it runs on a
+                            # thread and the hand crop stays in use until it's done
+                            fitting = Background("registration estimated", estimate, [c[0] for c in calibration],
+                                                 [c[1] for c in calibration], (0, 240, 20, 260), dim)
+                            calibration = []
+                    elif fitting is not None and fitting.done():
+                        registration = fitting.result()
+                        fitting = None
+                        registration.save(session)
+                        print("registration ready (ecc {:.3f} over {} pairs)".format(
+                            registration.score, registration.frames))
+
+                    tracing.end("preprocess", began)
+
+                    write_start = time.perf_counter()
+                    began = tracing.begin()
+                    if OUTPUT_MODE == "video":
+                        videos["TIR"].write(resizedt, pairNum)
+                        videos["TIRfull"].write(pureTIR, pairNum)
+                        if not RAW_RGB:
+                            videos["RGB"].write(resizedr, pairNum)
+                            videos["RGBfull"].write(pureRGBr, pairNum)
+                        saved = True
+                    else:
+                        filename = str(pairNum) + ".jpg"
+                        #TIR img to file here
+                        saved = output.write(dir1, filename, resizedt)
+                
+                        #RGB img to file here
+                        if saved and not RAW_RGB:
+                            saved = output.write(dir2, filename, resizedr)
+
+                        #saving pure versions, the first to be dropped when short on disk
+                        if saved:
+                            filename = str(pairNum) + ".bmp"
+                            output.write(dir3, filename, pureTIR, optional=True)
+                            if not RAW_RGB:
+                                output.write(dir4, filename, pureRGBr, optional=True)
+                        else:
+                            # a pair without both images is never committed,
+                            # its number goes to the next pair
+                            journal.discard()
+                    if saved and RAW_RGB:
+                        # keep the camera's jpeg as is, it is processed offline;
+                        # only once the TIR image is saved, so a discarded pair
+                        # leaves no frame behind
+                        rgbstream.write(ogrgb, pairNum)
+                    telemetry.observe("write_seconds", time.perf_counter() - write_start)
+
+                    # before the commit, so the stats saved with the journal
+                    # cover exactly its pairs
+                    if saved and STATS:
+                        with tracing.span("stats"):
+                            stats.update("TIR", resizedt)
+                            if not RAW_RGB:
+                                stats.update("RGB", resizedr)
+                    if saved and OUTPUT_MODE != "video":
+                        journal.commit(pairNum)
+                    tracing.end("save pair", began, pair=pairNum)
 
                     # Resize the rendering window.
                     if renderer.first_frame:
-                        (height, width, _) = resizedr.shape
+                        (height, width) = resizedt.shape[:2]
                         cv2.resizeWindow(window_name, width * 2, height * 2)
                         cv2.resizeWindow(other_window, width * 2, height * 2)
                         renderer.first_frame = False
 
                     # Render the image to the window.
-                    cv2.imshow(window_name, img)
-                    cv2.imshow(other_window, rgbimg)
+                    with tracing.span("display"):
+                        cv2.imshow(window_name, img)
+                        if not RAW_RGB:
+                            cv2.imshow(other_window, rgbimg)
 
-                    print(pairNum)
-                    pairNum+=1
+                    if saved:
+                        telemetry.inc("pairs_written")
+                        milestone("first pair saved", telemetry)
+                        pairNum+=1
 
             # Process key events.
-            key = cv2.waitKey(1)
+            with tracing.span("waitKey"):
+                key = cv2.waitKey(1)
             if key == ord("q"):
                 break
 
@@ -213,6 +456,20 @@ def main():
             if not cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE):
                 break
 
+    if OUTPUT_MODE == "video":
+        for video in videos.values():
+            video.close()
+    else:
+        journal.close()
+    rgb_opening.result().release()
+    if RAW_RGB:
+        rgbstream.close()
+    if STATS:
+        stats.save()
+    telemetry.close()
+    totals = telemetry.snapshot()
+    print(telemetry.summary(totals, telemetry.counter("pairs_written") / max(totals["uptime"], 1e-9)))
+
     cv2.destroyWindow(window_name)
     cv2.destroyWindow(other_window)
 
@@ -27,6 +27,35 @@ from seekcamera import (
     SeekFrame,
 )
 
+from framestack import FrameStackWriter
+from graytir import GrayFrames
+from journal import Journal, latest
+from rgbgrab import RgbGrabber, open_camera
+from startup import Background, milestone
+from telemetry import Telemetry
+
+# PRE_AGC records the camera's 16 bit frames from before AGC (in the TIRfull
+# folder) instead of bracketing three gain limits, so every frame is a pair. Any
+# gain limit is then rendered afterwards with agc.py, e.g.
+#   python agc.py render TIRfull<date> TIR<date> --gains 0.45 0.85 0.15 --crop 0 240 20 260 --size 256
+# gives the same <pair>_<gain>.png files this script writes in bracketing mode.
+# PRE_AGC_OUTPUT "png" saves each frame as a lossless 16 bit <pair>.png, part of
+# its pair in the journal; "stack" appends the raw frames uncompressed to a
+# frame stack (see framestack.py), cheaper to write but 2 bytes per pixel.
+PRE_AGC = False
+PRE_AGC_OUTPUT = "png"
+
+# pairs are journaled in journal<date>.jsonl and RESUME continues a crashed
+# session (see journal.py)
+RESUME = True
+FSYNC_EVERY = 30
+
+# one 8 bit channel for WHITE_HOT TIR frames instead of BGRA (see graytir.py)
+GRAY_TIR = True
+
+# webcam mode, a name in rgbgrab.PROFILES or a dict (see rgbgrab.py)
+RGB_PROFILE = "default"
+
 
 class Renderer:
     """Contains camera and image data required to render images to the screen."""
@@ -37,6 +66,9 @@ class Renderer:
         self.camera = SeekCamera()
         self.frame_condition = Condition()
         self.first_frame = True
+        self.gray = GRAY_TIR
+        self.pre_agc = None
+        self.pending = False
 
 
 def on_frame(_camera, camera_frame, renderer):
@@ -58,6 +90,9 @@ def on_frame(_camera, camera_frame, renderer):
     # all rendering done by OpenCV needs to happen on the main thread.
     with renderer.frame_condition:
         renderer.frame = camera_frame.color_argb8888
+        if PRE_AGC:
+            renderer.pre_agc = camera_frame.pre_agc
+        renderer.pending = True
         renderer.frame_condition.notify()
 
 
@@ -79,6 +114,7 @@ def on_event(camera, event_type, event_status, renderer):
     print("{}: {}".format(str(event_type), camera.chipid))
 
     if event_type == SeekCameraManagerEvent.CONNECT:
+        milestone("thermal camera connected")
         if renderer.busy:
             return
 
@@ -95,11 +131,18 @@ def on_event(camera, event_type, event_status, renderer):
         # Other options can set in a similar fashion.
         camera.color_palette = SeekCameraColorPalette.WHITE_HOT
         # WHITE_HOT, TYRIAN
+        # GRAY_TIR only holds for WHITE_HOT, whose three color channels are equal
+        renderer.gray = GRAY_TIR and camera.color_palette == SeekCameraColorPalette.WHITE_HOT
+        if GRAY_TIR and not renderer.gray:
+            print("GRAY_TIR needs the WHITE_HOT palette, keeping color frames")
 
         # Start imaging and provide a custom callback to be called
         # every time a new frame is received.
         camera.register_frame_available_callback(on_frame, renderer)
-        camera.capture_session_start(SeekCameraFrameFormat.COLOR_ARGB8888)
+        if PRE_AGC:
+            camera.capture_session_start(SeekCameraFrameFormat.COLOR_ARGB8888 | SeekCameraFrameFormat.PRE_AGC)
+        else:
+            camera.capture_session_start(SeekCameraFrameFormat.COLOR_ARGB8888)
 
     elif event_type == SeekCameraManagerEvent.DISCONNECT:
         # Check that the camera disconnecting is one actually associated with
@@ -118,6 +161,16 @@ def on_event(camera, event_type, event_status, renderer):
         return
 
 
+def save_image(journal, path, img):
+    """Write one image of the pair through the journal, False if it could not
+    be encoded or written (e.g. a full disk)."""
+    try:
+        return journal.write_image(path, img)
+    except OSError as e:
+        print("failed to write {}: {}".format(path, e))
+        return False
+
+
 def main():
     cwd = os.getcwd()
     os.environ["SEEKTHERMAL_LIB_DIR"] = cwd
@@ -127,24 +180,45 @@ def main():
     cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
     cv2.namedWindow(other_window, cv2.WINDOW_NORMAL)
 
-    # file name will be pairnum--change it every session so you have different names for everything
-    pairNum = 1
     gainmode = 0
     gains = np.array([0.45, 0.85, 0.15])
 
-    # Set up folder to save new capture data in
-    now = datetime.now()
-    date_time = now.strftime("%Y%m%d%H%M")
+    # Set up folder to save new capture data in, or continue the last session
+    previous = latest(os.path.join(os.getcwd(), "journal*.jsonl")) if RESUME else None
+    if previous is not None:
+        journal = Journal(previous, fsync_every=FSYNC_EVERY)
+        date_time = journal.header["date_time"]
+    else:
+        now = datetime.now()
+        date_time = now.strftime("%Y%m%d%H%M")
+        journal = Journal(os.path.join(os.getcwd(), "journal" + date_time + ".jsonl"),
+                          fsync_every=FSYNC_EVERY, header={"date_time": date_time})
     dir1 = os.path.join(os.getcwd(),"TIR" + date_time)
-    os.mkdir(dir1)
     dir2 = os.path.join(os.getcwd(),"RGB" + date_time)
-    os.mkdir(dir2)
     dir3 = os.path.join(os.getcwd(),"TIRfull" + date_time)
-    os.mkdir(dir3)
     dir4 = os.path.join(os.getcwd(),"RGBfull" + date_time)
-    os.mkdir(dir4)
+    for folder in (dir1, dir2, dir3, dir4):
+        os.makedirs(folder, exist_ok=True)
+
+    # file name is the pair number, unique over the whole session
+    pairNum = journal.next_pair
+    if journal.resumed:
+        removed = journal.discard_incomplete([dir1, dir2, dir3, dir4])
+        print("resuming session {} at pair {} ({} files of incomplete pairs removed)".format(
+            date_time, pairNum, removed))
+
+    if PRE_AGC and PRE_AGC_OUTPUT == "stack":
+        # a resumed session gets a new stack; its frames of incomplete pairs
+        # are the ones whose pair isn't in the journal
+        name = "preagc" + date_time if pairNum == 1 else "preagc{}-{}".format(date_time, pairNum)
+        preagc = FrameStackWriter(os.path.join(dir3, name))
 
-    rgb = cv2.VideoCapture(1) # video capture source camera
+    # the webcam opens on a thread while the thermal camera pairs (see startup.py)
+    telemetry = Telemetry()
+    rgb_opening = Background("rgb camera open", lambda: RgbGrabber(open_camera(1, RGB_PROFILE), telemetry)) # video capture source camera
+    rgb = None
+
+    gray = GrayFrames()
 
     # Create a context structure responsible for managing all connected USB cameras.
     # Cameras with other IO types can be managed by using a bitwise or of the
@@ -159,7 +233,10 @@ def main():
             # A condition variable is used to synchronize the access to the renderer;
             # it will be notified by the user defined frame available callback thread.
             with renderer.frame_condition:
-                if renderer.frame_condition.wait(150.0 / 1000.0):
+                # a frame may have come in while the last pair was made
+                ready = renderer.frame_condition.wait_for(lambda: renderer.pending, 150.0 / 1000.0)
+                if ready:
+                    renderer.pending = False
                     # Resize the rendering window.
                     if renderer.first_frame:
                         renderer.camera.histeq_agc_gain_limit = gains[2] #0.65 is default
@@ -169,54 +246,83 @@ def main():
                         cv2.resizeWindow(window_name, width * 2, height * 2)
                         cv2.resizeWindow(other_window, width * 2, height * 2)
                         renderer.first_frame = False
+                        ready = False
                     else:
-                        #get images into img (TIR) and frame (RGB)
-                        img = renderer.frame.data
-                        pureTIR = img;#tir normal
-                        img = img[0:240, 20:260]#tir square was 40:280 on second one
-                        #img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                    
-                        ret,ogrgb = rgb.read()
-                        #rgbimg = cv2.flip(ogrgb, 1)#flip horizontally
-                        rgbimg = cv2.rotate(ogrgb, cv2.ROTATE_90_CLOCKWISE)
-                        pureRGB = rgbimg[50:410, 120:600]#480x640->480x360
-                        pureDim = (320,240)
-                        pureRGBr = cv2.resize(pureRGB, pureDim, interpolation = cv2.INTER_AREA)
-                        rgbimg = rgbimg[54:566, 0:512]
-
-                        filename = str(pairNum)
+                        # a copy of the frame is taken and the lock let go, so the
+                        # SDK can hand over the next frame while this pair is made
+                        img = gray.convert(renderer.frame.data) if renderer.gray else renderer.frame.data.copy()
+                        pre_agc = renderer.pre_agc.data.copy() if PRE_AGC else None
+
+            if ready:
+                pureTIR = img;#tir normal
+                img = img[0:240, 20:260]#tir square was 40:280 on second one
+
+                if rgb is None:
+                    rgb = rgb_opening.result()
+                ret,ogrgb = rgb.read()
+                if not ret:
+                    # the gain setting stays, so the next frame is taken with it again
+                    telemetry.inc("drops", reason="rgb_read")
+                else:
+                    #rgbimg = cv2.flip(ogrgb, 1)#flip horizontally
+                    rgbimg = cv2.rotate(ogrgb, cv2.ROTATE_90_CLOCKWISE)
+                    pureRGB = rgbimg[50:410, 120:600]#480x640->480x360
+                    pureDim = (320,240)
+                    pureRGBr = cv2.resize(pureRGB, pureDim, interpolation = cv2.INTER_AREA)
+                    rgbimg = rgbimg[54:566, 0:512]
+
+                    filename = str(pairNum)
                     
-                        #TIR img to file here
-                        os.chdir(dir1)
-                        dim = (256, 256)
-                        resizedt = cv2.resize(img, dim, interpolation = cv2.INTER_AREA)
-                        cv2.imwrite(filename + "_" + str(gainmode) + ".png", resizedt)
+                    #TIR img to file here
+                    dim = (256, 256)
+                    resizedt = gray.resize(img, dim) if renderer.gray else cv2.resize(img, dim, interpolation = cv2.INTER_AREA)
+                    results = []
+                    if PRE_AGC and PRE_AGC_OUTPUT != "stack":
+                        results.append(save_image(journal, os.path.join(dir3, filename + ".png"), pre_agc))
+                    elif not PRE_AGC:
+                        results.append(save_image(journal, os.path.join(dir1, filename + "_" + str(gainmode) + ".png"), resizedt))
                     
-                        #RGB img to file here
-                        os.chdir(dir2)
-                        resizedr = cv2.resize(rgbimg, dim, interpolation = cv2.INTER_AREA)
-                        cv2.imwrite(filename + ".png", resizedr)
-
-                        #saving pure versions
-                        filename = str(pairNum) + ".bmp"
-                        os.chdir(dir3)
-                        cv2.imwrite(filename + "_" + str(gainmode) + ".png", pureTIR)
-                        os.chdir(dir4)
-                        cv2.imwrite(filename + ".png", pureRGBr)
-
-                        # deal with getting hdr settings right
-                        if gainmode == 2:
-                            gainmode = 0
-                            pairNum += 1
-                        else:
-                            gainmode += 1
+                    #RGB img to file here
+                    resizedr = cv2.resize(rgbimg, dim, interpolation = cv2.INTER_AREA)
+                    results.append(save_image(journal, os.path.join(dir2, filename + ".png"), resizedr))
+
+                    #saving pure versions
+                    filename = str(pairNum) + ".bmp"
+                    if not PRE_AGC:
+                        results.append(save_image(journal, os.path.join(dir3, filename + "_" + str(gainmode) + ".png"), pureTIR))
+                    results.append(save_image(journal, os.path.join(dir4, filename + ".png"), pureRGBr))
+                    saved = all(results)
+                    if saved and PRE_AGC and PRE_AGC_OUTPUT == "stack":
+                        # only once the images are saved, so a discarded pair
+                        # leaves no frame behind in the stack
+                        preagc.write(pre_agc, pairNum)
+
+                    # deal with getting hdr settings right
+                    if not saved:
+                        # a pair without all its images is never committed, the
+                        # files of the whole bracket go and it starts over
+                        journal.discard()
+                        gainmode = 0
+                    elif PRE_AGC:
+                        # gain is applied offline, so every frame is a pair
+                        journal.commit(pairNum)
+                        milestone("first pair saved")
+                        pairNum += 1
+                    elif gainmode == 2:
+                        journal.commit(pairNum)
+                        milestone("first pair saved")
+                        gainmode = 0
+                        pairNum += 1
+                    else:
+                        gainmode += 1
 
+                    if not PRE_AGC:
                         renderer.camera.histeq_agc_gain_limit = gains[gainmode] #0.65 is default
 
-                        # Render the image to the window.
-                        if gainmode == 2:
-                            cv2.imshow(window_name, img)
-                            cv2.imshow(other_window, rgbimg)
+                    # Render the image to the window.
+                    if gainmode == 2 or PRE_AGC:
+                        cv2.imshow(window_name, img)
+                        cv2.imshow(other_window, rgbimg)
 
             # Process key events.
             key = cv2.waitKey(1)
@@ -227,6 +333,12 @@ def main():
             if not cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE):
                 break
 
+    if PRE_AGC and PRE_AGC_OUTPUT == "stack":
+        preagc.close()
+    journal.close()
+    rgb_opening.result().release()
+    print("{} frames dropped for a failed RGB read".format(telemetry.counter("drops")))
+
     cv2.destroyWindow(window_name)
     cv2.destroyWindow(other_window)
 
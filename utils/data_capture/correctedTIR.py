@@ -13,107 +13,64 @@
 # The license for the original code is here: https://www.apache.org/licenses/LICENSE-2.0
 #
 
-from time import sleep
-
 import numpy as np
 
 import os
+from functools import partial
 
 from datetime import datetime
 
-import matplotlib.pyplot as plot
+from seekcamera import SeekCameraFrameFormat
+
+from aiocapture import CaptureRuntime
+from startup import milestone
+from telemetry import Telemetry, Timer
+
+# frame counts and write times, summarized every few seconds instead of a line per frame
+telemetry = Telemetry()
 
-from seekcamera import (
-    SeekCameraIOType,
-    SeekCameraManager,
-    SeekCameraManagerEvent,
-    SeekCameraFrameFormat,
-)
 
-filenum = 0
-def on_frame(camera, camera_frame, nothing):
-    """Async callback fired whenever a new frame is available.
+def extract(camera_frame):
+    """Copy of the part of the frame that is saved, taken on the SDK thread.
 
     Parameters
     ----------
-    camera: SeekCamera
-        Reference to the camera for which the new frame is available.
     camera_frame: SeekCameraFrame
         Reference to the class encapsulating the new frame (potentially
-        in multiple formats).
-    file: TextIOWrapper
-        User defined data passed to the callback. This can be anything
-        but in this case it is a reference to the open CSV file to which
-        to log data.
+        in multiple formats). Its buffers are reused after the callback.
     """
+    return camera_frame.corrected.data[0:240, 0:240].copy()
 
-    frame = camera_frame.corrected
-
-    print(
-        "frame available: {cid} (size: {w}x{h})".format(
-            cid=camera.chipid, w=frame.width, h=frame.height
-        )
-    )
-
-    global filenum
-    try:
-        filenum += 1
-        file = open(str(filenum) + ".csv","w")
-        square = frame.data[0:240, 0:240]
-        np.savetxt(file, square, delimiter=',')
-        file.close()
-
-        #plot.figure(frameon=False)
-        #plot.imshow(frame.data, cmap="inferno");
-        #plot.savefig(str(filenum) + '.png');
-    except OSError as e:
-        print("failed to open file")
 
-    return
+def save_csv(path, square):
+    with Timer(telemetry, "write_seconds"):
+        with open(path, "w") as file:
+            np.savetxt(file, square, delimiter=',')
 
 
-
-def on_event(camera, event_type, event_status, _user_data):
-    """Async callback fired whenever a camera event occurs.
+async def handle(folder, runtime, frame):
+    """Saves one frame as <number>.csv off the event loop.
 
     Parameters
     ----------
-    camera: SeekCamera
-        Reference to the camera on which an event occurred.
-    event_type: SeekCameraManagerEvent
-        Enumerated type indicating the type of event that occurred.
-    event_status: Optional[SeekCameraError]
-        Optional exception type. It will be a non-None derived instance of
-        SeekCameraError if the event_type is SeekCameraManagerEvent.ERROR.
-    _user_data: None
-        User defined data passed to the callback. This can be anything
-        but in this case it is None.
+    folder: str
+        Folder the csv files go to.
+    runtime: CaptureRuntime
+        The runtime the frame came from, used to run the write on its executor.
+    frame: Frame
+        Frame number, capture time and the data returned by extract.
     """
-    print("{}: {}".format(str(event_type), camera.chipid))
-
-    if event_type == SeekCameraManagerEvent.CONNECT:
-        # Start streaming data and provide a custom callback to be called
-        # every time a new frame is received.
-        camera.register_frame_available_callback(on_frame)
-        camera.capture_session_start(SeekCameraFrameFormat.CORRECTED)
-
-        # Set up folder to save new capture data in
-        now = datetime.now()
-        date_time = now.strftime("%Y%m%d%H%M")
-        dirname = "correctedTIR" + date_time
-        filepath = os.path.join(os.getcwd(),dirname)
-        os.mkdir(filepath)
-        print("saving images to: " + filepath)
-        os.chdir(filepath)
-
-    elif event_type == SeekCameraManagerEvent.DISCONNECT:
-        camera.capture_session_stop()
-
-    elif event_type == SeekCameraManagerEvent.ERROR:
-        print("{}: {}".format(str(event_status), camera.chipid))
+    try:
+        await runtime.io(save_csv, os.path.join(folder, str(frame.number) + ".csv"), frame.data)
+        telemetry.inc("pairs_written")
+        milestone("first frame saved", telemetry)
 
-    elif event_type == SeekCameraManagerEvent.READY_TO_PAIR:
-        return
+        #plot.figure(frameon=False)
+        #plot.imshow(frame.data, cmap="inferno");
+        #plot.savefig(str(frame.number) + '.png');
+    except OSError as e:
+        telemetry.inc("write_errors", stream="csv")
+        print("failed to write {}.csv: {}".format(frame.number, e))
 
 
 def main():
@@ -123,16 +80,23 @@ def main():
     os.environ["SEEKTHERMAL_LIB_DIR"] = cwd
     print("dll should be in: " + os.environ["SEEKTHERMAL_LIB_DIR"])
 
-    # Create a context structure responsible for managing all connected USB cameras.
-    # Cameras with other IO types can be managed by using a bitwise or of the
-    # SeekCameraIOType enum cases.
-    with SeekCameraManager(SeekCameraIOType.USB) as manager:
-        # Start listening for events.
-        manager.register_event_callback(on_event)
+    # Set up folder to save new capture data in
+    now = datetime.now()
+    date_time = now.strftime("%Y%m%d%H%M")
+    dirname = "correctedTIR" + date_time
+    filepath = os.path.join(os.getcwd(),dirname)
+    os.mkdir(filepath)
+    print("saving images to: " + filepath)
 
-        while True:
-            sleep(1.0)
+    # Frames are copied out of the SDK callback and written by the asyncio
+    # runtime, so slow writes never hold up frame delivery (see aiocapture.py).
+    # Ctrl+C or SIGTERM stops the capture after the queued frames are saved.
+    runtime = CaptureRuntime(SeekCameraFrameFormat.CORRECTED, extract, partial(handle, filepath),
+                             telemetry=telemetry)
+    telemetry.report(os.path.join(filepath, "telemetry.jsonl"), 5.0, filepath)
+    runtime.run()
+    telemetry.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,154 @@
+# Disk aware image output for the capture loops
+#
+# A long session can fill the disk halfway through a drive, and cv2.imwrite
+# just returns False from then on. DiskOutput writes the images instead and:
+#   - tracks the bytes written and the free space of the volume in use
+#   - rolls over to the next volume (another drive or folder) when free space
+#     falls below min_free, recreating the same folder names there
+#   - keeps an optional write budget in bytes per second; when the loop writes
+#     faster than that, or the last volume is nearly full, optional images
+#     (the full size BMPs) are dropped first and the training pairs kept
+#   - counts every failed or dropped write in telemetry (see telemetry.py)
+#
+# Images are encoded with cv2.imencode and written with plain file writes, so a
+# full disk raises a real OSError instead of failing silently.
+
+import os
+import shutil
+import time
+
+import cv2
+
+from telemetry import Telemetry
+import tracing
+
+MIN_FREE = 2 * 1024 ** 3  # roll over below 2 GB free
+RESERVE = 256 * 1024 ** 2  # on the last volume stop writing below 256 MB free
+
+
+class DiskOutput:
+    """Writes images into named folders on the first volume with enough free space.
+
+    Parameters
+    ----------
+    volumes: List[str]
+        Folders to write into, in order. The next one is used once the current
+        one's volume has less than min_free bytes left.
+    min_free: int
+        Free bytes below which to roll over to the next volume.
+    reserve: int
+        Free bytes below which the last volume takes no more writes at all.
+    budget: Optional[float]
+        Bytes per second that can be written before optional images are dropped.
+    telemetry: Optional[Telemetry]
+        Where to count bytes, drops, errors and rollovers.
+    check_every: float
+        Seconds between free space checks; in between it is estimated from the
+        bytes written.
+    journal: Optional[Journal]
+        Session journal (see journal.py) each written file is added to.
+    """
+
+    def __init__(self, volumes, min_free=MIN_FREE, reserve=RESERVE, budget=None, telemetry=None,
+                 check_every=1.0, journal=None):
+        self.volumes = list(volumes)
+        self.volume = 0
+        self.min_free = min_free
+        self.reserve = reserve
+        self.budget = budget
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.check_every = check_every
+        self.journal = journal
+        self.folders = {}
+        self.bytes_written = 0
+        self.tokens = budget if budget is not None else 0.0
+        self.last_refill = time.monotonic()
+        self.last_check = 0.0
+        self.free = None
+        self.check(force=True)
+
+    @property
+    def root(self):
+        return self.volumes[self.volume]
+
+    def folder(self, name):
+        """Path of folder ``name`` on the current volume, created if needed."""
+        path = self.folders.get(name)
+        if path is None:
+            path = os.path.join(self.root, name)
+            os.makedirs(path, exist_ok=True)
+            self.folders[name] = path
+        return path
+
+    def check(self, force=False):
+        """Refresh the free space of the current volume and roll over if it's low."""
+        now = time.monotonic()
+        if not force and now - self.last_check < self.check_every:
+            return
+        self.last_check = now
+        self.free = shutil.disk_usage(self.root).free
+        self.telemetry.set("volume_free_bytes", self.free, volume=self.volume)
+
+        while self.free < self.min_free and self.volume + 1 < len(self.volumes):
+            self.volume += 1
+            self.folders = {}
+            self.free = shutil.disk_usage(self.root).free
+            self.telemetry.inc("rollovers")
+            self.telemetry.set("volume", self.volume)
+            print("low on disk space, continuing on " + self.root)
+
+    def over_budget(self, size):
+        """Take ``size`` bytes from the write budget; True when it's used up."""
+        if self.budget is None:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.budget, self.tokens + (now - self.last_refill) * self.budget)
+        self.last_refill = now
+        return self.tokens < size
+
+    def write(self, name, filename, img, optional=False, params=()):
+        """Save ``img`` as ``filename`` in folder ``name``; returns whether it was written.
+
+        Optional images are the first to go when over budget or low on space.
+        """
+        self.check()
+        last = self.volume + 1 == len(self.volumes)
+        if last and self.free < self.reserve:
+            self.telemetry.inc("drops", reason="disk_full", stream=name)
+            return False
+
+        with tracing.span("encode", stream=name):
+            ok, buffer = cv2.imencode(os.path.splitext(filename)[1], img, list(params))
+        if not ok:
+            self.telemetry.inc("write_errors", stream=name)
+            return False
+
+        size = buffer.nbytes
+        pressure = self.over_budget(size) or (last and self.free < self.min_free)
+        if optional and pressure:
+            self.telemetry.inc("drops", reason="budget", stream=name)
+            return False
+
+        path = os.path.join(self.folder(name), filename)
+        began = tracing.begin()
+        try:
+            # written under a temporary name first so a file is never seen half written
+            with open(path + ".tmp", "wb") as file:
+                file.write(buffer)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            tracing.end("write", began, stream=name, failed=True)
+            self.telemetry.inc("write_errors", stream=name)
+            print("failed to write {}: {}".format(filename, e))
+            # the disk may have filled before the next check, look again now
+            self.check(force=True)
+            return False
+
+        tracing.end("write", began, stream=name, bytes=size)
+        self.tokens -= size
+        self.free -= size
+        self.bytes_written += size
+        self.telemetry.inc("bytes_written", size)
+        if self.journal is not None:
+            self.journal.add(path)
+        return True
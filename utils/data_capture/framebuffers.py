@@ -0,0 +1,52 @@
+# Reused output arrays for the per frame image operations
+#
+# Every cv2.flip/rotate/resize in a capture loop allocates a new output array,
+# tens of thousands of times a session, which keeps the allocator and the
+# garbage collector busy and lets the process size creep. FrameBuffers passes
+# each call a dst array allocated the first time a name is used (and again
+# only if the shape changes), so after the first frame the loop allocates
+# nothing for them. soak.py shows the difference:
+#   python soak.py combined --set REUSE_BUFFERS=false
+#
+# What the methods return is overwritten by the next call with the same name,
+# so copy it to keep it past the current frame.
+
+import cv2
+import numpy as np
+
+
+class FrameBuffers:
+    """cv2 operations writing into arrays kept by name; with reuse off they allocate as usual."""
+
+    def __init__(self, reuse=True):
+        self.reuse = reuse
+        self.arrays = {}
+
+    def get(self, name, shape, dtype):
+        """The array kept as ``name``, (re)allocated if it doesn't match; None with reuse off."""
+        if not self.reuse:
+            return None
+        array = self.arrays.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = self.arrays[name] = np.empty(shape, dtype)
+        return array
+
+    def copy(self, name, img):
+        """A copy of ``img`` that stays put when the source buffer is reused."""
+        dst = self.get(name, img.shape, img.dtype)
+        if dst is None:
+            return img.copy()
+        np.copyto(dst, img)
+        return dst
+
+    def resize(self, name, img, size):
+        """``cv2.resize(img, size, interpolation=INTER_AREA)``."""
+        dst = self.get(name, (size[1], size[0]) + img.shape[2:], img.dtype)
+        return cv2.resize(img, size, dst=dst, interpolation = cv2.INTER_AREA)
+
+    def flip(self, name, img, code):
+        return cv2.flip(img, code, dst=self.get(name, img.shape, img.dtype))
+
+    def rotate(self, name, img, code):
+        shape = img.shape if code == cv2.ROTATE_180 else (img.shape[1], img.shape[0]) + img.shape[2:]
+        return cv2.rotate(img, code, dst=self.get(name, shape, img.dtype))
@@ -0,0 +1,121 @@
+# Raw frame stacks for radiometric and other non image camera data
+#
+# A frame stack is one binary file of fixed size frames written back to back
+# (<name>.raw), a small json header with dtype and frame shape (<name>.json)
+# and an index csv with the pair number and capture time of every frame
+# (<name>.idx.csv). Writing is a plain append of the frame buffer, and reading
+# memory maps the whole stack as one (frames, height, width[, channels]) array,
+# so batch tools can work through it without parsing text.
+#
+# The frame count comes from the file size, so a stack cut short by a crash is
+# still readable up to the last complete frame.
+
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+EXTENSION = ".raw"
+
+
+def stack_paths(path):
+    """(data, header, index) paths of the stack named ``path``."""
+    base = path[: -len(EXTENSION)] if path.endswith(EXTENSION) else path
+    return base + EXTENSION, base + ".json", base + ".idx.csv"
+
+
+class FrameStackWriter:
+    """Appends frames of one dtype and shape to a frame stack."""
+
+    def __init__(self, path, flush_every=100):
+        self.data_path, self.header_path, self.index_path = stack_paths(path)
+        self.flush_every = flush_every
+        self.file = open(self.data_path, "wb")
+        self.index_file = open(self.index_path, "w", newline="")
+        self.index = csv.writer(self.index_file)
+        self.index.writerow(["frame", "pair", "timestamp"])
+        self.dtype = None
+        self.shape = None
+        self.count = 0
+
+    def write(self, data, pair=None, timestamp=None):
+        """Append one frame.
+
+        Parameters
+        ----------
+        data: np.ndarray
+            Frame data. Contiguous arrays (such as SeekFrame.data) are written
+            straight from their buffer without a copy.
+        pair: Optional[int]
+            Pair number to record for this frame, the frame index if None.
+        timestamp: Optional[float]
+            Capture time in seconds since the epoch, now if None.
+        """
+        if self.dtype is None:
+            self.dtype = data.dtype
+            self.shape = data.shape
+            with open(self.header_path, "w") as file:
+                json.dump({"dtype": self.dtype.str, "shape": list(self.shape)}, file)
+        elif data.shape != self.shape or data.dtype != self.dtype:
+            raise ValueError("frame %s %s does not match stack %s %s" % (data.shape, data.dtype, self.shape, self.dtype))
+
+        self.file.write(memoryview(np.ascontiguousarray(data)).cast("B"))
+        self.index.writerow([
+            self.count,
+            self.count if pair is None else pair,
+            "%.6f" % (time.time() if timestamp is None else timestamp),
+        ])
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+            self.index_file.flush()
+        return True
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameStackReader:
+    """Memory mapped view of a frame stack.
+
+    ``frames`` is a read only (count, *shape) array backed by the file, and
+    ``pairs``/``timestamps`` come from the index.
+    """
+
+    def __init__(self, path):
+        self.data_path, self.header_path, self.index_path = stack_paths(path)
+        with open(self.header_path) as file:
+            header = json.load(file)
+        self.dtype = np.dtype(header["dtype"])
+        self.shape = tuple(header["shape"])
+
+        frame_bytes = self.dtype.itemsize * int(np.prod(self.shape))
+        self.count = os.path.getsize(self.data_path) // frame_bytes
+        if self.count:
+            self.frames = np.memmap(self.data_path, dtype=self.dtype, mode="r",
+                                    shape=(self.count,) + self.shape)
+        else:
+            self.frames = np.empty((0,) + self.shape, dtype=self.dtype)
+
+        self.pairs = np.arange(self.count)
+        self.timestamps = np.zeros(self.count)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, newline="") as file:
+                rows = list(csv.DictReader(file))[: self.count]
+            self.pairs[: len(rows)] = [int(row["pair"]) for row in rows]
+            self.timestamps[: len(rows)] = [float(row["timestamp"]) for row in rows]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, frame):
+        return self.frames[frame]
@@ -0,0 +1,226 @@
+# Crash safe session journal for the capture scripts
+#
+# Every file of a pair is written to <name>.tmp and renamed into place, so no
+# file is ever seen half written. Once all files of a pair are in place the
+# pair is committed. Commits are grouped: every fsync_every pairs the files of
+# the waiting pairs are fsynced, then one line per pair is appended to the
+# journal (a JSON lines file) and the journal is fsynced. A pair is complete if
+# and only if it is in the journal, and fsync costs nothing on most frames.
+#
+# On restart the capture scripts reopen the latest journal, delete the files of
+# pairs that never made it into it (and stray .tmp files), and carry on
+# numbering after the last complete pair. A crash loses at most the last
+# fsync_every pairs and never leaves truncated images behind. A session that
+# was ended normally (q or closing the window) has a closing line in its
+# journal and is never resumed, the next capture starts a new session. The
+# capture scripts resume with RESUME and commit FSYNC_EVERY pairs at a time;
+# combined.py journals in its "images" output mode only.
+
+import glob
+import json
+import os
+import re
+
+import cv2
+
+# files that belong to a pair start with its number, e.g. 12.jpg or 12_0.png
+PAIR_FILE = re.compile(r"^\d+[._]")
+
+
+def latest(pattern):
+    """Most recently modified journal matching a glob pattern, or None if there
+    is none or that session was closed."""
+    paths = glob.glob(pattern)
+    if not paths:
+        return None
+    path = max(paths, key=os.path.getmtime)
+    return None if is_closed(path) else path
+
+
+def is_closed(path):
+    """Whether the journal's last line is the closing record."""
+    with open(path, "rb") as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(file.tell() - 256, 0))
+        lines = file.read().splitlines()
+    try:
+        return bool(lines) and "closed" in json.loads(lines[-1])
+    except ValueError:
+        return False
+
+
+def fsync_path(path, directory=False):
+    """fsync a file, or a directory where the OS allows it (not on Windows)."""
+    if directory and os.name == "nt":
+        return
+    # Windows only fsyncs handles open for writing
+    fd = os.open(path, os.O_RDONLY if directory else os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """Journal of the complete pairs of one capture session.
+
+    Parameters
+    ----------
+    path: str
+        The journal file. An existing journal is loaded and continued.
+    root: Optional[str]
+        Folder file paths are recorded relative to, so the session can be
+        moved. The journal's folder if None.
+    fsync_every: int
+        Number of pairs committed together.
+    header: Optional[dict]
+        Written as the first line of a new journal, e.g. the session's date.
+
+    ``on_sync`` (None or a function without arguments) is called each time
+    pairs are made durable, to save anything that has to agree with the
+    journal, such as the session statistics.
+    """
+
+    def __init__(self, path, root=None, fsync_every=30, header=None):
+        self.path = path
+        self.root = root if root is not None else os.path.dirname(os.path.abspath(path))
+        self.fsync_every = fsync_every
+        self.header = dict(header or {})
+        # pairs committed before this run, to clean up after a crash; pairs
+        # committed from now on only move last_pair, so a long session
+        # doesn't hold a record of every pair in memory
+        self.committed = {}
+        self.last_pair = 0
+        self.pending = {}
+        self.batch = []
+        self.on_sync = None
+
+        resumed = os.path.exists(path)
+        if resumed:
+            self.load()
+        self.file = open(path, "a")
+        if not resumed:
+            self.file.write(json.dumps({"header": self.header}) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.resumed = resumed
+
+    def load(self):
+        with open(self.path, "rb+") as file:
+            data = file.read()
+            # drop a line cut short by a crash, so the next record starts on a
+            # line of its own
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                file.truncate(end)
+                file.flush()
+                os.fsync(file.fileno())
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a garbled line, e.g. a journal appended to after a crash
+                # without trimming it; the lines after it still count
+                continue
+            if "header" in record:
+                self.header = record["header"]
+            elif "pair" in record:
+                self.committed[record["pair"]] = record["files"]
+                self.last_pair = max(self.last_pair, record["pair"])
+
+    @property
+    def next_pair(self):
+        """First pair number after the last complete pair."""
+        return self.last_pair + 1
+
+    def relative(self, path):
+        try:
+            relative = os.path.relpath(path, self.root)
+        except ValueError:  # another drive on Windows
+            return os.path.abspath(path)
+        return os.path.abspath(path) if relative.startswith("..") else relative
+
+    def discard_incomplete(self, folders):
+        """Delete pair files in ``folders`` that no committed pair owns; returns how many."""
+        complete = {os.path.normcase(path) for files in self.committed.values() for path in files}
+        removed = 0
+        for folder in folders:
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                if name.endswith(".tmp") or (
+                        PAIR_FILE.match(name) and os.path.normcase(self.relative(path)) not in complete):
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    def write(self, path, data):
+        """Write bytes to ``path`` atomically as part of the current pair."""
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as file:
+                file.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.add(path)
+
+    def write_image(self, path, img, params=()):
+        """Encode and write an image atomically as part of the current pair."""
+        ok, buffer = cv2.imencode(os.path.splitext(path)[1], img, list(params))
+        if not ok:
+            return False
+        self.write(path, buffer)
+        return True
+
+    def add(self, path):
+        """Count a file written (atomically) elsewhere as part of the current pair."""
+        self.pending[path] = None
+
+    def commit(self, pair):
+        """Mark the files written since the last commit as pair ``pair``."""
+        self.batch.append((pair, list(self.pending)))
+        self.pending = {}
+        if len(self.batch) >= self.fsync_every:
+            self.sync()
+
+    def discard(self):
+        """Delete the files written since the last commit, a pair that couldn't
+        be completed."""
+        for path in self.pending:
+            if os.path.exists(path):
+                os.remove(path)
+        self.pending = {}
+
+    def sync(self):
+        """Make the waiting pairs durable and append them to the journal."""
+        if not self.batch:
+            return
+        folders = set()
+        for _, files in self.batch:
+            for path in files:
+                fsync_path(path)
+                folders.add(os.path.dirname(path))
+        for folder in folders:
+            fsync_path(folder, directory=True)
+
+        for pair, files in self.batch:
+            relative = [self.relative(path) for path in files]
+            self.file.write(json.dumps({"pair": pair, "files": relative}) + "\n")
+            self.last_pair = max(self.last_pair, pair)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.batch = []
+        if self.on_sync is not None:
+            self.on_sync()
+
+    def close(self):
+        """Sync the waiting pairs and mark the session as ended, so it isn't resumed."""
+        self.sync()
+        self.file.write(json.dumps({"closed": True}) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
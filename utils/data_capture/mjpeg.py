@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# MJPEG passthrough capture for the RGB webcam
+#
+# Normally cv2.VideoCapture decodes every webcam frame to BGR, and the capture
+# scripts then rotate, crop, resize and encode it again, which costs most of the
+# CPU on the capture laptop. In raw mode the webcam is asked for MJPEG and the
+# compressed frames are stored exactly as the camera sent them, appended to one
+# .mjpeg file with an index csv (frame, pair, offset, length, timestamp). The
+# rotate/crop/resize happens afterwards, on every core, with:
+#   python mjpeg.py process RGB202408181354.mjpeg outdir --transform combined
+#
+# Passthrough needs a backend that can hand over undecoded frames (DirectShow on
+# Windows, V4L2 on Linux). If the backend decodes anyway, frames are re-encoded
+# as high quality JPEG and a warning is printed.
+
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+EXTENSION = ".mjpeg"
+FALLBACK_QUALITY = 95
+
+
+def index_path(stream_path):
+    """Path of the index csv belonging to an .mjpeg stream."""
+    return os.path.splitext(stream_path)[0] + ".idx.csv"
+
+
+def is_jpeg(buf):
+    """True if ``buf`` is an undecoded JPEG frame rather than a BGR image."""
+    return buf is not None and buf.ndim <= 2 and min(buf.shape) == 1 and \
+        buf.size > 2 and buf.flat[0] == 0xFF and buf.flat[1] == 0xD8
+
+
+def open_raw_capture(index, width=640, height=480, fps=30):
+    """Open a webcam asking for MJPEG frames that are not decoded by OpenCV.
+
+    Parameters
+    ----------
+    index: int
+        Camera index, as passed to cv2.VideoCapture.
+    width, height, fps: int
+        Requested MJPEG mode.
+
+    Returns the capture and whether undecoded frames are actually delivered.
+    """
+    backend = cv2.CAP_DSHOW if os.name == "nt" else cv2.CAP_V4L2
+    camera = cv2.VideoCapture(index, backend)
+    if not camera.isOpened():
+        camera = cv2.VideoCapture(index)
+
+    camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    camera.set(cv2.CAP_PROP_FPS, fps)
+    camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    if backend == cv2.CAP_V4L2:
+        camera.set(cv2.CAP_PROP_FORMAT, -1)
+
+    result, buf = camera.read()
+    passthrough = bool(result) and is_jpeg(buf)
+    if not passthrough:
+        print("webcam backend does not pass MJPEG through, frames will be re-encoded")
+    return camera, passthrough
+
+
+class MjpegWriter:
+    """Appends compressed frames to one .mjpeg file plus an index csv.
+
+    With ``append`` an existing stream is continued, e.g. when a capture
+    session is resumed after a crash: frames after the last complete index row,
+    and those of pairs from ``resume_at`` on (the incomplete pairs of the
+    session), are cut off and numbering carries on. Should a pair still be
+    written twice, MjpegReader takes the later frame.
+    """
+
+    def __init__(self, path, flush_every=100, append=False, resume_at=None):
+        if not path.endswith(EXTENSION):
+            path += EXTENSION
+        self.path = path
+        self.flush_every = flush_every
+        self.count = 0
+        self.offset = 0
+        if append and os.path.exists(path) and os.path.exists(index_path(path)):
+            self.resume(resume_at)
+            self.file = open(path, "ab")
+            self.index_file = open(index_path(path), "a", newline="")
+            self.index = csv.writer(self.index_file)
+        else:
+            self.file = open(path, "wb")
+            self.index_file = open(index_path(path), "w", newline="")
+            self.index = csv.writer(self.index_file)
+            self.index.writerow(["frame", "pair", "offset", "length", "timestamp"])
+
+    def resume(self, resume_at=None):
+        """Trim the stream and its index to the frames both hold completely,
+        and to pairs before ``resume_at``."""
+        size = os.path.getsize(self.path)
+        with open(index_path(self.path), newline="") as file:
+            lines = file.read().split("\n")
+        kept = lines[:1]
+        # the last line may be cut short, and the index may be ahead of the data
+        for line in lines[1:-1]:
+            try:
+                frame, pair, offset, length, _ = line.rstrip("\r").split(",")
+                frame, pair, offset, length = int(frame), int(pair), int(offset), int(length)
+            except ValueError:
+                break
+            if frame != self.count or offset != self.offset or offset + length > size:
+                break
+            if resume_at is not None and pair >= resume_at:
+                break
+            kept.append(line)
+            self.count += 1
+            self.offset = offset + length
+
+        with open(self.path, "r+b") as file:
+            file.truncate(self.offset)
+        with open(index_path(self.path) + ".tmp", "w", newline="") as file:
+            file.write("\n".join(kept) + "\n")
+        os.replace(index_path(self.path) + ".tmp", index_path(self.path))
+
+    def write(self, buf, pair=None, timestamp=None):
+        """Store one frame.
+
+        Parameters
+        ----------
+        buf: np.ndarray
+            Raw JPEG bytes from a passthrough capture, or a decoded BGR image
+            which is then encoded as JPEG.
+        pair: Optional[int]
+            Pair number to record for this frame, the frame index if None.
+        timestamp: Optional[float]
+            Capture time in seconds since the epoch, now if None.
+        """
+        if not is_jpeg(buf):
+            ok, buf = cv2.imencode(".jpg", buf, [cv2.IMWRITE_JPEG_QUALITY, FALLBACK_QUALITY])
+            if not ok:
+                return False
+        data = buf.tobytes()
+        self.file.write(data)
+        self.index.writerow([
+            self.count,
+            self.count if pair is None else pair,
+            self.offset,
+            len(data),
+            "%.6f" % (time.time() if timestamp is None else timestamp),
+        ])
+        self.offset += len(data)
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+            self.index_file.flush()
+        return True
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MjpegReader:
+    """Random access to the frames of an .mjpeg stream."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(index_path(path), newline="") as file:
+            rows = list(csv.DictReader(file))
+        self.pairs = [int(row["pair"]) for row in rows]
+        self.offsets = [int(row["offset"]) for row in rows]
+        self.lengths = [int(row["length"]) for row in rows]
+        self.timestamps = [float(row["timestamp"]) for row in rows]
+        self.frame_of_pair = {pair: frame for frame, pair in enumerate(self.pairs)}
+        self.file = open(path, "rb")
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def read_bytes(self, frame):
+        """Compressed bytes of frame number ``frame``."""
+        self.file.seek(self.offsets[frame])
+        return self.file.read(self.lengths[frame])
+
+    def read(self, frame):
+        """Decoded BGR image of frame number ``frame``."""
+        return cv2.imdecode(np.frombuffer(self.read_bytes(frame), np.uint8), cv2.IMREAD_COLOR)
+
+    def read_pair(self, pair):
+        return self.read(self.frame_of_pair[pair])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# The processing each capture script used to do live, returning the images to
+# save keyed by output folder.
+def transform_webcam(img):
+    return {"RGB": img[0:480, 0:480]}
+
+
+def transform_combined(img):
+    rgbimg = cv2.flip(img, 1)#flip horizontally
+    rgbimg = cv2.rotate(rgbimg, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    pureRGB = rgbimg[140:500, 0:480]#480x640->480x360
+    pureRGBr = cv2.resize(pureRGB, (320, 240), interpolation = cv2.INTER_AREA)
+    rgbimg = rgbimg[64:576, 0:512]
+    resizedr = cv2.resize(rgbimg, (256, 256), interpolation = cv2.INTER_AREA)
+    return {"RGB": resizedr, "RGBfull": pureRGBr}
+
+
+def transform_combined_hdr(img):
+    rgbimg = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    pureRGB = rgbimg[50:410, 120:600]#480x640->480x360
+    pureRGBr = cv2.resize(pureRGB, (320, 240), interpolation = cv2.INTER_AREA)
+    rgbimg = rgbimg[54:566, 0:512]
+    resizedr = cv2.resize(rgbimg, (256, 256), interpolation = cv2.INTER_AREA)
+    return {"RGB": resizedr, "RGBfull": pureRGBr}
+
+
+def transform_thermography(img):
+    rgbimg = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    rgbimg = rgbimg[64:576, 0:512]
+    return {"RGB": cv2.resize(rgbimg, (240, 240), interpolation = cv2.INTER_AREA)}
+
+
+TRANSFORMS = {
+    "webcam": transform_webcam,
+    "combined": transform_combined,
+    "combinedHDR": transform_combined_hdr,
+    "thermography": transform_thermography,
+}
+
+
+def process_range(path, outdir, transform, extension, start, stop):
+    """Decode, transform and save frames start..stop-1 of one stream."""
+    count = 0
+    with MjpegReader(path) as reader:
+        for frame in range(start, stop):
+            if reader.frame_of_pair[reader.pairs[frame]] != frame:
+                continue  # written again later in the stream
+            img = reader.read(frame)
+            if img is None:
+                print("could not decode frame %d" % frame)
+                continue
+            for folder, out in TRANSFORMS[transform](img).items():
+                cv2.imwrite(os.path.join(outdir, folder, str(reader.pairs[frame]) + extension), out)
+            count += 1
+    return count
+
+
+def process(path, outdir, transform, extension=".png", workers=None, chunk=256):
+    """Run the deferred processing of a whole stream on a process pool."""
+    with MjpegReader(path) as reader:
+        total = len(reader)
+    for folder in TRANSFORMS[transform](np.zeros((480, 640, 3), np.uint8)):
+        os.makedirs(os.path.join(outdir, folder), exist_ok=True)
+
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(process_range, path, outdir, transform, extension, start, min(start + chunk, total))
+                for start in range(0, total, chunk)]
+        return sum(job.result() for job in jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline processing of raw MJPEG webcam captures.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("process", help="decode, rotate, crop and resize every frame")
+    run.add_argument("stream", help=".mjpeg file written in raw capture mode")
+    run.add_argument("outdir")
+    run.add_argument("--transform", default="combined", choices=sorted(TRANSFORMS))
+    run.add_argument("--ext", default=".png", help="image type to save, e.g. .png or .jpg")
+    run.add_argument("--workers", type=int, default=None)
+    extract = commands.add_parser("extract", help="copy the original jpeg of every frame out unchanged")
+    extract.add_argument("stream")
+    extract.add_argument("outdir")
+    args = parser.parse_args()
+
+    if args.command == "process":
+        count = process(args.stream, args.outdir, args.transform, args.ext, args.workers)
+        print("processed %d frames" % count)
+    else:
+        os.makedirs(args.outdir, exist_ok=True)
+        with MjpegReader(args.stream) as reader:
+            for frame in sorted(reader.frame_of_pair.values()):
+                with open(os.path.join(args.outdir, str(reader.pairs[frame]) + ".jpg"), "wb") as file:
+                    file.write(reader.read_bytes(frame))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,17 @@ from seekcamera import (
     SeekFrame,
 )
 
+from graytir import GrayFrames
+from startup import milestone
+from videostore import VideoStreamWriter
+
+# "images" saves one png per frame, "video" encodes the whole session into one
+# lossless video with a frame index next to it (see videostore.py)
+OUTPUT_MODE = "images"
+
+# one 8 bit channel for WHITE_HOT TIR frames instead of BGRA (see graytir.py)
+GRAY_TIR = True
+
 
 class Renderer:
     """Contains camera and image data required to render images to the screen."""
@@ -38,6 +49,7 @@ class Renderer:
         self.camera = SeekCamera()
         self.frame_condition = Condition()
         self.first_frame = True
+        self.gray = GRAY_TIR
 
 
 def on_frame(_camera, camera_frame, renderer):
@@ -82,6 +94,7 @@ def on_event(camera, event_type, event_status, renderer):
     print("{}: {}".format(str(event_type), camera.chipid))
 
     if event_type == SeekCameraManagerEvent.CONNECT:
+        milestone("thermal camera connected")
         if renderer.busy:
             return
 
@@ -97,6 +110,10 @@ def on_event(camera, event_type, event_status, renderer):
         # Set a custom color palette.
         # Other options can set in a similar fashion.
         camera.color_palette = SeekCameraColorPalette.WHITE_HOT #change to TYRIAN for pretty pink
+        # GRAY_TIR only holds for WHITE_HOT, whose three color channels are equal
+        renderer.gray = GRAY_TIR and camera.color_palette == SeekCameraColorPalette.WHITE_HOT
+        if GRAY_TIR and not renderer.gray:
+            print("GRAY_TIR needs the WHITE_HOT palette, keeping color frames")
 
         # Start imaging and provide a custom callback to be called
         # every time a new frame is received.
@@ -138,10 +155,15 @@ def main():
 
     count = 1;
 
+    if OUTPUT_MODE == "video":
+        video = VideoStreamWriter(os.path.join(filepath, "TIR" + date_time))
+
     # Set up display
     window_name = "Thermal Capture"
     cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
 
+    gray = GrayFrames()
+
     # Create a context structure responsible for managing all connected USB cameras.
     # Cameras with other IO types can be managed by using a bitwise or of the
     # SeekCameraIOType enum cases.
@@ -157,20 +179,26 @@ def main():
             with renderer.frame_condition:
                 if renderer.frame_condition.wait(150.0 / 1000.0):
                     img = renderer.frame.data
+                    if renderer.gray:
+                        img = gray.convert(img)
 
                     img = img[0:240, 0:240]
 
                     # Resize the rendering window.
                     if renderer.first_frame:
-                        (height, width, _) = img.shape
+                        (height, width) = img.shape[:2]
                         cv2.resizeWindow(window_name, width * 2, height * 2)
                         renderer.first_frame = False
 
                     # Render the image to the window.
                     cv2.imshow(window_name, img)
                 
-                    name = str(count) + ".png"#note--change filetype to option
-                    cv2.imwrite(name, img)
+                    if OUTPUT_MODE == "video":
+                        video.write(img, count)
+                    else:
+                        name = str(count) + ".png"#note--change filetype to option
+                        cv2.imwrite(name, img)
+                    milestone("first frame saved")
                     count+=1
 
             # Process key events.
@@ -182,6 +210,8 @@ def main():
             if not cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE):
                 break
 
+    if OUTPUT_MODE == "video":
+        video.close()
 
     cv2.destroyWindow(window_name)
 
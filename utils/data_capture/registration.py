@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Automatic TIR to RGB registration for capture sessions
+#
+# The capture scripts align the two cameras with hand picked crops (20:260 on
+# the TIR frame, 64:576 on the rotated RGB frame, ...) that differ per rig. This
+# module instead estimates a homography from the TIR frame to the RGB output
+# crop from a short calibration segment at the start of a session, caches it in
+# the session folder as registration.json and applies it to every frame with
+# precomputed cv2.remap tables. The remap goes straight from the full TIR frame
+# to the final output size, so it replaces the crop and the resize.
+#
+# The two cameras see different things, so the estimate uses ECC on gradient
+# magnitude images (edges line up across modalities even when intensities
+# don't), starting from the hand picked crop, and takes the median over all
+# calibration frames. Point the rig at a scene with strong edges (buildings,
+# poles, a heated checkerboard) while calibrating.
+#
+# To estimate a registration offline from saved full frame pairs:
+#   python registration.py <full TIR folder> <RGB 256 crop folder> <session folder> --frames 30
+
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+
+FILENAME = "registration.json"
+
+
+def initial_homography(crop, out_size):
+    """Homography mapping output pixels to TIR pixels for a hand picked crop.
+
+    Parameters
+    ----------
+    crop: Tuple[int, int, int, int]
+        (top, bottom, left, right) of the TIR crop, e.g. (0, 240, 20, 260).
+    out_size: Tuple[int, int]
+        (width, height) of the output image.
+    """
+    top, bottom, left, right = crop
+    width, height = out_size
+    return np.array([
+        [(right - left) / width, 0, left],
+        [0, (bottom - top) / height, top],
+        [0, 0, 1],
+    ], dtype=np.float32)
+
+
+def edges(img):
+    """Normalised gradient magnitude of an image, the common ground for ECC."""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+    img = cv2.GaussianBlur(img.astype(np.float32), (5, 5), 1.5)
+    gx = cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(img, cv2.CV_32F, 0, 1, ksize=3)
+    mag = cv2.magnitude(gx, gy)
+    return (mag - mag.mean()) / (mag.std() + 1e-6)
+
+
+def estimate_pair(tir, rgb, init, levels=3, iterations=100, eps=1e-5):
+    """Refine ``init`` on one TIR frame and its RGB output crop.
+
+    ECC is run coarse to fine over an image pyramid so that rigs whose crop is
+    off by tens of pixels still converge. Returns (homography, ecc correlation),
+    or (None, 0) if ECC didn't converge.
+    """
+    template = edges(rgb)
+    source = edges(tir)
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, eps)
+
+    warp = init.astype(np.float32)
+    cc = 0.0
+    for level in reversed(range(levels)):
+        # a homography between images both shrunk by s is S H S^-1
+        scale = np.diag([0.5 ** level, 0.5 ** level, 1.0]).astype(np.float32)
+        scaled = scale @ warp @ np.linalg.inv(scale)
+        small_template = cv2.resize(template, None, fx=0.5 ** level, fy=0.5 ** level, interpolation=cv2.INTER_AREA)
+        small_source = cv2.resize(source, None, fx=0.5 ** level, fy=0.5 ** level, interpolation=cv2.INTER_AREA)
+        try:
+            cc, scaled = cv2.findTransformECC(small_template, small_source, scaled.astype(np.float32),
+                                              cv2.MOTION_HOMOGRAPHY, criteria, None, 1)
+        except cv2.error:
+            return None, 0.0
+        warp = np.linalg.inv(scale) @ scaled @ scale
+
+    return (warp / warp[2, 2]).astype(np.float32), cc
+
+
+def estimate(tir_frames, rgb_frames, crop, out_size, min_cc=0.2):
+    """Estimate the session homography from calibration pairs.
+
+    Parameters
+    ----------
+    tir_frames: List[np.ndarray]
+        Full TIR frames as delivered by the camera.
+    rgb_frames: List[np.ndarray]
+        RGB output crops taken at the same time, already at ``out_size``.
+    crop: Tuple[int, int, int, int]
+        Hand picked TIR crop used as the starting point.
+    out_size: Tuple[int, int]
+        (width, height) of the output image.
+    min_cc: float
+        Pairs whose ECC correlation is below this are ignored.
+    """
+    init = initial_homography(crop, out_size)
+    warps = []
+    scores = []
+    for tir, rgb in zip(tir_frames, rgb_frames):
+        warp, cc = estimate_pair(tir, rgb, init)
+        if warp is not None and cc >= min_cc:
+            warps.append(warp)
+            scores.append(cc)
+
+    if not warps:
+        print("registration failed, falling back to the hand picked crop")
+        return Registration(init, out_size, tir_frames[0].shape[:2] if tir_frames else None, 0.0, 0)
+
+    # element wise median is robust to the odd frame ECC got wrong
+    warp = np.median(np.stack(warps), axis=0).astype(np.float32)
+    return Registration(warp, out_size, tir_frames[0].shape[:2], float(np.median(scores)), len(warps))
+
+
+class Registration:
+    """A TIR to RGB homography with its precomputed remap tables."""
+
+    def __init__(self, homography, out_size, source_shape=None, score=0.0, frames=0):
+        self.homography = np.asarray(homography, dtype=np.float32)
+        self.out_size = tuple(out_size)
+        self.source_shape = source_shape
+        self.score = score
+        self.frames = frames
+        self.map1, self.map2 = build_maps(self.homography, self.out_size)
+
+    def fits(self, shape):
+        """Whether it was estimated on frames of this size (any size if unknown)."""
+        return not self.source_shape or tuple(self.source_shape) == tuple(shape[:2])
+
+    def apply(self, tir, dst=None):
+        """Warp a full TIR frame into the RGB output crop."""
+        return cv2.remap(tir, self.map1, self.map2, cv2.INTER_LINEAR, dst=dst,
+                         borderMode=cv2.BORDER_CONSTANT)
+
+    def save(self, session):
+        path = os.path.join(session, FILENAME)
+        with open(path, "w") as file:
+            json.dump({
+                "homography": self.homography.tolist(),
+                "out_size": list(self.out_size),
+                "source_shape": list(self.source_shape) if self.source_shape else None,
+                "score": self.score,
+                "frames": self.frames,
+            }, file, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Load a cached registration from a session folder or json file."""
+        if os.path.isdir(path):
+            path = os.path.join(path, FILENAME)
+        with open(path) as file:
+            data = json.load(file)
+        return cls(data["homography"], data["out_size"], data.get("source_shape"),
+                   data.get("score", 0.0), data.get("frames", 0))
+
+
+def build_maps(homography, out_size):
+    """Fixed point remap tables sending every output pixel to its TIR pixel."""
+    width, height = out_size
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    points = np.stack([xs, ys, np.ones_like(xs)], axis=-1) @ homography.T
+    map_x = points[..., 0] / points[..., 2]
+    map_y = points[..., 1] / points[..., 2]
+    # the fixed point form is noticeably faster in remap than two float maps
+    return cv2.convertMaps(map_x.astype(np.float32), map_y.astype(np.float32), cv2.CV_16SC2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate a TIR to RGB registration from saved frames.")
+    parser.add_argument("tir", help="folder of full TIR frames named <pair>.<ext>, e.g. TIRfull")
+    parser.add_argument("rgb", help="folder of RGB output crops named <pair>.<ext>, e.g. RGB")
+    parser.add_argument("session", help="folder to write registration.json to")
+    parser.add_argument("--frames", type=int, default=30, help="number of pairs to use")
+    parser.add_argument("--crop", type=int, nargs=4, default=[0, 240, 20, 260],
+                        help="hand picked TIR crop top bottom left right to start from")
+    args = parser.parse_args()
+
+    # the folders use different image types, so pair files up by pair number
+    rgb_names = {os.path.splitext(name)[0]: name for name in os.listdir(args.rgb)}
+    names = [name for name in os.listdir(args.tir) if os.path.splitext(name)[0] in rgb_names]
+    names.sort(key=lambda name: (len(name), name))
+    tir_frames = []
+    rgb_frames = []
+    step = max(1, len(names) // args.frames)
+    for name in names[::step][: args.frames]:
+        tir_frames.append(cv2.imread(os.path.join(args.tir, name), cv2.IMREAD_UNCHANGED))
+        rgb_frames.append(cv2.imread(os.path.join(args.rgb, rgb_names[os.path.splitext(name)[0]])))
+
+    out_size = rgb_frames[0].shape[1::-1]
+    registration = estimate(tir_frames, rgb_frames, args.crop, out_size)
+    os.makedirs(args.session, exist_ok=True)
+    print("saved %s (ecc %.3f over %d pairs)" % (registration.save(args.session), registration.score, registration.frames))
+
+
+if __name__ == "__main__":
+    main()
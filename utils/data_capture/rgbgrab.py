@@ -0,0 +1,141 @@
+# Webcam grabbing with decoding only for the frames that are kept
+#
+# rgb.read() is grab() (take the next frame from the driver) plus retrieve()
+# (decode it to BGR). The capture scripts only keep the RGB frame that goes
+# with a TIR frame, and reading only then returns whatever old frame the driver
+# has buffered. RgbGrabber calls grab() on a thread all the time, which keeps the
+# driver's buffer drained and costs no decoding, and read() decodes the next
+# grabbed frame only when a pair needs it. That means waiting for the grab in
+# progress, up to one frame period (about 30 ms at 30 fps on average), so don't
+# call read() while holding a lock the camera callbacks need. Counts of grabbed
+# and decoded frames go to telemetry as rgb_frames{stage="grabbed"|"decoded"}.
+#
+# The webcam mode is set from a device profile (resolution, fps, pixel format,
+# driver buffer size), one of PROFILES or a dict of the same keys, which the
+# capture scripts take from their RGB_PROFILE:
+#   grabber = RgbGrabber(open_camera(0, "mjpeg"), telemetry)
+#   ok, img = grabber.read()
+
+import threading
+
+import cv2
+
+PROFILES = {
+    # the rig's webcam mode, rotated and cropped by the capture scripts
+    "default": {"width": 640, "height": 480, "fps": 30, "buffersize": 1},
+    # the same over MJPEG, which many USB webcams need for full rate at 640x480
+    "mjpeg": {"width": 640, "height": 480, "fps": 30, "buffersize": 1, "fourcc": "MJPG"},
+}
+
+BACKENDS = {
+    "any": cv2.CAP_ANY,
+    "dshow": cv2.CAP_DSHOW,
+    "msmf": cv2.CAP_MSMF,
+    "v4l2": cv2.CAP_V4L2,
+}
+
+
+def open_camera(index, profile="default"):
+    """Open a webcam and set the mode of a device profile.
+
+    Parameters
+    ----------
+    index: int
+        Camera index, as passed to cv2.VideoCapture.
+    profile: Union[str, dict]
+        Name in PROFILES or a dict with any of width, height, fps, buffersize,
+        fourcc and backend (a key of BACKENDS).
+
+    Settings the driver doesn't take are printed with what it uses instead.
+    """
+    if isinstance(profile, str):
+        profile = PROFILES[profile]
+    camera = cv2.VideoCapture(index, BACKENDS[profile.get("backend", "any")])
+
+    # the pixel format goes first, it limits the sizes and rates on offer
+    if "fourcc" in profile:
+        camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*profile["fourcc"]))
+    properties = [
+        ("width", cv2.CAP_PROP_FRAME_WIDTH),
+        ("height", cv2.CAP_PROP_FRAME_HEIGHT),
+        ("fps", cv2.CAP_PROP_FPS),
+        ("buffersize", cv2.CAP_PROP_BUFFERSIZE),
+    ]
+    for key, prop in properties:
+        if key in profile:
+            camera.set(prop, profile[key])
+    if camera.isOpened():
+        for key, prop in properties:
+            if key in profile and camera.get(prop) != profile[key]:
+                print("webcam {}: asked for {}, got {}".format(key, profile[key], camera.get(prop)))
+    return camera
+
+
+class RgbGrabber:
+    """Grabs webcam frames continuously on a thread and decodes one when asked.
+
+    read() returns ``(ok, img)`` like cv2.VideoCapture.read(), decoding the
+    frame grabbed after (or while) it was called, so it is never older than
+    one frame period but can take up to one frame period. With ``reuse`` every frame is decoded into the same
+    array, for callers that are done with a frame before they read the next.
+    """
+
+    def __init__(self, capture, telemetry=None, reuse=False):
+        self.capture = capture
+        self.telemetry = telemetry
+        self.reuse = reuse
+        self.image = None
+        self.condition = threading.Condition()
+        self.reading = threading.Lock()
+        self.wanted = False
+        self.grabbed = False
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="rgb-grab", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # grab() blocks until the next frame, with the condition held so that a
+        # read() gets in right after it; otherwise the lock is only let go
+        # while a read() decodes or after a failed grab
+        with self.condition:
+            try:
+                while self.running:
+                    self.grabbed = self.capture.grab()
+                    if self.telemetry is not None and self.grabbed:
+                        self.telemetry.inc("rgb_frames", stage="grabbed")
+                    if self.wanted:
+                        self.condition.notify_all()
+                        self.condition.wait_for(lambda: not self.wanted or not self.running)
+                    elif not self.grabbed:
+                        # unplugged or not delivering, don't spin
+                        self.condition.wait(0.05)
+            finally:
+                # released here, where no grab() or retrieve() can still be running
+                self.running = False
+                self.capture.release()
+
+    def read(self):
+        with self.reading:
+            self.wanted = True
+            with self.condition:
+                if not self.running or not self.grabbed:
+                    self.wanted = False
+                    self.condition.notify_all()
+                    return False, None
+                if self.reuse:
+                    ok, img = self.capture.retrieve(self.image)
+                    self.image = img if ok else None
+                else:
+                    ok, img = self.capture.retrieve()
+                self.wanted = False
+                self.condition.notify_all()
+        if self.telemetry is not None and ok:
+            self.telemetry.inc("rgb_frames", stage="decoded")
+        return ok, img
+
+    def release(self):
+        # the grab thread holds the condition between grabs, so this is seen
+        # after the grab in progress, and the thread releases the capture on
+        # its way out, even if that grab is still blocked after the join
+        self.running = False
+        self.thread.join(timeout=1.0)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Running dataset statistics kept during capture
+#
+# Normalizing TIR/RGB for training needs per channel mean/std and histograms
+# over the whole dataset. Instead of reading every image again afterwards, the
+# capture scripts update these statistics on each saved frame and write them to
+# stats.json in the session folder. Means and variances use Welford's method
+# (merged one whole frame at a time with Chan's formula), histograms have fixed
+# bins, and radiometric streams also keep their minimum and maximum temperature.
+# Statistics of different sessions merge exactly, without rereading any image:
+#   python sessionstats.py merge capture*/stats.json --out night_stats.json
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+FILENAME = "stats.json"
+
+# fixed histogram bins for radiometric data, in C
+TEMPERATURE_RANGE = (-40.0, 160.0)
+TEMPERATURE_BINS = 400
+
+
+class RunningStats:
+    """Per channel count, mean, variance, min, max and histogram of one stream.
+
+    Parameters
+    ----------
+    bins: int
+        Number of histogram bins per channel.
+    value_range: Tuple[float, float]
+        Range the bins cover; values outside it go to the first or last bin.
+    """
+
+    def __init__(self, bins=256, value_range=(0.0, 256.0)):
+        self.bins = bins
+        self.value_range = tuple(value_range)
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.hist = None
+
+    def update(self, frame):
+        """Add every pixel of one HxW or HxWxC frame (alpha is ignored)."""
+        if frame.ndim == 2:
+            frame = frame[..., None]
+        elif frame.shape[2] == 4:
+            frame = frame[..., :3]
+        channels = frame.shape[2]
+        pixels = frame.reshape(-1, channels)
+
+        if self.mean is None:
+            self.mean = np.zeros(channels)
+            self.m2 = np.zeros(channels)
+            self.min = np.full(channels, np.inf)
+            self.max = np.full(channels, -np.inf)
+            self.hist = np.zeros((channels, self.bins), dtype=np.int64)
+
+        if frame.dtype == np.uint8 and self.bins == 256 and self.value_range == (0, 256):
+            # 8 bit images: one bincount per channel gives the histogram, and
+            # the exact moments follow from it
+            hist = np.stack([np.bincount(pixels[:, c], minlength=256) for c in range(channels)])
+            levels = np.arange(256, dtype=np.float64)
+            n = int(hist[0].sum())
+            mean = hist @ levels / n
+            m2 = (hist * (levels - mean[:, None]) ** 2).sum(axis=1)
+            self.merge_moments(n, mean, m2)
+            self.min = np.minimum(self.min, np.argmax(hist > 0, axis=1))
+            self.max = np.maximum(self.max, 255 - np.argmax(hist[:, ::-1] > 0, axis=1))
+            self.hist += hist
+            return
+
+        values = pixels.astype(np.float64)
+        n = len(values)
+        mean = values.mean(axis=0)
+        m2 = ((values - mean) ** 2).sum(axis=0)
+        self.merge_moments(n, mean, m2)
+        self.min = np.minimum(self.min, values.min(axis=0))
+        self.max = np.maximum(self.max, values.max(axis=0))
+
+        low, high = self.value_range
+        index = ((values - low) * (self.bins / (high - low))).astype(np.intp)
+        np.clip(index, 0, self.bins - 1, out=index)
+        index += np.arange(channels) * self.bins
+        self.hist += np.bincount(index.ravel(), minlength=channels * self.bins).reshape(channels, self.bins)
+
+    def merge_moments(self, n, mean, m2):
+        """Chan et al.'s parallel update of count, mean and sum of squared deviations."""
+        total = self.count + n
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta * delta * (self.count * n / total)
+        self.count = total
+
+    def merge(self, other):
+        """Fold another stream's statistics (same bins) into this one."""
+        if other.mean is None:
+            return
+        if self.mean is None:
+            self.mean = np.zeros_like(other.mean)
+            self.m2 = np.zeros_like(other.m2)
+            self.min = other.min.copy()
+            self.max = other.max.copy()
+            self.hist = np.zeros_like(other.hist)
+        if other.bins != self.bins or other.value_range != self.value_range:
+            raise ValueError("can't merge histograms with different bins")
+        self.merge_moments(other.count, other.mean, other.m2)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.hist += other.hist
+
+    @property
+    def std(self):
+        """Per channel standard deviation of all pixels."""
+        return np.sqrt(self.m2 / max(self.count - 1, 1))
+
+    def to_dict(self):
+        data = {"bins": self.bins, "range": list(self.value_range), "count": self.count}
+        if self.mean is not None:
+            data.update({
+                "mean": self.mean.tolist(),
+                "std": self.std.tolist(),
+                "m2": self.m2.tolist(),
+                "min": self.min.tolist(),
+                "max": self.max.tolist(),
+                "hist": self.hist.tolist(),
+            })
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data["bins"], data["range"])
+        stats.count = data["count"]
+        if "mean" in data:
+            stats.mean = np.array(data["mean"])
+            stats.m2 = np.array(data["m2"])
+            stats.min = np.array(data["min"])
+            stats.max = np.array(data["max"])
+            stats.hist = np.array(data["hist"], dtype=np.int64)
+        return stats
+
+
+class SessionStats:
+    """Running statistics of all streams of a session, saved as stats.json.
+
+    A resumed session's existing stats.json is loaded and carried on. With
+    ``save_every`` None it is only written by save().
+    """
+
+    def __init__(self, session, save_every=500):
+        self.path = os.path.join(session, FILENAME)
+        self.save_every = save_every
+        self.streams = load(self.path) if os.path.exists(self.path) else {}
+        self.updates = 0
+
+    def update(self, name, frame, radiometric=False):
+        """Add one saved frame of stream ``name``.
+
+        Radiometric (temperature) streams use fixed temperature bins, 16 bit
+        streams 1024 bins over 0..65535 and all others 256 bins over 0..255.
+        """
+        if name not in self.streams:
+            if radiometric:
+                self.streams[name] = RunningStats(TEMPERATURE_BINS, TEMPERATURE_RANGE)
+            elif frame.dtype == np.uint16:
+                self.streams[name] = RunningStats(1024, (0.0, 65536.0))
+            else:
+                self.streams[name] = RunningStats()
+        self.streams[name].update(frame)
+
+        self.updates += 1
+        if self.save_every and self.updates % self.save_every == 0:
+            self.save()
+
+    def save(self):
+        # written to a temporary file first so a crash never leaves half a file
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump({name: stats.to_dict() for name, stats in self.streams.items()}, file)
+        os.replace(tmp, self.path)
+
+
+def load(path):
+    """Stream name to RunningStats from a stats.json (or the session folder holding it)."""
+    if os.path.isdir(path):
+        path = os.path.join(path, FILENAME)
+    with open(path) as file:
+        return {name: RunningStats.from_dict(data) for name, data in json.load(file).items()}
+
+
+def merge(paths):
+    """Merge the stats.json files of several sessions stream by stream."""
+    merged = {}
+    for path in paths:
+        for name, stats in load(path).items():
+            if name not in merged:
+                merged[name] = RunningStats(stats.bins, stats.value_range)
+            merged[name].merge(stats)
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge and print capture session statistics.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    join = commands.add_parser("merge", help="merge stats.json files of several sessions")
+    join.add_argument("stats", nargs="+", help="stats.json files or session folders")
+    join.add_argument("--out", default=None, help="json file for the merged statistics")
+    show = commands.add_parser("show", help="print the statistics of one session")
+    show.add_argument("stats")
+    args = parser.parse_args()
+
+    streams = merge(args.stats) if args.command == "merge" else load(args.stats)
+    for name, stats in sorted(streams.items()):
+        if stats.mean is None:
+            continue
+        print("%s: %d pixels" % (name, stats.count))
+        print("  mean " + " ".join("%.4f" % value for value in stats.mean))
+        print("  std  " + " ".join("%.4f" % value for value in stats.std))
+        print("  min  " + " ".join("%.2f" % value for value in stats.min))
+        print("  max  " + " ".join("%.2f" % value for value in stats.max))
+
+    if args.command == "merge" and args.out is not None:
+        with open(args.out, "w") as file:
+            json.dump({name: stats.to_dict() for name, stats in streams.items()}, file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+# Soak test of the capture scripts with a synthetic camera
+#
+# Night sessions run for 30k+ frames, and memory that grows a little per frame
+# only shows up hours in. This runs a capture script's own main() against a
+# synthetic Seek camera and webcam for a fixed number of frames, headless, in a
+# scratch folder, while sampling the process size (RSS) over time:
+#   python soak.py combined --frames 5000
+#   python soak.py combined --frames 5000 --set REUSE_BUFFERS=false
+#   python soak.py all --frames 2000
+# The first --warmup frames fill caches and buffers. After that, growth of RSS
+# beyond --max-rss-growth (MB), as measured or as projected from the trend over
+# a --session of 30k frames, fails the run (exit code 1). --report writes all
+# samples to a JSON file (one per script, <name>-<script>.json, with "all").
+#
+# --tracemalloc also samples the Python heap, checks it against
+# --max-heap-growth and prints the source lines whose allocations grew most.
+# Tracing slows allocation heavy scripts (np.savetxt in correctedTIR and
+# thermography) below the camera's rate, and their bounded frame queues then
+# fill up during the run, which reads as growth; give those a lower --fps when
+# tracing them, e.g. python soak.py thermography --tracemalloc --fps 2
+#
+# The synthetic camera delivers frames of every format the script starts a
+# session with at --fps, into buffers reused from frame to frame like the
+# SDK's, on its own thread. The synthetic webcam keeps up with it. OpenCV's
+# window functions are replaced by no-ops and waitKey returns "q" once all the
+# frames were delivered; scripts without a window loop get a SIGINT instead.
+
+import argparse
+import enum
+import gc
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+import cv2
+import numpy as np
+
+from capture import SCRIPTS, parse_setting
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+HEIGHT, WIDTH = 240, 320
+VARIANTS = 16  # distinct synthetic frames, cycled through
+
+done = threading.Event()
+
+
+class Progress:
+    """Frames delivered by the source being soaked; sets ``done`` at the target."""
+
+    frames = 0
+    target = 1000
+
+    @classmethod
+    def add(cls):
+        cls.frames += 1
+        if cls.frames >= cls.target:
+            done.set()
+
+
+def rss():
+    """Resident set size of this process in bytes, None where it can't be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def scenes():
+    """Smooth moving gradients with noise, as float images in 0..1."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:HEIGHT, 0:WIDTH].astype(np.float32)
+    frames = []
+    for k in range(VARIANTS):
+        phase = 2 * np.pi * k / VARIANTS
+        scene = 0.5 + 0.25 * np.sin(x / 37.0 + phase) * np.cos(y / 23.0 - phase)
+        scene += rng.normal(0, 0.03, scene.shape).astype(np.float32)
+        frames.append(np.clip(scene, 0, 1))
+    return frames
+
+
+# synthetic seekcamera module
+
+class SeekCameraIOType(enum.IntFlag):
+    USB = 1
+    SPI = 2
+
+
+class SeekCameraColorPalette(enum.IntEnum):
+    WHITE_HOT = 0
+    BLACK_HOT = 1
+    SPECTRA = 2
+    PRISM = 3
+    TYRIAN = 4
+
+
+class SeekCameraFrameFormat(enum.IntFlag):
+    CORRECTED = 0x04
+    PRE_AGC = 0x08
+    THERMOGRAPHY_FLOAT = 0x10
+    THERMOGRAPHY_FIXED_10_6 = 0x20
+    GRAYSCALE = 0x40
+    COLOR_ARGB8888 = 0x80
+
+
+class SeekCameraManagerEvent(enum.IntEnum):
+    CONNECT = 0
+    DISCONNECT = 1
+    ERROR = 2
+    READY_TO_PAIR = 3
+
+
+class SeekCameraError(Exception):
+    pass
+
+
+class SeekFrameHeader:
+    def __init__(self):
+        self.timestamp_utc_ns = 0
+
+
+class SeekFrame:
+    def __init__(self, data=None):
+        self.data = data
+        self.header = SeekFrameHeader()
+
+    @property
+    def height(self):
+        return self.data.shape[0]
+
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+
+class SeekCameraFrame:
+    """The frame passed to the frame callback, one SeekFrame per captured format."""
+
+    def __init__(self, buffers):
+        for name, data in buffers.items():
+            setattr(self, name, SeekFrame(data))
+
+
+# attribute name, dtype and channels of each format
+FORMATS = {
+    SeekCameraFrameFormat.CORRECTED: ("corrected", np.uint16, None),
+    SeekCameraFrameFormat.PRE_AGC: ("pre_agc", np.uint16, None),
+    SeekCameraFrameFormat.THERMOGRAPHY_FLOAT: ("thermography_float", np.float32, None),
+    SeekCameraFrameFormat.GRAYSCALE: ("grayscale", np.uint8, None),
+    SeekCameraFrameFormat.COLOR_ARGB8888: ("color_argb8888", np.uint8, 4),
+}
+
+
+def render(scene, name, out):
+    """Write one scene into a format's buffer."""
+    if name == "thermography_float":
+        np.multiply(scene, 40.0, out=out)
+        out += 5.0  # 5..45 C
+    elif out.dtype == np.uint16:
+        np.multiply(scene, 16383.0, out=out, casting="unsafe")
+    elif out.ndim == 3:
+        # white hot: equal blue, green and red, opaque
+        np.multiply(scene, 255.0, out=out[..., 0], casting="unsafe")
+        out[..., 1] = out[..., 0]
+        out[..., 2] = out[..., 0]
+        out[..., 3] = 255
+    else:
+        np.multiply(scene, 255.0, out=out, casting="unsafe")
+
+
+class SeekCamera:
+    """A camera that delivers synthetic frames at ``fps`` from the start of a session until ``done``."""
+
+    fps = 27.0
+
+    def __init__(self):
+        self.chipid = "SYNTHETIC0001"
+        self.color_palette = SeekCameraColorPalette.WHITE_HOT
+        self.histeq_agc_gain_limit = 0.65
+        self.callback = None
+        self.user_data = None
+        self.running = False
+        self.thread = None
+
+    def register_frame_available_callback(self, callback, user_data=None):
+        self.callback = callback
+        self.user_data = user_data
+
+    def capture_session_start(self, frame_format):
+        buffers = {}
+        for flag, (name, dtype, channels) in FORMATS.items():
+            if frame_format & flag:
+                shape = (HEIGHT, WIDTH) if channels is None else (HEIGHT, WIDTH, channels)
+                buffers[name] = np.zeros(shape, dtype)
+        self.running = True
+        self.thread = threading.Thread(target=self.deliver, args=(buffers,), name="synthetic-sdk", daemon=True)
+        self.thread.start()
+
+    def deliver(self, buffers):
+        variants = scenes()
+        period = 1.0 / self.fps
+        next_time = time.perf_counter()
+        count = 0
+        while self.running and not done.is_set():
+            scene = variants[count % VARIANTS]
+            for name, out in buffers.items():
+                render(scene, name, out)
+            # the SDK hands out new frame objects over the same buffers
+            frame = SeekCameraFrame(buffers)
+            for name in buffers:
+                getattr(frame, name).header.timestamp_utc_ns = time.time_ns()
+            self.callback(self, frame, self.user_data)
+            count += 1
+            Progress.add()
+            next_time += period
+            time.sleep(max(0.0, next_time - time.perf_counter()))
+
+    def capture_session_stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class SeekCameraManager:
+    """Connects one synthetic camera when an event callback is registered."""
+
+    def __init__(self, io_type=SeekCameraIOType.USB):
+        self.camera = SeekCamera()
+
+    def register_event_callback(self, callback, user_data=None):
+        threading.Thread(target=callback, args=(self.camera, SeekCameraManagerEvent.CONNECT, None, user_data),
+                         daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.camera.capture_session_stop()
+
+
+def synthetic_sdk():
+    module = types.ModuleType("seekcamera")
+    for item in (SeekCameraIOType, SeekCameraColorPalette, SeekCameraFrameFormat, SeekCameraManagerEvent,
+                 SeekCameraError, SeekFrame, SeekCameraFrame, SeekCamera, SeekCameraManager):
+        setattr(module, item.__name__, item)
+    return module
+
+
+# synthetic webcam and headless OpenCV
+
+class SyntheticWebcam:
+    """Stands in for cv2.VideoCapture: 640x480 BGR frames at ``fps``.
+
+    With ``counting`` set (for webcamRGB, which has no thermal camera) it is
+    the source being soaked.
+    """
+
+    counting = False
+    fps = 30.0
+
+    def __init__(self, *args):
+        self.properties = {cv2.CAP_PROP_FRAME_WIDTH: 640.0, cv2.CAP_PROP_FRAME_HEIGHT: 480.0,
+                           cv2.CAP_PROP_FPS: 30.0}
+        variants = scenes()
+        self.frames = [cv2.cvtColor(cv2.resize((scene * 255).astype(np.uint8), (640, 480)), cv2.COLOR_GRAY2BGR)
+                       for scene in variants[:4]]
+        self.count = 0
+        self.next_time = time.perf_counter()
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        self.properties[prop] = float(value)
+        return True
+
+    def get(self, prop):
+        return self.properties.get(prop, 0.0)
+
+    def grab(self):
+        # block until the next frame is due, like a driver
+        self.next_time = max(self.next_time + 1.0 / self.fps, time.perf_counter() - 0.1)
+        time.sleep(max(0.0, self.next_time - time.perf_counter()))
+        self.count += 1
+        if self.counting:
+            Progress.add()
+        return True
+
+    def retrieve(self, image=None, flag=0):
+        frame = self.frames[self.count % len(self.frames)]
+        if image is not None and image.shape == frame.shape and image.dtype == frame.dtype:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame.copy()
+
+    def read(self, image=None):
+        self.grab()
+        return self.retrieve(image)
+
+    def release(self):
+        return
+
+
+def wait_key(delay=0):
+    time.sleep(0.001)
+    return ord("q") if done.is_set() else -1
+
+
+def headless():
+    for name in ("namedWindow", "imshow", "resizeWindow", "destroyWindow", "destroyAllWindows",
+                 "setWindowTitle", "moveWindow"):
+        setattr(cv2, name, lambda *args, **kwargs: None)
+    cv2.getWindowProperty = lambda *args: 1.0
+    cv2.waitKey = wait_key
+    cv2.VideoCapture = SyntheticWebcam
+
+
+# sampling
+
+class Sampler:
+    """Records frames delivered, RSS and traced heap every ``interval`` seconds."""
+
+    def __init__(self, interval, warmup):
+        self.interval = interval
+        self.warmup = warmup
+        self.samples = []
+        self.baseline = None
+        self.snapshot = None
+        self.final = None
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="soak-sampler", daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        frames = Progress.frames
+        # cyclic garbage waits for the collector, which runs by allocation
+        # count, not time; np.savetxt leaves a class behind on every call
+        gc.collect()
+        if self.baseline is None and frames >= self.warmup:
+            # snapshot first, so the memory it leaves behind is in the baseline
+            if tracemalloc.is_tracing():
+                self.snapshot = tracemalloc.take_snapshot()
+            self.baseline = len(self.samples)
+        size = rss()
+        heap = None
+        if tracemalloc.is_tracing():
+            heap = tracemalloc.get_traced_memory()[0]
+            if size is not None:
+                # tracemalloc's own bookkeeping grows with the heap it traces
+                size -= tracemalloc.get_tracemalloc_memory()
+        self.samples.append({"t": round(time.perf_counter() - self.started, 3), "frames": frames,
+                             "rss": size, "heap": heap})
+
+    def run(self):
+        # sampling ends with the last frame, before the script closes its
+        # files and frees its buffers
+        while not done.is_set():
+            self.sample()
+            done.wait(self.interval)
+        self.sample()
+        if tracemalloc.is_tracing():
+            self.final = tracemalloc.take_snapshot()
+
+    def stop(self):
+        done.set()
+        self.thread.join()
+
+
+def growth(samples, baseline, key):
+    """Growth of ``key`` from the baseline sample to the end, its slope per frame and the slope's standard error."""
+    points = [(s["frames"], s[key]) for s in samples[baseline:] if s[key] is not None]
+    if len(points) < 2:
+        return None, None, None
+    frames, values = np.array(points, dtype=np.float64).T
+    if len(points) < 4 or frames[-1] == frames[0]:
+        return values[-1] - values[0], 0.0, 0.0
+    coefficients, covariance = np.polyfit(frames, values, 1, cov=True)
+    return values[-1] - values[0], coefficients[0], float(np.sqrt(covariance[0, 0]))
+
+
+def soak(script, frames, fps, warmup, settings, interval=1.0, trace=False, keep=False):
+    """Run one capture script for ``frames`` synthetic frames; returns the report."""
+    Progress.target = frames
+    SeekCamera.fps = fps
+    if SCRIPTS[script] == "webcamRGB":
+        SyntheticWebcam.counting = True
+    SyntheticWebcam.fps = max(fps, 30.0)
+    sys.modules["seekcamera"] = synthetic_sdk()
+    headless()
+
+    workdir = tempfile.mkdtemp(prefix="soak-" + script + "-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    module = __import__(SCRIPTS[script])
+    for key, value in settings.items():
+        if not key.isupper() or not hasattr(module, key):
+            raise SystemExit("{}.py has no setting {}".format(SCRIPTS[script], key))
+        setattr(module, key, value)
+
+    def interrupt():
+        # scripts without a waitKey loop stop on Ctrl+C
+        done.wait()
+        time.sleep(2.0)
+        if not finished.is_set():
+            signal.raise_signal(signal.SIGINT)
+
+    finished = threading.Event()
+    threading.Thread(target=interrupt, daemon=True).start()
+    if trace:
+        tracemalloc.start()
+    sampler = Sampler(interval, warmup)
+    try:
+        module.main()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        finished.set()
+        sampler.stop()
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"script": script, "frames": Progress.frames, "settings": settings, "samples": sampler.samples}
+    if sampler.baseline is not None:
+        for key in ("rss", "heap"):
+            report[key + "_growth"], report[key + "_per_frame"], report[key + "_per_frame_error"] = growth(
+                sampler.samples, sampler.baseline, key)
+        if sampler.snapshot is not None and sampler.final is not None:
+            stats = sampler.final.compare_to(sampler.snapshot, "lineno")
+            report["top_growth"] = [str(stat) for stat in stats[:10] if stat.size_diff > 0]
+    if trace:
+        tracemalloc.stop()
+    if keep:
+        report["workdir"] = workdir
+    return report
+
+
+def check(report, max_rss, max_heap, session):
+    """Print a report; True if memory stayed within the limits.
+
+    Both the growth measured and the growth the trend projects over a session
+    of ``session`` frames count, so a short soak catches slow leaks too. The
+    trend is taken two standard errors low, so that frames in flight at a
+    sample don't read as a leak.
+    """
+    ok = True
+    print("{}: {} frames".format(report["script"], report["frames"]))
+    for key, limit in (("rss", max_rss), ("heap", max_heap)):
+        change = report.get(key + "_growth")
+        if change is None:
+            print("  {}: not measured".format(key))
+            continue
+        slope, error = report[key + "_per_frame"], report[key + "_per_frame_error"]
+        projected = max(0.0, slope - 2 * error) * session
+        over = max(change, projected) > limit * 1024 ** 2
+        ok = ok and not over
+        print("  {}: {:+.2f} MB after warmup, {:+.0f} +- {:.0f} bytes/frame, {:+.1f} MB over {} frames{}".format(
+            key, change / 1024 ** 2, slope, error, projected / 1024 ** 2, session, "  FAIL" if over else ""))
+    if not ok:
+        for line in report.get("top_growth", []):
+            print("    " + line)
+    return ok
+
+
+def forwarded(arguments, script):
+    """Command line arguments for one script of "all", with its own --report file."""
+    arguments = list(arguments)
+    for i, argument in enumerate(arguments):
+        if argument == "--report" and i + 1 < len(arguments):
+            base, extension = os.path.splitext(arguments[i + 1])
+            arguments[i + 1] = "{}-{}{}".format(base, script, extension)
+        elif argument.startswith("--report="):
+            base, extension = os.path.splitext(argument[len("--report="):])
+            arguments[i] = "--report={}-{}{}".format(base, script, extension)
+    return arguments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test a capture script with a synthetic camera.")
+    parser.add_argument("script", choices=list(SCRIPTS) + ["all"])
+    parser.add_argument("--frames", type=int, default=3000)
+    parser.add_argument("--fps", type=float, default=27.0, help="synthetic thermal frame rate")
+    parser.add_argument("--warmup", type=int, default=None, help="frames before measuring, a fifth if not given")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between samples")
+    parser.add_argument("--max-rss-growth", type=float, default=8.0, help="MB")
+    parser.add_argument("--max-heap-growth", type=float, default=2.0, help="MB")
+    parser.add_argument("--session", type=int, default=30000, help="frames to project the growth trend over")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also sample the Python heap; slows the script, see above")
+    parser.add_argument("--set", dest="settings", type=parse_setting, action="append", default=[],
+                        metavar="KEY=VALUE", help="set one of the script's constants, may be repeated")
+    parser.add_argument("--report", default=None, help="JSON file for the samples")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch session folder")
+    args = parser.parse_args()
+
+    if args.script == "all":
+        # one process per script, each imports its own modules and SDK
+        failed = []
+        for script in SCRIPTS:
+            command = [sys.executable, os.path.abspath(__file__), script] + forwarded(sys.argv[2:], script)
+            if subprocess.run(command).returncode != 0:
+                failed.append(script)
+        if failed:
+            print("failed: " + ", ".join(failed))
+        sys.exit(1 if failed else 0)
+
+    warmup = args.warmup if args.warmup is not None else args.frames // 5
+    report = soak(args.script, args.frames, args.fps, warmup, dict(args.settings), args.interval,
+                  args.tracemalloc, args.keep)
+    if args.report is not None:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=1)
+    if not check(report, args.max_rss_growth, args.max_heap_growth, args.session):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
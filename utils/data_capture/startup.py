@@ -0,0 +1,67 @@
+# Startup helpers shared by the capture scripts
+#
+# Getting to the first saved pair used to be slow because everything happened
+# one after the other: heavy imports, opening the webcam (a second or more
+# with DirectShow), then starting the Seek camera manager and waiting for the
+# camera to pair. Background() opens devices on a thread while the thermal
+# camera pairs, and milestone() prints how long after start each step was
+# first reached, e.g.
+#   [startup] rgb camera open: 1.42 s
+#   [startup] thermal camera connected: 2.10 s
+#   [startup] first pair saved: 2.31 s
+# START is the time this module was first imported. capture.py imports it
+# before anything else, so there it is close to process start.
+
+import threading
+import time
+
+START = time.perf_counter()
+
+reached = {}
+lock = threading.Lock()
+
+
+def milestone(name, telemetry=None):
+    """Print the time since start the first time ``name`` is reached; later calls return at once."""
+    if name in reached:
+        return reached[name]
+    with lock:
+        if name in reached:
+            return reached[name]
+        elapsed = time.perf_counter() - START
+        reached[name] = elapsed
+    print("[startup] {}: {:.2f} s".format(name, elapsed))
+    if telemetry is not None:
+        telemetry.set("startup_seconds", elapsed, step=name)
+    return elapsed
+
+
+class Background:
+    """Runs ``function(*args)`` on a thread, e.g. opening a webcam while the thermal camera pairs.
+
+    result() waits for it and returns its value, or raises what it raised.
+    """
+
+    def __init__(self, name, function, *args):
+        self.name = name
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(function, args), daemon=True)
+        self.thread.start()
+
+    def run(self, function, args):
+        try:
+            self.value = function(*args)
+            milestone(self.name)
+        except BaseException as e:
+            self.error = e
+
+    def done(self):
+        """Whether it has finished, so result() won't wait."""
+        return not self.thread.is_alive()
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -0,0 +1,186 @@
+# Live metrics for capture sessions
+#
+# Counters, gauges and latency summaries that the capture loop and the camera
+# callbacks update, exposed three ways:
+#   - a local HTTP endpoint in Prometheus text format (http://127.0.0.1:9108/metrics)
+#   - a JSON lines file in the session folder with one snapshot per interval
+#   - one summary line on the console per interval, instead of printing every
+#     frame (printing on every frame was slowing the loop down)
+#
+# Metric names used by the capture scripts:
+#   frames_received            frames delivered by the camera callback
+#   pairs_written              pairs saved
+#   drops{reason=...}          frames or pairs lost, by reason
+#   write_errors{stream=...}   writes that failed (see diskout.py)
+#   write_seconds              time spent writing one pair
+#   queue_depth                frames waiting for the main loop
+#   disk_free_bytes            free space on the output volume
+#   camera_events{event=...}   camera connect/disconnect/error events
+
+import json
+import shutil
+import threading
+import time
+
+PREFIX = "tri2i_"
+
+
+def metric_key(name, labels):
+    """Prometheus style key, e.g. drops{reason="rgb_read"}."""
+    if not labels:
+        return name
+    return name + "{" + ",".join('%s="%s"' % item for item in sorted(labels.items())) + "}"
+
+
+class Telemetry:
+    """Thread safe registry of counters, gauges and latency summaries."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+        self.started = time.time()
+        self.threads = []
+        self.stopping = threading.Event()
+        self.server = None
+
+    def inc(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds):
+        """Record one latency measurement."""
+        with self.lock:
+            count, total, high = self.summaries.get(name, (0, 0.0, 0.0))
+            self.summaries[name] = (count + 1, total + seconds, max(high, seconds))
+
+    def counter(self, name):
+        """Total of a counter over all its labels."""
+        with self.lock:
+            return sum(value for key, value in self.counters.items()
+                       if key == name or key.startswith(name + "{"))
+
+    def snapshot(self):
+        with self.lock:
+            data = {"time": time.time(), "uptime": time.time() - self.started}
+            data.update(self.counters)
+            data.update(self.gauges)
+            for name, (count, total, high) in self.summaries.items():
+                data[name + "_count"] = count
+                data[name + "_sum"] = total
+                data[name + "_max"] = high
+            return data
+
+    def prometheus(self):
+        """All metrics in Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for key, value in sorted(self.counters.items()):
+                lines.append("%s%s %s" % (PREFIX, key, value))
+            for key, value in sorted(self.gauges.items()):
+                lines.append("%s%s %s" % (PREFIX, key, value))
+            for name, (count, total, high) in sorted(self.summaries.items()):
+                lines.append("%s%s_count %d" % (PREFIX, name, count))
+                lines.append("%s%s_sum %f" % (PREFIX, name, total))
+                lines.append("%s%s_max %f" % (PREFIX, name, high))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve /metrics on a local port from a background thread."""
+        # imported here so scripts that don't serve metrics don't pay for it at startup
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = telemetry.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                return
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        print("metrics on http://{}:{}/metrics".format(host, port))
+
+    def report(self, path=None, interval=5.0, disk_path=None):
+        """Every ``interval`` seconds append a snapshot to ``path`` and print a summary line.
+
+        Parameters
+        ----------
+        path: Optional[str]
+            JSON lines file to append snapshots to.
+        interval: float
+            Seconds between snapshots and summary lines.
+        disk_path: Optional[str]
+            Folder whose volume's free space is tracked as disk_free_bytes.
+        """
+        def run():
+            last_pairs = 0
+            last_time = time.time()
+            while not self.stopping.wait(interval):
+                if disk_path is not None:
+                    try:
+                        self.set("disk_free_bytes", shutil.disk_usage(disk_path).free)
+                    except OSError:
+                        pass
+
+                data = self.snapshot()
+                if path is not None:
+                    with open(path, "a") as file:
+                        file.write(json.dumps(data) + "\n")
+
+                pairs = self.counter("pairs_written")
+                now = time.time()
+                rate = (pairs - last_pairs) / max(now - last_time, 1e-9)
+                last_pairs, last_time = pairs, now
+                print(self.summary(data, rate))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def summary(self, data, rate):
+        count = data.get("write_seconds_count", 0)
+        write_ms = 1000.0 * data.get("write_seconds_sum", 0.0) / count if count else 0.0
+        line = "pairs {} ({:.1f}/s) frames {} drops {} errors {} write {:.1f} ms".format(
+            self.counter("pairs_written"), rate, self.counter("frames_received"),
+            self.counter("drops"), self.counter("write_errors"), write_ms)
+        if "disk_free_bytes" in data:
+            line += " disk {:.1f} GB free".format(data["disk_free_bytes"] / 1e9)
+        return line
+
+    def close(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class Timer:
+    """Context manager recording how long its block took as a latency summary."""
+
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.telemetry.observe(self.name, time.perf_counter() - self.start)
@@ -0,0 +1,73 @@
+# Tests for the crash safe session journal: python -m pytest test_journal.py
+
+import os
+
+from journal import Journal
+
+
+def capture(journal, folder, pairs):
+    for pair in pairs:
+        journal.write(os.path.join(folder, "%d.bmp" % pair), b"tir")
+        journal.write(os.path.join(folder, "%d.jpg" % pair), b"rgb")
+        journal.commit(pair)
+
+
+def crash(journal, folder, pair):
+    """Leave a pair half written and the journal with a line cut short, as a
+    power cut in the middle of a sync would."""
+    journal.write(os.path.join(folder, "%d.bmp" % pair), b"tir")
+    journal.file.write('{"pair": %d, "fi' % pair)
+    journal.file.flush()
+    journal.file.close()
+
+
+def test_resume_after_two_crashes(tmp_path):
+    folder = str(tmp_path)
+    path = os.path.join(folder, "journal.jsonl")
+
+    journal = Journal(path, fsync_every=1)
+    capture(journal, folder, [1, 2])
+    crash(journal, folder, 3)
+
+    journal = Journal(path, fsync_every=1)
+    assert journal.resumed and journal.next_pair == 3
+    assert journal.discard_incomplete([folder]) == 1
+    capture(journal, folder, [3, 4])
+    crash(journal, folder, 5)
+
+    journal = Journal(path, fsync_every=1)
+    assert journal.next_pair == 5
+    assert journal.discard_incomplete([folder]) == 1
+    for pair in [1, 2, 3, 4]:
+        assert os.path.exists(os.path.join(folder, "%d.bmp" % pair))
+        assert os.path.exists(os.path.join(folder, "%d.jpg" % pair))
+    assert not os.path.exists(os.path.join(folder, "5.bmp"))
+    journal.close()
+
+
+def test_lines_after_a_garbled_line_count(tmp_path):
+    folder = str(tmp_path)
+    path = os.path.join(folder, "journal.jsonl")
+    with open(path, "w") as file:
+        file.write('{"header": {}}\n'
+                   '{"pair": 1, "files": ["1.bmp"]}\n'
+                   '{"pair": 2, "fi{"pair": 2, "files": ["2.bmp"]}\n'
+                   '{"pair": 3, "files": ["3.bmp"]}\n')
+
+    journal = Journal(path)
+    assert journal.next_pair == 4
+    assert sorted(journal.committed) == [1, 3]
+    journal.close()
+
+
+def test_discarded_pair_is_not_committed(tmp_path):
+    folder = str(tmp_path)
+    journal = Journal(os.path.join(folder, "journal.jsonl"), fsync_every=1)
+    capture(journal, folder, [1])
+    journal.write(os.path.join(folder, "2.bmp"), b"tir")
+    journal.discard()
+    capture(journal, folder, [2])
+    journal.close()
+
+    journal = Journal(journal.path)
+    assert journal.committed[2] == ["2.bmp", "2.jpg"]
@@ -15,109 +15,113 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from time import sleep
-
 import numpy as np
 
-from seekcamera import (
-    SeekCameraIOType,
-    SeekCameraManager,
-    SeekCameraManagerEvent,
-    SeekCameraFrameFormat,
-)
+from seekcamera import SeekCameraFrameFormat
 
 from datetime import datetime
+from functools import partial
 import cv2
 import os
 
+from aiocapture import CaptureRuntime
+from framestack import FrameStackWriter
+from rgbgrab import RgbGrabber, open_camera
+from startup import Background, milestone
+from telemetry import Telemetry, Timer
+
+# "csv" appends every frame to a text file, "stack" appends the float data to a
+# binary frame stack (see framestack.py) that tonemap.py can turn into images
+THERMOGRAPHY_OUTPUT = "csv"
+
+# webcam mode, a name in rgbgrab.PROFILES or a dict (see rgbgrab.py)
+RGB_PROFILE = "default"
 
-def on_frame(camera, camera_frame, stuff):
-    """Async callback fired whenever a new frame is available.
+
+def extract(camera_frame):
+    """Copy of the temperatures, taken on the SDK thread.
 
     Parameters
     ----------
-    camera: SeekCamera
-        Reference to the camera for which the new frame is available.
     camera_frame: SeekCameraFrame
         Reference to the class encapsulating the new frame (potentially
-        in multiple formats).
-    stuff: Tuple
-        [TextIOWrapper, camera object, image number]
-        User defined data passed to the callback. This can be anything
-        but in this case it is a reference to the open CSV file to which
-        to log data.
+        in multiple formats). Its buffers are reused after the callback.
     """
-    frame = camera_frame.thermography_float
-
-    # Append the frame to the CSV file.
-    np.savetxt(stuff[0], frame.data, fmt="%.1f")
-
-    # Save the RGB image
-    ret,ogrgb = stuff[1].read()
-    rgbimg = ogrgb#cv2.flip(ogrgb, 1)#flip horizontally
-    rgbimg = cv2.rotate(rgbimg, cv2.ROTATE_90_CLOCKWISE)
-    rgbimg = rgbimg[64:576, 0:512]
-    rgbimg = cv2.resize(rgbimg, (240,240), interpolation = cv2.INTER_AREA)
-
-    max_number = 0
-    
-    # List all files in the directory
-    for filename in os.listdir():
-        if filename.endswith(".png"):
-            try:
-                # Extract the number part from the filename
-                number = int(filename.split('.')[0])
-                if number > max_number:
-                    max_number = number
-            except ValueError:
-                pass  # Ignore files that don't match the expected pattern
-    
-    filename = str(max_number + 1) + ".png"
-    cv2.imwrite(filename, rgbimg)
-    print(str(max_number+1))
-
-
-def on_event(camera, event_type, event_status, rgbcam):
-    """Async callback fired whenever a camera event occurs.
+    return camera_frame.thermography_float.data.copy()
 
-    Parameters
-    ----------
-    camera: SeekCamera
-        Reference to the camera on which an event occurred.
-    event_type: SeekCameraManagerEvent
-        Enumerated type indicating the type of event that occurred.
-    event_status: Optional[SeekCameraError]
-        Optional exception type. It will be a non-None derived instance of
-        SeekCameraError if the event_type is SeekCameraManagerEvent.ERROR.
-    rgbcam: cv2 camera object
-        User defined data passed to the callback. This can be anything
-        but in this case it is a camera.
-    """
-    print("{}: {}".format(str(event_type), camera.chipid))
 
-    if event_type == SeekCameraManagerEvent.CONNECT:
-        # Open a new CSV file with the unique camera chip ID embedded.
-        try:
-            now = datetime.now()
-            date_time = now.strftime("%Y%m%d%H%M")
-            file = open("thermography-" + date_time + ".csv", "w")
-        except OSError as e:
-            print("Failed to open file: %s" % str(e))
-            return
+class PairWriter:
+    """Saves pairs numbered 1, 2, ... in the order they are written.
 
-        # Start streaming data and provide a custom callback to be called
-        # every time a new frame is received.
-        camera.register_frame_available_callback(on_frame, [file, rgbcam])
-        camera.capture_session_start(SeekCameraFrameFormat.THERMOGRAPHY_FLOAT)
+    The n-th row of the csv (or frame of the stack) belongs to n.png: a pair
+    only takes a number once its RGB image is saved, and its temperatures are
+    only appended after that.
 
-    elif event_type == SeekCameraManagerEvent.DISCONNECT:
-        camera.capture_session_stop()
+    Parameters
+    ----------
+    telemetry: Telemetry
+        Where the write time is observed.
+    output: Union[TextIOWrapper, FrameStackWriter]
+        The open CSV file or frame stack the temperatures go to.
+    folder: str
+        Folder the RGB images go to.
+    """
 
-    elif event_type == SeekCameraManagerEvent.ERROR:
-        print("{}: {}".format(str(event_status), camera.chipid))
+    def __init__(self, telemetry, output, folder):
+        self.telemetry = telemetry
+        self.output = output
+        self.folder = folder
+        self.count = 0
+
+    def save(self, timestamp, temperatures, ogrgb):
+        """Saves the RGB image as <number>.png, then appends the temperatures;
+        returns whether the pair was saved."""
+        number = self.count + 1
+        with Timer(self.telemetry, "write_seconds"):
+            # Save the RGB image
+            rgbimg = ogrgb#cv2.flip(ogrgb, 1)#flip horizontally
+            rgbimg = cv2.rotate(rgbimg, cv2.ROTATE_90_CLOCKWISE)
+            rgbimg = rgbimg[64:576, 0:512]
+            rgbimg = cv2.resize(rgbimg, (240,240), interpolation = cv2.INTER_AREA)
+            if not cv2.imwrite(os.path.join(self.folder, str(number) + ".png"), rgbimg):
+                return False
+
+            # Append the frame to the CSV file.
+            if THERMOGRAPHY_OUTPUT == "csv":
+                np.savetxt(self.output, temperatures, fmt="%.1f")
+            else:
+                self.output.write(temperatures, number, timestamp)
+        self.count = number
+        return True
+
+
+async def handle(writer, runtime, frame):
+    """Saves one frame and the RGB image grabbed when it arrived.
 
-    elif event_type == SeekCameraManagerEvent.READY_TO_PAIR:
+    Parameters
+    ----------
+    writer: PairWriter
+        Numbers and saves the pairs.
+    runtime: CaptureRuntime
+        The runtime the frame came from, used to run the writes on its executor.
+    frame: Frame
+        Frame number, capture time, temperatures and the future of rgb.read().
+    """
+    try:
+        ret, ogrgb = await frame.grabbed
+    except Exception:
+        # e.g. the webcam didn't open: a dropped frame like any failed read,
+        # not a handler error
+        ret = False
+    if not ret:
+        # the TIR frame goes too, and is counted so the summary line shows it
+        runtime.telemetry.inc("drops", reason="rgb_read")
         return
+    if await runtime.io(writer.save, frame.timestamp, frame.data, ogrgb):
+        runtime.telemetry.inc("pairs_written")
+        milestone("first pair saved", runtime.telemetry)
+    else:
+        runtime.telemetry.inc("write_errors", stream="rgb")
 
 
 def main():
@@ -128,20 +132,34 @@ def main():
     date_time = now.strftime("%Y%m%d%H%M")
     dir1 = os.path.join(os.getcwd(),"therm" + date_time)
     os.mkdir(dir1)
-    os.chdir(dir1)
-
-    rgb = cv2.VideoCapture(0)
-    # Create a context structure responsible for managing all connected USB cameras.
-    # Cameras with other IO types can be managed by using a bitwise or of the
-    # SeekCameraIOType enum cases.
-    with SeekCameraManager(SeekCameraIOType.USB) as manager:
-        # Start listening for events.
 
-        manager.register_event_callback(on_event, rgb)
-
-        while True:
-            sleep(1.0)
+    if THERMOGRAPHY_OUTPUT == "stack":
+        output = FrameStackWriter(os.path.join(dir1, "thermography-" + date_time))
+    else:
+        output = open(os.path.join(dir1, "thermography-" + date_time + ".csv"), "w")
+
+    # rgb.read() (a decode of the latest grabbed frame, see rgbgrab.py) starts
+    # on its own thread as each TIR frame arrives, and the writes run on the
+    # runtime's I/O thread, so neither holds up the SDK's frame delivery (see
+    # aiocapture.py). Ctrl+C or SIGTERM stops the capture after the queued
+    # frames are saved. The webcam opens while the thermal camera pairs (see
+    # startup.py).
+    telemetry = Telemetry()
+    rgb_opening = Background("rgb camera open", lambda: RgbGrabber(open_camera(0, RGB_PROFILE), telemetry))
+    writer = PairWriter(telemetry, output, dir1)
+    runtime = CaptureRuntime(SeekCameraFrameFormat.THERMOGRAPHY_FLOAT, extract, partial(handle, writer),
+                             grab=lambda: rgb_opening.result().read(), telemetry=telemetry)
+    telemetry.report(os.path.join(dir1, "telemetry.jsonl"), 5.0, dir1)
+    try:
+        runtime.run()
+    finally:
+        output.close()
+        try:
+            rgb_opening.result().release()
+        except Exception as e:
+            print("rgb camera never opened: {}".format(e))
+        telemetry.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
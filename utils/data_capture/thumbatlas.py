@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# Thumbnail atlas and viewer for reviewing capture sessions
+#
+# Looking through a session before a dataset build used to mean opening
+# thousands of full size images one by one. This builds a cached atlas instead:
+# every frame of each stream (a folder of images, e.g. TIR<date> and RGB<date>)
+# is shrunk into a pyramid of thumbnail sizes, and the thumbnails are packed
+# into square mosaic sheets per level, next to an index (atlas.json):
+#   atlas/
+#     atlas.json        streams, pair numbers, levels and their sheet grids
+#     0/<stream>_<sheet>.jpg   largest thumbnails, e.g. 8 x 8 per sheet
+#     1/<stream>_<sheet>.jpg   half size, 16 x 16 per sheet
+#     2/...
+# Sheets are built in chunks on a process pool. A chunk is only rebuilt when
+# its source files changed, so rerunning on a growing session only adds the new
+# pairs. The viewer pages through the pairs with the streams side by side, one
+# sheet of each stream per page:
+#   python thumbatlas.py build TIR202408181354 RGB202408181354 --out atlas202408181354
+#   python thumbatlas.py view atlas202408181354
+# Viewer keys: n/space next page, p/b previous page, +/- bigger/smaller
+# thumbnails, q quits. The page slider jumps anywhere in the session.
+
+import argparse
+import json
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+INDEX = "atlas.json"
+
+# the pair number a capture file name starts with, e.g. 12.jpg, 12_0.png, 12.bmp_0.png
+PAIR_NUMBER = re.compile(r"^(\d+)[._]")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def stream_files(folder):
+    """Pair number to image path in one stream folder; the first name wins for repeated pairs."""
+    files = {}
+    for name in sorted(os.listdir(folder)):
+        match = PAIR_NUMBER.match(name)
+        if match and name.lower().endswith(IMAGE_EXTENSIONS):
+            files.setdefault(int(match.group(1)), os.path.join(folder, name))
+    return files
+
+
+def level_grids(sheet, tile, levels):
+    """(tile size, tiles per sheet side) of every pyramid level.
+
+    Raises ValueError unless the sheets of every level hold whole sheets of
+    the level above, which is what chunking the build relies on.
+    """
+    if tile >> (levels - 1) < 1 or tile > sheet:
+        raise ValueError("%d levels of %d px tiles don't fit %d px sheets" % (levels, tile, sheet))
+    grids = [(tile >> level, sheet // (tile >> level)) for level in range(levels)]
+    last = grids[-1][1] ** 2
+    if any(last % (grid * grid) for _, grid in grids):
+        raise ValueError("%d px tiles don't nest in %d px sheets (%s tiles per side), "
+                         "make the sheet a multiple of the tile, e.g. --sheet %d"
+                         % (tile, sheet, "/".join(str(grid) for _, grid in grids), tile * (sheet // tile)))
+    return grids
+
+
+def fit(img, size):
+    """Shrink an image into a size x size tile, keeping its aspect ratio."""
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    height, width = img.shape[:2]
+    scale = size / max(height, width)
+    new = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    small = cv2.resize(img, new, interpolation = cv2.INTER_AREA)
+    tile = np.zeros((size, size, 3), np.uint8)
+    top = (size - new[1]) // 2
+    left = (size - new[0]) // 2
+    tile[top:top + new[1], left:left + new[0]] = small
+    return tile
+
+
+def chunk_stamp(paths):
+    """Cheap fingerprint of a chunk's source files: their names, sizes and times."""
+    stamp = []
+    for path in paths:
+        if path is None:
+            stamp.append(None)
+        else:
+            stat = os.stat(path)
+            stamp.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+
+def build_chunk(out, stream, paths, first, grids, quality=90):
+    """Write every level's sheets of one stream for pairs first..first+len(paths)-1.
+
+    The largest thumbnails are made from the images, each smaller level from
+    the level above it.
+    """
+    tiles = None
+    for level, (size, grid) in enumerate(grids):
+        if tiles is None:
+            tiles = np.zeros((len(paths), size, size, 3), np.uint8)
+            for i, path in enumerate(paths):
+                img = cv2.imread(path, cv2.IMREAD_COLOR) if path is not None else None
+                if img is not None:
+                    tiles[i] = fit(img, size)
+        else:
+            tiles = np.stack([cv2.resize(tile, (size, size), interpolation = cv2.INTER_AREA) for tile in tiles])
+
+        per_sheet = grid * grid
+        for start in range(0, len(paths), per_sheet):
+            block = tiles[start:start + per_sheet]
+            if len(block) < per_sheet:
+                block = np.concatenate([block, np.zeros((per_sheet - len(block), size, size, 3), np.uint8)])
+            sheet = block.reshape(grid, grid, size, size, 3).transpose(0, 2, 1, 3, 4).reshape(grid * size, grid * size, 3)
+            name = "%d_%d.jpg" % (stream, (first + start) // per_sheet)
+            cv2.imwrite(os.path.join(out, str(level), name), sheet, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return first
+
+
+def build(folders, out, sheet=1024, tile=128, levels=3, workers=None):
+    """Build or update the atlas of paired stream folders; returns the chunks rebuilt."""
+    grids = level_grids(sheet, tile, levels)
+    # a chunk fills exactly one sheet of the smallest level and whole sheets of the others
+    chunk = grids[-1][1] ** 2
+    for level in range(levels):
+        os.makedirs(os.path.join(out, str(level)), exist_ok=True)
+
+    files = [stream_files(folder) for folder in folders]
+    pairs = sorted(set().union(*files))
+
+    old = {}
+    index_path = os.path.join(out, INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            index = json.load(file)
+        if index["grids"] == [list(g) for g in grids] and len(index["streams"]) == len(folders):
+            old = index["stamps"]
+
+    stamps = {}
+    jobs = []
+    with ProcessPoolExecutor(workers) as pool:
+        for first in range(0, len(pairs), chunk):
+            block = pairs[first:first + chunk]
+            for stream, stream_paths in enumerate(files):
+                paths = [stream_paths.get(pair) for pair in block]
+                key = "%d_%d" % (stream, first // chunk)
+                stamps[key] = chunk_stamp(paths)
+                if old.get(key) != stamps[key]:
+                    jobs.append(pool.submit(build_chunk, out, stream, paths, first, grids))
+        for job in jobs:
+            job.result()
+
+    index = {
+        "streams": [os.path.basename(os.path.normpath(folder)) for folder in folders],
+        "pairs": pairs,
+        "grids": grids,
+        "stamps": stamps,
+    }
+    with open(index_path + ".tmp", "w") as file:
+        json.dump(index, file)
+    os.replace(index_path + ".tmp", index_path)
+    return len(jobs)
+
+
+class AtlasViewer:
+    """Pages through an atlas with the streams of each pair side by side."""
+
+    def __init__(self, atlas, window="Session QA"):
+        self.atlas = atlas
+        self.window = window
+        with open(os.path.join(atlas, INDEX)) as file:
+            self.index = json.load(file)
+        self.pairs = self.index["pairs"]
+        self.grids = self.index["grids"]
+        self.streams = len(self.index["streams"])
+        self.level = 0
+        self.page = 0
+        self.sheet = lru_cache(maxsize=64)(self.load_sheet)
+
+    def load_sheet(self, level, stream, page):
+        size, grid = self.grids[level]
+        img = cv2.imread(os.path.join(self.atlas, str(level), "%d_%d.jpg" % (stream, page)), cv2.IMREAD_COLOR)
+        if img is None:
+            img = np.zeros((grid * size, grid * size, 3), np.uint8)
+        return img
+
+    def pages(self, level=None):
+        grid = self.grids[self.level if level is None else level][1]
+        return max(1, -(-len(self.pairs) // (grid * grid)))
+
+    def render(self):
+        """One page: row after row of pairs, every pair's stream tiles next to each other."""
+        size, grid = self.grids[self.level]
+        sheets = np.stack([self.sheet(self.level, stream, self.page) for stream in range(self.streams)])
+        # (streams, rows, size, cols, size, 3) -> (rows, size, cols, streams, size, 3)
+        tiles = sheets.reshape(self.streams, grid, size, grid, size, 3).transpose(1, 2, 3, 0, 4, 5)
+        page = np.ascontiguousarray(tiles.reshape(grid * size, grid * self.streams * size, 3))
+
+        first = self.page * grid * grid
+        if size >= 64:
+            for i, pair in enumerate(self.pairs[first:first + grid * grid]):
+                row, col = divmod(i, grid)
+                origin = (col * self.streams * size + 3, row * size + 14)
+                cv2.putText(page, str(pair), origin, cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
+        return page
+
+    def prefetch(self):
+        """Decode the next page's sheets in the background."""
+        if self.page + 1 < self.pages():
+            for stream in range(self.streams):
+                threading.Thread(target=self.sheet, args=(self.level, stream, self.page + 1), daemon=True).start()
+
+    def show(self):
+        per_page = self.grids[self.level][1] ** 2
+        shown = self.pairs[self.page * per_page:(self.page + 1) * per_page] or [0]
+        cv2.imshow(self.window, self.render())
+        cv2.setWindowTitle(self.window, "{}  pairs {}-{}  page {}/{}  (n/p page, +/- size, q quit)".format(
+            " | ".join(self.index["streams"]), shown[0], shown[-1], self.page + 1, self.pages()))
+        cv2.setTrackbarPos("page", self.window, self.page)
+        self.prefetch()
+
+    def on_trackbar(self, page):
+        if page != self.page:
+            self.goto(page)
+
+    def goto(self, page):
+        self.page = min(max(page, 0), self.pages() - 1)
+        self.show()
+
+    def zoom(self, step):
+        level = min(max(self.level + step, 0), len(self.grids) - 1)
+        if level == self.level:
+            return
+        # stay at the first pair on screen
+        first = self.page * self.grids[self.level][1] ** 2
+        self.level = level
+        cv2.setTrackbarMax("page", self.window, self.pages() - 1)
+        self.goto(first // self.grids[level][1] ** 2)
+
+    def run(self):
+        cv2.namedWindow(self.window, cv2.WINDOW_NORMAL)
+        cv2.createTrackbar("page", self.window, 0, max(self.pages() - 1, 1), self.on_trackbar)
+        self.show()
+        while True:
+            key = cv2.waitKey(50) & 0xFF
+            if key in (ord("q"), 27):
+                break
+            if key in (ord("n"), ord(" ")):
+                self.goto(self.page + 1)
+            elif key in (ord("p"), ord("b")):
+                self.goto(self.page - 1)
+            elif key in (ord("+"), ord("=")):
+                self.zoom(-1)
+            elif key in (ord("-"), ord("_")):
+                self.zoom(1)
+            if cv2.getWindowProperty(self.window, cv2.WND_PROP_VISIBLE) < 1:
+                break
+        cv2.destroyWindow(self.window)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and browse thumbnail atlases of capture sessions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    make = commands.add_parser("build", help="build or update the atlas of paired image folders")
+    make.add_argument("folders", nargs="+", help="one folder per stream, e.g. TIR<date> RGB<date>")
+    make.add_argument("--out", required=True, help="atlas folder")
+    make.add_argument("--sheet", type=int, default=1024, help="sheet side in pixels")
+    make.add_argument("--tile", type=int, default=128, help="largest thumbnail side in pixels")
+    make.add_argument("--levels", type=int, default=3, help="thumbnail sizes, each half the one before")
+    make.add_argument("--workers", type=int, default=None)
+    view = commands.add_parser("view", help="page through an atlas")
+    view.add_argument("atlas")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        try:
+            level_grids(args.sheet, args.tile, args.levels)
+        except ValueError as e:
+            parser.error(str(e))
+        rebuilt = build(args.folders, args.out, args.sheet, args.tile, args.levels, args.workers)
+        print("rebuilt %d chunks" % rebuilt)
+    else:
+        AtlasViewer(args.atlas).run()
+
+
+if __name__ == "__main__":
+    main()
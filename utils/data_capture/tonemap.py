@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Tone mapping of radiometric (thermography_float) TIR frames to images
+#
+# Turns float temperature frames into 8 bit palette images or 16 bit grayscale
+# images with precomputed look up tables, instead of going through matplotlib
+# one frame at a time. Temperatures are quantized to a fixed resolution (0.1 C
+# by default, which is what thermography.py's text dumps hold anyway), so for a
+# fixed range the whole mapping from temperature to colour is one table lookup
+# per pixel. 16 bit output would lose most of its levels to that step, so its
+# table has one entry per output level instead (65536 for any range).
+#
+# Range normalization:
+#   fixed    a given range in C, the same for every frame and session
+#   session  one range for the whole stack, from percentiles of a sample of it
+#   frame    each frame stretched to its own percentiles
+#
+# Batch mode works over memory mapped frame stacks (see framestack.py), e.g.
+#   python tonemap.py render thermography_float.raw outdir --palette inferno --mode session
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from framestack import FrameStackReader
+
+
+def tyrian():
+    """Approximation of Seek's TYRIAN palette: black, purple, magenta, pink, white."""
+    points = np.array([0, 64, 128, 192, 255])
+    colours = np.array([  # RGB
+        [0, 0, 0],
+        [62, 12, 94],
+        [186, 32, 130],
+        [248, 128, 160],
+        [255, 255, 255],
+    ], dtype=np.float64)
+    ramp = np.arange(256)
+    rgb = np.stack([np.interp(ramp, points, colours[:, channel]) for channel in range(3)], axis=1)
+    return np.rint(rgb[:, ::-1]).astype(np.uint8)
+
+
+def palette(name):
+    """(256, 3) BGR look up table for a palette, or (256,) for grayscale ones."""
+    ramp = np.arange(256, dtype=np.uint8)
+    if name == "white_hot":
+        return ramp
+    if name == "black_hot":
+        return ramp[::-1].copy()
+    if name == "inferno":
+        return cv2.applyColorMap(ramp.reshape(-1, 1), cv2.COLORMAP_INFERNO).reshape(256, 3)
+    if name == "tyrian":
+        return tyrian()
+    raise ValueError("unknown palette: " + name)
+
+
+PALETTES = ("white_hot", "black_hot", "inferno", "tyrian")
+
+
+class ToneMapper:
+    """Maps temperature frames to images through precomputed tables.
+
+    Parameters
+    ----------
+    palette_name: str
+        One of PALETTES. Only white_hot and black_hot can be 16 bit.
+    bits: int
+        8 or 16 bits per output channel.
+    resolution: float
+        Temperature step in C the input is quantized to for 8 bit output. 16 bit
+        output uses the range over 65535 instead.
+    """
+
+    def __init__(self, palette_name="white_hot", bits=8, resolution=0.1):
+        if bits == 16 and palette_name not in ("white_hot", "black_hot"):
+            raise ValueError("16 bit output is grayscale only")
+        self.bits = bits
+        self.levels = 1 << bits
+        self.resolution = resolution
+        self.dtype = np.uint16 if bits == 16 else np.uint8
+        if bits == 16:
+            ramp = np.arange(self.levels, dtype=np.uint16)
+            self.colours = ramp if palette_name == "white_hot" else ramp[::-1].copy()
+        else:
+            self.colours = palette(palette_name)
+        self.low = None
+        self.step = None
+        self.lut = None
+
+    def set_range(self, low, high):
+        """Precompute the temperature to colour table for a fixed range."""
+        if self.bits == 16:
+            # one entry per level, so every level of the output is reachable
+            steps = self.levels - 1
+        else:
+            steps = max(int(round((high - low) / self.resolution)), 1)
+        levels = np.rint(np.arange(steps + 1) * ((self.levels - 1) / steps)).astype(np.intp)
+        self.low = low
+        self.step = max(high - low, self.resolution) / steps
+        self.lut = self.colours[levels]
+
+    def map_fixed(self, frames):
+        """Tone map with the range from set_range; any array shape."""
+        index = np.rint((np.asarray(frames, dtype=np.float32) - self.low) * (1.0 / self.step))
+        np.clip(index, 0, len(self.lut) - 1, out=index)
+        return self.lut[index.astype(np.intp)]
+
+    def map_frames(self, frames, percentiles=(1.0, 99.0)):
+        """Tone map a (frames, height, width) batch, each frame to its own range."""
+        frames = np.asarray(frames, dtype=np.float32)
+        low, high = np.percentile(frames.reshape(len(frames), -1), percentiles, axis=1)
+        low = low[:, None, None]
+        span = np.maximum(high - low[:, 0, 0], self.resolution)[:, None, None]
+        index = np.rint((frames - low) * ((self.levels - 1) / span))
+        np.clip(index, 0, self.levels - 1, out=index)
+        return self.colours[index.astype(np.intp)]
+
+
+def session_range(stack, percentiles=(1.0, 99.0), sample=200):
+    """Temperature range of a whole stack from percentiles of evenly spaced frames."""
+    step = max(1, len(stack) // sample)
+    values = np.asarray(stack.frames[::step], dtype=np.float32)
+    low, high = np.percentile(values, percentiles)
+    return float(low), float(high)
+
+
+def render_range(path, outdir, palette_name, bits, mode, value_range, start, stop, batch=64):
+    """Tone map frames start..stop-1 of a stack and save them as <pair>.png."""
+    stack = FrameStackReader(path)
+    mapper = ToneMapper(palette_name, bits)
+    if mode != "frame":
+        mapper.set_range(*value_range)
+
+    for first in range(start, stop, batch):
+        last = min(first + batch, stop)
+        frames = stack.frames[first:last]
+        images = mapper.map_frames(frames) if mode == "frame" else mapper.map_fixed(frames)
+        for offset, img in enumerate(images):
+            cv2.imwrite(os.path.join(outdir, "%d.png" % stack.pairs[first + offset]), img)
+    return stop - start
+
+
+def render(path, outdir, palette_name="white_hot", bits=8, mode="session", value_range=None,
+           workers=None, chunk=512):
+    """Tone map a whole stack on a process pool."""
+    os.makedirs(outdir, exist_ok=True)
+    stack = FrameStackReader(path)
+    if mode == "session":
+        value_range = session_range(stack)
+        print("session range: %.1f C to %.1f C" % value_range)
+    elif mode == "fixed" and value_range is None:
+        raise ValueError("fixed mode needs a range")
+
+    total = len(stack)
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = [pool.submit(render_range, path, outdir, palette_name, bits, mode, value_range,
+                            start, min(start + chunk, total))
+                for start in range(0, total, chunk)]
+        return sum(job.result() for job in jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tone map radiometric TIR frame stacks to images.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("render")
+    run.add_argument("stack", help="thermography_float frame stack (.raw)")
+    run.add_argument("outdir")
+    run.add_argument("--palette", default="white_hot", choices=PALETTES)
+    run.add_argument("--bits", type=int, default=8, choices=(8, 16))
+    run.add_argument("--mode", default="session", choices=("fixed", "session", "frame"))
+    run.add_argument("--range", type=float, nargs=2, default=None, help="low high in C for fixed mode")
+    run.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    count = render(args.stack, args.outdir, args.palette, args.bits, args.mode, args.range, args.workers)
+    print("tone mapped %d frames" % count)
+
+
+if __name__ == "__main__":
+    main()
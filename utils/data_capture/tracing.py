@@ -0,0 +1,146 @@
+# Opt-in timeline tracing of the capture threads, in Chrome trace format
+#
+# The capture scripts split their work between the SDK's callback thread and
+# the OpenCV main thread, which meet at Renderer.frame_condition. To see where
+# either side waits, run a script with TRI2I_TRACE set to an output file:
+#   TRI2I_TRACE=trace.json python combined.py
+# Spans (callback entry, lock wait, frame wait, RGB read, preprocessing,
+# encode, write, ...) are recorded with the id and name of the thread they ran
+# on, and written when the script exits. Open the file in chrome://tracing or
+# https://ui.perfetto.dev.
+#
+# Without TRI2I_TRACE, span() returns one shared do-nothing context manager,
+# locked() returns the lock itself and begin()/end() return at once, so
+# instrumented code costs a function call per span. Only the last MAX_EVENTS
+# spans are kept, so long runs in the field don't grow without bound.
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+PATH = os.environ.get("TRI2I_TRACE")
+ENABLED = bool(PATH)
+MAX_EVENTS = 1_000_000
+
+events = deque(maxlen=MAX_EVENTS)
+threads = {}
+start = time.perf_counter_ns()
+
+
+def now_us():
+    return (time.perf_counter_ns() - start) / 1000.0
+
+
+def record(name, begin, end, args=None):
+    """Record a complete span from begin to end (microseconds) on this thread."""
+    tid = threading.get_ident()
+    if tid not in threads:
+        threads[tid] = threading.current_thread().name
+    event = {"name": name, "ph": "X", "ts": begin, "dur": end - begin, "pid": os.getpid(), "tid": tid}
+    if args:
+        event["args"] = args
+    events.append(event)
+
+
+class Span:
+    """Context manager recording how long its block took."""
+
+    __slots__ = ("name", "args", "begin")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.begin = now_us()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.begin, now_us(), self.args)
+
+
+class NullSpan:
+    """What span() returns while tracing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **args):
+    """Trace the block under ``with span(name):``; extra keyword arguments are shown with it."""
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name, args)
+
+
+def begin():
+    """Start of a span ended with end(); for blocks too long to indent under span()."""
+    return now_us() if ENABLED else 0.0
+
+
+def end(name, began, **args):
+    """Record the span from ``began`` (as returned by begin()) to now."""
+    if ENABLED:
+        record(name, began, now_us(), args)
+
+
+class TracedLock:
+    """Wraps a lock or condition to record the wait to acquire it and the time it is held."""
+
+    def __init__(self, lock, name):
+        self.lock = lock
+        self.name = name
+
+    def __enter__(self):
+        begin = now_us()
+        self.lock.__enter__()
+        self.acquired = now_us()
+        record(self.name + " wait", begin, self.acquired)
+        return self.lock
+
+    def __exit__(self, *exc):
+        record(self.name + " held", self.acquired, now_us())
+        return self.lock.__exit__(*exc)
+
+
+def locked(lock, name):
+    """``with locked(renderer.frame_condition, "main"):`` traces the lock wait and hold times."""
+    if not ENABLED:
+        return lock
+    return TracedLock(lock, name)
+
+
+def instant(name, **args):
+    """Mark a moment, e.g. a camera event."""
+    if not ENABLED:
+        return
+    tid = threading.get_ident()
+    if tid not in threads:
+        threads[tid] = threading.current_thread().name
+    events.append({"name": name, "ph": "i", "s": "t", "ts": now_us(), "pid": os.getpid(), "tid": tid,
+                   "args": args})
+
+
+def save(path=None):
+    """Write the recorded spans as Chrome trace JSON."""
+    path = path or PATH
+    names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+             for tid, name in list(threads.items())]
+    with open(path, "w") as file:
+        json.dump({"traceEvents": names + list(events), "displayTimeUnit": "ms"}, file)
+    print("trace of {} spans written to {}".format(len(events), path))
+
+
+if ENABLED:
+    atexit.register(save)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# Lossless transcoding of archived capture sessions
+#
+# Older sessions hold their full size frames as uncompressed bitmaps, their
+# radiometric data as text and some files under the wrong name. This walks an
+# archive tree and, on a process pool:
+#   N.bmp                  -> N.png, PNG at the highest compression level
+#   N.bmp_G.png, N.bmp.png -> N_G.png, N.png (combinedHDR.py's names, renamed
+#                             as they are, the bytes don't change)
+#   thermography-*.csv     -> thermography-*.raw/.json/.idx.csv, a float32
+#                             frame stack (see framestack.py), the format
+#                             thermography.py writes with THERMOGRAPHY_OUTPUT
+#                             = "stack" and tonemap.py reads
+# The .jpg crops are already lossy and are left as they are.
+#
+# Every new file is written under a temporary name, checked against its source
+# and only then moved into place: images must decode to the same pixels, and a
+# frame stack must print back to the csv byte for byte. The original is kept
+# unless --delete is given, and it is only deleted after that check. One line
+# per file (names, sizes, what was done) goes to <root>/transcode.jsonl, so an
+# interrupted run picks up where it stopped and the byte savings can be totalled
+# at any time:
+#   python transcode.py run D:/captures --delete
+#   python transcode.py report D:/captures
+#
+# Session journals (see journal.py) list the files of every pair; once a file
+# is renamed or its original deleted, its journal entries are pointed at the new
+# name, so a resumed session doesn't take the new files for strays.
+
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import os
+import queue
+import re
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+import cv2
+import numpy as np
+
+from framestack import FrameStackReader, FrameStackWriter, stack_paths
+
+LOG = "transcode.jsonl"
+
+# combinedHDR.py's full size frames, e.g. 12.bmp_0.png and 12.bmp.png
+MISNAMED = re.compile(r"^(\d+)\.bmp((?:_\d+)?)\.png$")
+THERMOGRAPHY = re.compile(r"^thermography-.*(?<!\.idx)\.csv$")
+TEMPORARY = ".tmp"
+
+# thermography_float frames are 240 rows of 320 temperatures
+FRAME_ROWS = 240
+PNG_LEVEL = 9
+
+
+def target_of(name):
+    """(kind, new name) of a file in the archive, or None if it stays as it is."""
+    if TEMPORARY in name:
+        return None
+    misnamed = MISNAMED.match(name)
+    if misnamed:
+        return "rename", misnamed.group(1) + misnamed.group(2) + ".png"
+    if name.lower().endswith(".bmp"):
+        return "bmp", name[:-4] + ".png"
+    if THERMOGRAPHY.match(name):
+        return "csv", name[:-4] + ".raw"
+    return None
+
+
+def scan(root):
+    """(jobs, kept) for the archive under root.
+
+    jobs are (kind, source, target) relative paths, kept counts the files and
+    bytes of the .jpg files left as they are.
+    """
+    jobs = []
+    kept = [0, 0]
+    for folder, _, names in os.walk(root):
+        for name in sorted(names):
+            path = os.path.join(folder, name)
+            found = target_of(name)
+            if found is not None:
+                kind, target = found
+                jobs.append((kind, os.path.relpath(path, root), os.path.relpath(os.path.join(folder, target), root)))
+            elif name.lower().endswith((".jpg", ".jpeg")):
+                kept[0] += 1
+                kept[1] += os.path.getsize(path)
+    return jobs, kept
+
+
+def load_log(root):
+    """The latest record of every source in root's log."""
+    records = {}
+    path = os.path.join(root, LOG)
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash, the file is simply done again
+                    continue
+                records[record["source"]] = record
+    return records
+
+
+def same_pixels(source, target):
+    a = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+    b = cv2.imread(target, cv2.IMREAD_UNCHANGED)
+    return a is not None and b is not None and a.dtype == b.dtype and np.array_equal(a, b)
+
+
+def newline_of(path):
+    with open(path, "rb") as file:
+        return b"\r\n" if file.readline().endswith(b"\r\n") else b"\n"
+
+
+def csv_to_stack(source, target, rows):
+    """Parse thermography.py's text dump into a frame stack, ``rows`` lines per frame."""
+    with open(source) as file, FrameStackWriter(target) as stack:
+        while True:
+            lines = list(islice(file, rows))
+            if not lines:
+                break
+            if len(lines) < rows:
+                raise ValueError("%s ends with %d of %d rows of a frame" % (source, len(lines), rows))
+            # the csv holds no pair numbers or times; frame N went with N.png
+            stack.write(np.loadtxt(lines, dtype=np.float32, ndmin=2), stack.count + 1, 0.0)
+
+
+def same_text(source, target):
+    """Whether the frame stack prints back to exactly the bytes of the csv."""
+    stack = FrameStackReader(target)
+    newline = newline_of(source).decode()
+    text = io.StringIO()
+    with open(source, "rb") as file:
+        for frame in stack.frames:
+            text.seek(0)
+            text.truncate()
+            np.savetxt(text, frame, fmt="%.1f", newline=newline)
+            printed = text.getvalue().encode()
+            if file.read(len(printed)) != printed:
+                return False
+        return file.read(1) == b""
+
+
+def stack_size(target):
+    return sum(os.path.getsize(path) for path in stack_paths(target))
+
+
+def move_stack(temporary, target):
+    # the data file goes last, it is what marks the stack as there
+    for old, new in reversed(list(zip(stack_paths(temporary), stack_paths(target)))):
+        os.replace(old, new)
+
+
+def transcode(root, kind, source, target, delete, rows=FRAME_ROWS, level=PNG_LEVEL):
+    """Transcode one file and check the result; returns its log record.
+
+    A target that is already there (left by an interrupted run, or the original
+    of a name clash) is checked against the source instead of written again,
+    and the source is left alone if they differ.
+    """
+    record = {"source": source, "target": target, "kind": kind}
+    source = os.path.join(root, source)
+    target = os.path.join(root, target)
+    try:
+        record["bytes_in"] = os.path.getsize(source)
+        if kind == "rename":
+            if os.path.exists(target):
+                record["status"] = "clash"
+                return record
+            os.rename(source, target)
+            record.update(status="done", bytes_out=record["bytes_in"], deleted=True)
+            return record
+
+        existed = os.path.exists(target)
+        if not existed:
+            temporary = target + TEMPORARY if kind == "bmp" else target[:-4] + TEMPORARY
+            if kind == "bmp":
+                img = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+                ok, buffer = (False, None) if img is None else cv2.imencode(
+                    ".png", img, [cv2.IMWRITE_PNG_COMPRESSION, level])
+                if not ok:
+                    record["status"] = "unreadable"
+                    return record
+                with open(temporary, "wb") as file:
+                    file.write(buffer)
+            else:
+                csv_to_stack(source, temporary, rows)
+
+        check = target if existed else temporary
+        if not (same_pixels(source, check) if kind == "bmp" else same_text(source, check)):
+            record["status"] = "clash" if existed else "mismatch"
+            if not existed:
+                for path in [temporary] if kind == "bmp" else stack_paths(temporary):
+                    os.remove(path)
+            return record
+        if not existed:
+            if kind == "bmp":
+                os.replace(temporary, target)
+            else:
+                move_stack(temporary, target)
+
+        record["bytes_out"] = os.path.getsize(target) if kind == "bmp" else stack_size(target)
+        record["status"] = "done"
+        record["deleted"] = delete
+        if delete:
+            os.remove(source)
+    except Exception as e:
+        # cv2.error from a codec, a damaged stack left over as the target, ...:
+        # this file failed, the others of its chunk still go ahead
+        record["status"] = "error"
+        record["error"] = "%s: %s" % (type(e).__name__, e)
+    return record
+
+
+def transcode_chunk(root, jobs, delete, rows, level, records):
+    """Transcode a chunk of jobs, putting each record on the ``records`` queue
+    as soon as it is done, so a deleted original is logged even if a later
+    file of the chunk takes the worker down."""
+    for kind, source, target in jobs:
+        records.put(transcode(root, kind, source, target, delete, rows, level))
+
+
+def update_journals(root, moved):
+    """Point session journal entries at files that moved; returns how many journals changed.
+
+    ``moved`` maps absolute old paths to absolute new ones. Journal paths are
+    relative to the folder the capture ran in, the journal's own folder or the
+    one above it.
+    """
+    moved = {os.path.normcase(old): new for old, new in moved.items()}
+    changed = 0
+    for path in glob.glob(os.path.join(root, "**", "journal*.jsonl"), recursive=True):
+        folders = [os.path.dirname(os.path.abspath(path))]
+        folders.append(os.path.dirname(folders[0]))
+        lines = []
+        edited = False
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    lines.append(line)
+                    continue
+                files = record.get("files")
+                for i, name in enumerate(files or ()):
+                    for folder in folders:
+                        new = moved.get(os.path.normcase(os.path.join(folder, name)))
+                        if new is not None:
+                            files[i] = os.path.relpath(new, folder) if not os.path.isabs(name) else new
+                            edited = True
+                            break
+                lines.append(json.dumps(record) + "\n")
+        if edited:
+            with open(path + TEMPORARY, "w") as file:
+                file.writelines(lines)
+            os.replace(path + TEMPORARY, path)
+            changed += 1
+    return changed
+
+
+def totals(records):
+    """Files, bytes in and bytes out of the finished records, per kind."""
+    sums = {}
+    for record in records:
+        if record.get("status") == "done":
+            counts = sums.setdefault(record["kind"], [0, 0, 0])
+            counts[0] += 1
+            counts[1] += record["bytes_in"]
+            counts[2] += record["bytes_out"]
+    return sums
+
+
+def report(records, kept=None):
+    for kind, (files, before, after) in sorted(totals(records).items()):
+        print("%-6s %8d files %10.1f MB -> %10.1f MB  saved %.1f MB (%.0f%%)" % (
+            kind, files, before / 1e6, after / 1e6, (before - after) / 1e6,
+            100.0 * (before - after) / max(before, 1)))
+    problems = [record for record in records if record.get("status") != "done"]
+    for record in problems:
+        print("%s: %s %s" % (record["status"], record["source"], record.get("error", "")))
+    if kept:
+        print("jpg    %8d files %10.1f MB kept as they are" % (kept[0], kept[1] / 1e6))
+
+
+def run(root, delete=False, workers=None, rows=FRAME_ROWS, level=PNG_LEVEL, chunk=64):
+    """Transcode everything under root that isn't done yet; returns the log records."""
+    jobs, kept = scan(root)
+    records = load_log(root)
+    todo = [job for job in jobs
+            if records.get(job[1], {}).get("status") != "done" or (delete and not records[job[1]].get("deleted"))]
+    print("%d files to do, %d done before" % (len(todo), len(jobs) - len(todo)))
+
+    # the text dumps take longest, they go first and one per task
+    chunks = [[job] for job in todo if job[0] == "csv"]
+    images = [job for job in todo if job[0] != "csv"]
+    chunks += [images[i:i + chunk] for i in range(0, len(images), chunk)]
+
+    def logged(record):
+        records[record["source"]] = record
+        log.write(json.dumps(record) + "\n")
+        log.flush()
+
+    finished = 0
+    with open(os.path.join(root, LOG), "a") as log, multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(workers) as pool:
+        produced = manager.Queue()
+        pending = {pool.submit(transcode_chunk, root, block, delete, rows, level, produced) for block in chunks}
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            while True:
+                try:
+                    logged(produced.get_nowait())
+                except queue.Empty:
+                    break
+            for task in done:
+                try:
+                    task.result()
+                except Exception as e:
+                    # a worker that died; its files that weren't logged are done next run
+                    print("a chunk failed: %s: %s" % (type(e).__name__, e))
+                finished += 1
+                if finished % 100 == 0:
+                    print("%d/%d chunks" % (finished, len(chunks)))
+        while True:
+            try:
+                logged(produced.get_nowait())
+            except queue.Empty:
+                break
+
+    # journals list images only, never the thermography text dumps
+    moved = {os.path.abspath(os.path.join(root, record["source"])): os.path.abspath(os.path.join(root, record["target"]))
+             for record in records.values() if record.get("deleted") and record["kind"] != "csv"}
+    changed = update_journals(root, moved)
+    if changed:
+        print("updated %d session journals" % changed)
+    report(list(records.values()), kept)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcode archived capture sessions to lossless compact formats.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    transcoding = commands.add_parser("run", help="transcode, check and optionally delete the originals")
+    transcoding.add_argument("root", help="archive folder, searched recursively")
+    transcoding.add_argument("--delete", action="store_true", help="delete each original once its new file checks out")
+    transcoding.add_argument("--frame-rows", type=int, default=FRAME_ROWS, help="csv rows per thermography frame")
+    transcoding.add_argument("--level", type=int, default=PNG_LEVEL, help="PNG compression level, 0-9")
+    transcoding.add_argument("--workers", type=int, default=None)
+    totalling = commands.add_parser("report", help="total the savings recorded in the log")
+    totalling.add_argument("root")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args.root, args.delete, args.workers, args.frame_rows, args.level)
+    else:
+        report(list(load_log(args.root).values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# This captures radiometric, corrected and AGC data from the SeekThermal camera
+# in a single capture session, so every modality comes from the same instant.
+# Before, each needed its own script and its own session:
+#   thermography.py  -> THERMOGRAPHY_FLOAT (temperatures)
+#   correctedTIR.py  -> CORRECTED (flat field, gain/offset and bad pixel corrected)
+#   combined.py      -> COLOR_ARGB8888 (AGC images)
+#
+# One capture session is started with all the formats or'ed together and one
+# frame callback fans every SeekCameraFrame out to a sink per format. All sinks
+# get the same frame number and timestamp. The callback only copies the frame
+# data out of the SDK buffers (which are reused once it returns) and queues it;
+# a writer thread appends the radiometric and corrected frames to frame stacks
+# (see framestack.py) and encodes the AGC frames, converted from BGRA to BGR,
+# so the SDK is never held up by the disk or the encoder. Optionally an RGB
+# webcam frame is grabbed per frame, on a thread of its own.
+#
+# As a note, this requires the seekcamera.dll file provided in the seek thermal programming kit
+
+from time import sleep
+from functools import reduce
+import operator
+import os
+import queue
+import threading
+import time
+
+import cv2
+from datetime import datetime
+
+from seekcamera import (
+    SeekCameraIOType,
+    SeekCameraColorPalette,
+    SeekCameraManager,
+    SeekCameraManagerEvent,
+    SeekCameraFrameFormat,
+)
+
+from framestack import FrameStackWriter
+from rgbgrab import RgbGrabber, open_camera
+from sessionstats import SessionStats
+from startup import milestone
+from videostore import VideoStreamWriter
+
+# Formats to capture, as attribute names of SeekCameraFrame. Add "pre_agc" to
+# also record the 16 bit frames before AGC, for rendering with agc.py.
+FORMATS = ("thermography_float", "corrected", "color_argb8888")
+
+FRAME_FORMATS = {
+    "thermography_float": SeekCameraFrameFormat.THERMOGRAPHY_FLOAT,
+    "corrected": SeekCameraFrameFormat.CORRECTED,
+    "pre_agc": SeekCameraFrameFormat.PRE_AGC,
+    "color_argb8888": SeekCameraFrameFormat.COLOR_ARGB8888,
+}
+
+# AGC images go to a lossless "video" (see videostore.py) or to "images" (pngs)
+AGC_OUTPUT = "video"
+
+# pre-AGC frames go to "images" (lossless 16 bit pngs, which agc.py renders from
+# the folder) or to an uncompressed frame "stack"
+PRE_AGC_OUTPUT = "images"
+
+# webcam index to grab an RGB frame with every TIR frame, None for TIR only
+RGB_CAMERA = None
+
+# webcam mode, a name in rgbgrab.PROFILES or a dict of the same keys
+RGB_PROFILE = "default"
+
+# frames waiting for the writer threads before new ones are dropped, about
+# two seconds of capture
+WRITE_QUEUE = 64
+
+# keep running statistics of every camera stream in stats.json (see sessionstats.py)
+STATS = True
+
+
+class StackSink:
+    """Appends the frame data to a frame stack."""
+
+    def __init__(self, path):
+        self.stack = FrameStackWriter(path)
+
+    def write(self, number, timestamp, data):
+        return self.stack.write(data, number, timestamp)
+
+    def close(self):
+        self.stack.close()
+
+
+class VideoSink:
+    """Encodes AGC frames into a lossless video."""
+
+    def __init__(self, path):
+        self.video = VideoStreamWriter(path)
+
+    def write(self, number, timestamp, data):
+        return self.video.write(data, number, timestamp)
+
+    def close(self):
+        self.video.close()
+
+
+class ImageSink:
+    """Saves every frame as <number>.png in a folder."""
+
+    def __init__(self, path):
+        os.mkdir(path)
+        self.path = path
+
+    def write(self, number, timestamp, data):
+        return cv2.imwrite(os.path.join(self.path, str(number) + ".png"), data)
+
+    def close(self):
+        return
+
+
+class RGBSink:
+    """Grabs a webcam frame for every TIR frame and saves it as <number>.png."""
+
+    def __init__(self, path, camera):
+        os.mkdir(path)
+        self.path = path
+        self.camera = RgbGrabber(open_camera(camera, RGB_PROFILE))
+
+    def write(self, number, timestamp, data):
+        ret, img = self.camera.read()
+        if not ret:
+            return False
+        return cv2.imwrite(os.path.join(self.path, str(number) + ".png"), img)
+
+    def close(self):
+        self.camera.release()
+
+
+class SinkWriter:
+    """Writes queued frames to sinks on a thread of its own.
+
+    put() never blocks: when the thread falls WRITE_QUEUE frames behind, the
+    frame is dropped and counted in ``dropped``.
+
+    Parameters
+    ----------
+    sinks: List[Tuple[Optional[str], sink]]
+        The sinks, keyed by the SeekCameraFrame attribute they take.
+    stats: Optional[SessionStats]
+        Updated with every frame written, only from this thread.
+    """
+
+    def __init__(self, sinks, stats=None):
+        self.sinks = sinks
+        self.stats = stats
+        self.dropped = 0
+        self.queue = queue.Queue(WRITE_QUEUE)
+        self.thread = threading.Thread(target=self.run, name="sink-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, number, timestamp, frames):
+        try:
+            self.queue.put_nowait((number, timestamp, frames))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            number, timestamp, frames = item
+            for name, sink in self.sinks:
+                data = frames.get(name)
+                try:
+                    ok = sink.write(number, timestamp, data)
+                except OSError as e:
+                    # e.g. a full disk, the next frame is tried all the same
+                    print("{}: {}".format(name, e))
+                    ok = False
+                if not ok:
+                    print("failed to write frame {} to {}".format(number, name))
+                elif self.stats is not None and name is not None:
+                    self.stats.update(name, data, radiometric=name == "thermography_float")
+            milestone("first frame saved")
+
+    def close(self):
+        """Write what is still queued, then close the sinks."""
+        self.queue.put(None)
+        self.thread.join()
+        for _, sink in self.sinks:
+            sink.close()
+
+
+class Session:
+    """All sinks of one capture, keyed by the SeekCameraFrame attribute they take."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.stats = SessionStats(path)
+
+        sinks = []
+        for name in FORMATS:
+            if name == "color_argb8888":
+                if AGC_OUTPUT == "video":
+                    sink = VideoSink(os.path.join(path, "agc"))
+                else:
+                    sink = ImageSink(os.path.join(path, "agc"))
+            elif name == "pre_agc" and PRE_AGC_OUTPUT == "images":
+                sink = ImageSink(os.path.join(path, name))
+            else:
+                sink = StackSink(os.path.join(path, name))
+            sinks.append((name, sink))
+        self.writers = [SinkWriter(sinks, self.stats if STATS else None)]
+
+        if RGB_CAMERA is not None:
+            # attribute None: the sink doesn't take any of the camera's data.
+            # Its own writer, so the webcam read isn't held up by the encoding
+            self.writers.append(SinkWriter([(None, RGBSink(os.path.join(path, "rgb"), RGB_CAMERA))]))
+
+    def frame_format(self):
+        """All requested formats or'ed together for capture_session_start."""
+        return reduce(operator.or_, (FRAME_FORMATS[name] for name in FORMATS))
+
+    def dropped(self):
+        """Frames the writers were too far behind to take."""
+        return max(writer.dropped for writer in self.writers)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+        if STATS:
+            self.stats.save()
+
+
+def frame_timestamp(camera_frame):
+    """Capture time of a frame in seconds, from the frame header if available."""
+    try:
+        return getattr(camera_frame, FORMATS[0]).header.timestamp_utc_ns / 1e9
+    except AttributeError:
+        return time.time()
+
+
+def on_frame(_camera, camera_frame, session):
+    """Async callback fired whenever a new frame is available.
+
+    Parameters
+    ----------
+    _camera: SeekCamera
+        Reference to the camera for which the new frame is available.
+    camera_frame: SeekCameraFrame
+        Reference to the class encapsulating the new frame in all the
+        formats the session was started with.
+    session: Session
+        User defined data passed to the callback. This can be anything
+        but in this case it is the session holding the sinks.
+    """
+    session.count += 1
+    timestamp = frame_timestamp(camera_frame)
+
+    frames = {name: getattr(camera_frame, name).data.copy() for name in FORMATS}
+    for writer in session.writers:
+        writer.put(session.count, timestamp, frames)
+
+
+def on_event(camera, event_type, event_status, session):
+    """Async callback fired whenever a camera event occurs.
+
+    Parameters
+    ----------
+    camera: SeekCamera
+        Reference to the camera on which an event occurred.
+    event_type: SeekCameraManagerEvent
+        Enumerated type indicating the type of event that occurred.
+    event_status: Optional[SeekCameraError]
+        Optional exception type. It will be a non-None derived instance of
+        SeekCameraError if the event_type is SeekCameraManagerEvent.ERROR.
+    session: Session
+        User defined data passed to the callback. This can be anything
+        but in this case it is the session holding the sinks.
+    """
+    print("{}: {}".format(str(event_type), camera.chipid))
+
+    if event_type == SeekCameraManagerEvent.CONNECT:
+        milestone("thermal camera connected")
+        camera.color_palette = SeekCameraColorPalette.WHITE_HOT
+
+        # Start streaming data in every format at once and provide a custom
+        # callback to be called every time a new frame is received.
+        camera.register_frame_available_callback(on_frame, session)
+        camera.capture_session_start(session.frame_format())
+
+    elif event_type == SeekCameraManagerEvent.DISCONNECT:
+        camera.capture_session_stop()
+
+    elif event_type == SeekCameraManagerEvent.ERROR:
+        print("{}: {}".format(str(event_status), camera.chipid))
+
+    elif event_type == SeekCameraManagerEvent.READY_TO_PAIR:
+        return
+
+
+def main():
+    # Make sure that seekcamera.dll is in the current working directory of this project.
+    # Also make sure you have installed the Seek Camera SDK
+    cwd = os.getcwd()
+    os.environ["SEEKTHERMAL_LIB_DIR"] = cwd
+
+    # Set up folder to save new capture data in
+    now = datetime.now()
+    date_time = now.strftime("%Y%m%d%H%M")
+    filepath = os.path.join(cwd, "unified" + date_time)
+    os.mkdir(filepath)
+    print("saving to: " + filepath)
+
+    session = Session(filepath)
+
+    # Create a context structure responsible for managing all connected USB cameras.
+    # Cameras with other IO types can be managed by using a bitwise or of the
+    # SeekCameraIOType enum cases.
+    try:
+        with SeekCameraManager(SeekCameraIOType.USB) as manager:
+            # Start listening for events.
+            manager.register_event_callback(on_event, session)
+
+            while True:
+                sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()
+        print("{} frames captured, {} dropped while writing".format(session.count, session.dropped()))
+
+
+if __name__ == "__main__":
+    main()
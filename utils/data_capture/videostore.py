@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Lossless video container output for capture sessions
+#
+# Instead of writing one PNG/BMP per frame, each stream (TIR, RGB, ...) is
+# encoded into a single FFV1 video in an MKV container, which is lossless and
+# intra-only, so any frame can be decoded on its own. A sidecar csv next to the
+# video maps frame index to pair number and capture time, so frames can still
+# be looked up by the pair numbers used everywhere else.
+#
+# The capture scripts use this when OUTPUT_MODE is set to "video". To get
+# individual images back out of a session:
+#   python videostore.py export TIR202408181354.mkv outdir [--start N --stop M]
+#
+# Note: the TIR frames come from the camera as 4 channel ARGB with a constant
+# alpha channel, which is dropped before encoding; nothing else is lost.
+
+import argparse
+import csv
+import os
+import time
+
+import cv2
+
+FOURCC = "FFV1"
+EXTENSION = ".mkv"
+
+
+def index_path(video_path):
+    """Path of the frame index sidecar belonging to a video."""
+    return os.path.splitext(video_path)[0] + ".idx.csv"
+
+
+class VideoStreamWriter:
+    """Appends frames of one stream to a lossless video plus frame index.
+
+    The video is opened on the first frame so its size and colour mode
+    follow whatever the capture loop produces.
+    """
+
+    def __init__(self, path, fps=27.0, flush_every=100):
+        if not path.endswith(EXTENSION):
+            path += EXTENSION
+        self.path = path
+        self.fps = fps
+        self.flush_every = flush_every
+        self.writer = None
+        self.count = 0
+        self.index_file = open(index_path(path), "w", newline="")
+        self.index = csv.writer(self.index_file)
+        self.index.writerow(["frame", "pair", "timestamp", "channels"])
+
+    def write(self, img, pair=None, timestamp=None):
+        """Encode one frame.
+
+        Parameters
+        ----------
+        img: np.ndarray
+            HxW grayscale, HxWx3 BGR or HxWx4 BGRA image (alpha is dropped).
+        pair: Optional[int]
+            Pair number to record for this frame, the frame index if None.
+        timestamp: Optional[float]
+            Capture time in seconds since the epoch, now if None.
+        """
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        channels = img.shape[2] if img.ndim == 3 else 1
+
+        if self.writer is None:
+            height, width = img.shape[:2]
+            self.writer = cv2.VideoWriter(
+                self.path, cv2.VideoWriter_fourcc(*FOURCC), self.fps,
+                (width, height), img.ndim == 3,
+            )
+            if not self.writer.isOpened():
+                raise OSError("could not open video writer for " + self.path)
+
+        self.writer.write(img)
+        self.index.writerow([
+            self.count,
+            self.count if pair is None else pair,
+            "%.6f" % (time.time() if timestamp is None else timestamp),
+            channels,
+        ])
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.index_file.flush()
+        return True
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class VideoStreamReader:
+    """Random access to frames of a video written by VideoStreamWriter."""
+
+    def __init__(self, path):
+        self.path = path
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise OSError("could not open " + path)
+        self.position = 0
+
+        self.pairs = []
+        self.timestamps = []
+        self.grayscale = False
+        if os.path.exists(index_path(path)):
+            with open(index_path(path), newline="") as file:
+                for row in csv.DictReader(file):
+                    self.pairs.append(int(row["pair"]))
+                    self.timestamps.append(float(row["timestamp"]))
+                    self.grayscale = row["channels"] == "1"
+        self.frame_of_pair = {pair: frame for frame, pair in enumerate(self.pairs)}
+
+    def __len__(self):
+        if self.pairs:
+            return len(self.pairs)
+        return int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def read(self, frame):
+        """Decode frame number ``frame`` (0 based)."""
+        if frame != self.position:
+            # FFV1 frames are all key frames, so this seek is exact and cheap
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        ok, img = self.capture.read()
+        if not ok:
+            raise IndexError("frame %d out of range for %s" % (frame, self.path))
+        self.position = frame + 1
+
+        # grayscale streams are stored as gray but always decoded as BGR
+        if self.grayscale:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+
+    def read_pair(self, pair):
+        """Decode the frame recorded for pair number ``pair``."""
+        return self.read(self.frame_of_pair[pair])
+
+    def __iter__(self):
+        for frame in range(len(self)):
+            yield self.read(frame)
+
+    def close(self):
+        self.capture.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or export a lossless capture video.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    info = commands.add_parser("info", help="print frame count and pair range")
+    info.add_argument("video")
+    export = commands.add_parser("export", help="write frames back out as png files named by pair")
+    export.add_argument("video")
+    export.add_argument("outdir")
+    export.add_argument("--start", type=int, default=0, help="first frame to export")
+    export.add_argument("--stop", type=int, default=None, help="frame to stop before")
+    args = parser.parse_args()
+
+    with VideoStreamReader(args.video) as reader:
+        if args.command == "info":
+            print("%s: %d frames" % (args.video, len(reader)))
+            if reader.pairs:
+                print("pairs %d to %d" % (min(reader.pairs), max(reader.pairs)))
+            return
+
+        os.makedirs(args.outdir, exist_ok=True)
+        stop = len(reader) if args.stop is None else min(args.stop, len(reader))
+        for frame in range(args.start, stop):
+            pair = reader.pairs[frame] if reader.pairs else frame
+            cv2.imwrite(os.path.join(args.outdir, str(pair) + ".png"), reader.read(frame))
+
+
+if __name__ == "__main__":
+    main()
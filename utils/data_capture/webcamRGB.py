@@ -4,52 +4,120 @@ import cv2
 
 from datetime import datetime
 
-print(cv2.getBuildInformation())
-
-# Set up folder to save new capture data in
-now = datetime.now()
-date_time = now.strftime("%Y%m%d%H%M")
-dirname = "webcamRGB" + date_time
-filepath = os.path.join(os.getcwd(),dirname)
-os.mkdir(filepath)
-print("saving images to: " + filepath)
-os.chdir(filepath)
-
-cam_port = 0
-camera = cv2.VideoCapture(cam_port)
-
-count = 1
-first = True
-
-# Set up display
-window_name = "Webcam Capture"
-cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
-
-while True:
-    result, img = camera.read()
-    img = img[0:480, 0:480]
-
-    if result:
-        #resize window to image
-        if first:
-            (height, width, _) = img.shape
-            cv2.resizeWindow(window_name, width * 2, height * 2)
-            first == False
-        
-        #show image in window
-        cv2.imshow(window_name, img)
-
-        name = str(count) + ".png"#note--change filetype to option
-        cv2.imwrite(name, img)
-        count+=1
-
-        # Process key events.
-        key = cv2.waitKey(1)
-        if key == ord("q"):
-            break
-
-        # Check if the window has been closed manually.
-        if not cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE):
-            break
-
-cv2.destroyWindow(window_name)
\ No newline at end of file
+from mjpeg import MjpegWriter, is_jpeg, open_raw_capture
+from rgbgrab import open_camera
+from startup import milestone
+
+# RAW_CAPTURE asks the webcam for MJPEG and stores the compressed frames as they
+# arrive, with timestamps, in one .mjpeg file (see mjpeg.py). The crop is done
+# afterwards with: python mjpeg.py process <file> <outdir> --transform webcam
+RAW_CAPTURE = False
+PREVIEW_EVERY = 30
+
+# RGB_PROFILE sets the webcam's resolution, fps, pixel format and driver buffer
+# size (see rgbgrab.py). Only every SAVE_EVERY-th frame is decoded and saved,
+# the others are just grabbed from the driver.
+RGB_PROFILE = "default"
+SAVE_EVERY = 1
+
+# the full OpenCV build report is long and slow to print; turn on to check the
+# video backends when a webcam won't open
+SHOW_BUILD_INFO = False
+
+
+def main():
+    if SHOW_BUILD_INFO:
+        print(cv2.getBuildInformation())
+
+    # Set up folder to save new capture data in
+    now = datetime.now()
+    date_time = now.strftime("%Y%m%d%H%M")
+    dirname = "webcamRGB" + date_time
+    filepath = os.path.join(os.getcwd(),dirname)
+    os.mkdir(filepath)
+    print("saving images to: " + filepath)
+    os.chdir(filepath)
+
+    cam_port = 0
+    if RAW_CAPTURE:
+        camera, _ = open_raw_capture(cam_port)
+        stream = MjpegWriter(os.path.join(filepath, "RGB" + date_time))
+    else:
+        camera = open_camera(cam_port, RGB_PROFILE)
+    milestone("rgb camera open")
+
+    count = 1
+    grabs = 0
+    first = True
+
+    # Set up display
+    window_name = "Webcam Capture"
+    cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+
+    if RAW_CAPTURE:
+        while True:
+            result, buf = camera.read()
+
+            if result:
+                stream.write(buf, count)
+                milestone("first frame saved")
+                count+=1
+
+                # decoding is exactly what raw mode saves, so only preview now and then
+                if count % PREVIEW_EVERY == 0:
+                    img = cv2.imdecode(buf.reshape(-1), cv2.IMREAD_REDUCED_COLOR_2) if is_jpeg(buf) else buf
+                    if img is not None:
+                        cv2.imshow(window_name, img)
+
+            # Process key events, also after a failed read so an unplugged
+            # camera can still be quit
+            key = cv2.waitKey(1)
+            if key == ord("q"):
+                break
+
+            # Check if the window has been closed manually.
+            if not cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE):
+                break
+
+        stream.close()
+    else:
+        while True:
+            result = camera.grab()
+            grabs += 1
+
+            retrieved = False
+            if result and grabs % SAVE_EVERY == 0:
+                retrieved, img = camera.retrieve()
+
+            if retrieved:
+                img = img[0:480, 0:480]
+
+                #resize window to image
+                if first:
+                    (height, width, _) = img.shape
+                    cv2.resizeWindow(window_name, width * 2, height * 2)
+                    first == False
+
+                #show image in window
+                cv2.imshow(window_name, img)
+
+                name = str(count) + ".png"#note--change filetype to option
+                cv2.imwrite(name, img)
+                milestone("first frame saved")
+                count+=1
+
+            # Process key events, also after a failed grab so an unplugged
+            # camera can still be quit
+            key = cv2.waitKey(1)
+            if key == ord("q"):
+                break
+
+            # Check if the window has been closed manually.
+            if not cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE):
+                break
+
+    cv2.destroyWindow(window_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# Sharded pix2pix / CycleGAN evaluation over a Slurm job array
+#
+# test.slurm runs test.py on the whole test set on one GPU, and scoring ran
+# afterwards on one machine. This splits the test set into shards, one per
+# array task. Each task runs test.py on its shard and scores its results
+# (SSIM, PSNR and, with pyssim installed, CW-SSIM). A merge job runs once all
+# tasks are done and reduces the partial scores into the final csv and
+# statistics.
+#
+#   python eval_array.py submit --workdir $WORK --dataroot $DATADIR --repo $PIX2PIX \
+#       --name ab_night --shards 16 -- --direction AtoB --model pix2pix
+#
+# Sharding is deterministic: the sorted test images are cut into contiguous
+# ranges, so rerunning a failed task redoes exactly the same images:
+#   python eval_array.py run --workdir $WORK --task 3
+#
+# The steps can also be run by hand (plan, run per task, merge), and
+# fake_sbatch.py runs the array as local subprocesses to try it without a cluster:
+#   python eval_array.py submit ... --sbatch "python fake_sbatch.py" --modules
+#
+# Work folder layout:
+#   plan.json               shards, images per shard, test.py arguments
+#   shard_<k>/data/test/    links to the shard's test images (a dataroot for test.py)
+#   shard_<k>/results/      test.py's results
+#   shard_<k>/scores.csv    number,ssim,psnr[,cw_ssim] of the shard
+#   scores.csv, summary.json  merged results
+
+import argparse
+import csv
+import json
+import os
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "analysis_utils"))
+
+from image_metrics import FAKE_SUFFIX, REAL_SUFFIX, has_cw_ssim, score_pair  # noqa: E402
+from watch_results import summarize  # noqa: E402
+
+PLAN = "plan.json"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+ARRAY_SCRIPT = """#!/bin/bash
+#SBATCH --time={time}
+#SBATCH --nodes=1
+#SBATCH --account={account}
+#SBATCH --partition={partition}
+#SBATCH -o {workdir}/slurm-%A_%a.out
+#SBATCH --job-name={name}_eval
+#SBATCH --mem=0
+#SBATCH --gres=gpu:1
+
+{modules}
+python {script} run --workdir {workdir} --task $SLURM_ARRAY_TASK_ID --workers {workers}
+"""
+
+MERGE_SCRIPT = """#!/bin/bash
+#SBATCH --time=1:00:00
+#SBATCH --nodes=1
+#SBATCH --account={account}
+#SBATCH --partition={partition}
+#SBATCH -o {workdir}/slurm-merge-%j.out
+#SBATCH --job-name={name}_merge
+
+{modules}
+python {script} merge --workdir {workdir}{store}
+"""
+
+
+def shard_path(workdir, task):
+    return os.path.join(workdir, "shard_%d" % task)
+
+
+def results_folder(phase, test_args):
+    """Folder test.py writes its images to, <phase>_<epoch>[_iter<n>], as
+    set by the --epoch and --load_iter it was given."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--epoch", default="latest")
+    parser.add_argument("--load_iter", type=int, default=0)
+    known, _ = parser.parse_known_args(test_args)
+    folder = "%s_%s" % (phase, known.epoch)
+    if known.load_iter > 0:
+        folder += "_iter%d" % known.load_iter
+    return folder
+
+
+def shard_ranges(count, shards):
+    """Contiguous [start, stop) ranges cutting ``count`` items into ``shards`` nearly equal shards."""
+    return [(count * k // shards, count * (k + 1) // shards) for k in range(shards)]
+
+
+def plan(workdir, dataroot, repo, name, shards, test_args, phase="test"):
+    """Split the test images into shards and write plan.json."""
+    source = os.path.join(dataroot, phase)
+    images = sorted(name for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS))
+    if not images:
+        raise ValueError("no test images in " + source)
+    shards = min(shards, len(images))
+
+    os.makedirs(workdir, exist_ok=True)
+    ranges = shard_ranges(len(images), shards)
+    for task, (start, stop) in enumerate(ranges):
+        folder = os.path.join(shard_path(workdir, task), "data", phase)
+        os.makedirs(folder, exist_ok=True)
+        for image in images[start:stop]:
+            link = os.path.join(folder, image)
+            if not os.path.lexists(link):
+                os.symlink(os.path.abspath(os.path.join(source, image)), link)
+
+    info = {
+        "dataroot": os.path.abspath(dataroot),
+        "repo": os.path.abspath(repo),
+        "name": name,
+        "phase": phase,
+        "test_args": list(test_args),
+        "images": len(images),
+        "shards": [{"start": start, "stop": stop} for start, stop in ranges],
+    }
+    with open(os.path.join(workdir, PLAN), "w") as file:
+        json.dump(info, file, indent=1)
+    return info
+
+
+def load_plan(workdir):
+    with open(os.path.join(workdir, PLAN)) as file:
+        return json.load(file)
+
+
+def score_folder(images, out, workers, with_cw_ssim):
+    """Score every real/fake pair in a results folder into a csv; returns the rows."""
+    prefixes = sorted(name[: -len(FAKE_SUFFIX)] for name in os.listdir(images) if name.endswith(FAKE_SUFFIX))
+    reals = [os.path.join(images, prefix + REAL_SUFFIX) for prefix in prefixes]
+    fakes = [os.path.join(images, prefix + FAKE_SUFFIX) for prefix in prefixes]
+    with ProcessPoolExecutor(workers) as pool:
+        rows = [row for row in pool.map(score_pair, reals, fakes, [with_cw_ssim] * len(reals), chunksize=16)
+                if row is not None]
+
+    header = ["number", "ssim", "psnr"] + (["cw_ssim"] if with_cw_ssim else [])
+    with open(out + ".tmp", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+    # the merge step only trusts complete files
+    os.replace(out + ".tmp", out)
+    return rows
+
+
+def run(workdir, task, workers=None, skip_test=False):
+    """Run test.py on one shard and score its results."""
+    info = load_plan(workdir)
+    shard = shard_path(workdir, task)
+    start, stop = info["shards"][task]["start"], info["shards"][task]["stop"]
+    results = os.path.join(shard, "results")
+
+    if not skip_test:
+        command = [sys.executable, "test.py", "--dataroot", os.path.join(shard, "data"), "--name", info["name"],
+                   "--results_dir", results, "--phase", info["phase"], "--num_test", str(stop - start)]
+        command += info["test_args"]
+        print(" ".join(shlex.quote(part) for part in command), flush=True)
+        subprocess.run(command, cwd=info["repo"], check=True)
+
+    images = os.path.join(results, info["name"], results_folder(info["phase"], info["test_args"]), "images")
+    with_cw_ssim = has_cw_ssim()
+    if not with_cw_ssim:
+        print("pyssim is not installed, skipping CW-SSIM")
+    rows = score_folder(images, os.path.join(shard, "scores.csv"), workers, with_cw_ssim)
+    print("shard %d: scored %d of %d images" % (task, len(rows), stop - start))
+    return rows
+
+
+def merge(workdir, store=None, run_name=None):
+    """Reduce the shards' scores into scores.csv and summary.json."""
+    info = load_plan(workdir)
+    missing = [task for task in range(len(info["shards"]))
+               if not os.path.exists(os.path.join(shard_path(workdir, task), "scores.csv"))]
+    if missing:
+        raise RuntimeError("shards without scores: %s" % " ".join(map(str, missing)))
+
+    header = None
+    rows = []
+    for task in range(len(info["shards"])):
+        with open(os.path.join(shard_path(workdir, task), "scores.csv"), newline="") as file:
+            reader = csv.reader(file)
+            shard_header = next(reader)
+            # every shard must have scored the same metrics
+            header = header or shard_header
+            if shard_header != header:
+                raise RuntimeError("shard %d has columns %s, expected %s" % (task, shard_header, header))
+            rows.extend(reader)
+    rows.sort(key=lambda row: int(row[0]))
+
+    with open(os.path.join(workdir, "scores.csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+    summary = {"images": info["images"], "scored": len(rows)}
+    for column, metric in enumerate(header[1:], start=1):
+        summary[metric] = summarize([float(row[column]) for row in rows])
+    with open(os.path.join(workdir, "summary.json"), "w") as file:
+        json.dump(summary, file, indent=1)
+
+    for metric in header[1:]:
+        print("%s: mean %.4f std %.4f (n=%d)" % (metric, summary[metric]["mean"], summary[metric]["std"],
+                                                 summary[metric]["count"]))
+    if summary["scored"] < info["images"]:
+        print("warning: %d of %d images were not scored" % (info["images"] - summary["scored"], info["images"]))
+
+    if store is not None:
+        from results_store import append, parse_run_name
+
+        columns = {"number": [int(row[0]) for row in rows]}
+        for column, metric in enumerate(header[1:], start=1):
+            columns[metric] = [float(row[column]) for row in rows]
+        run_name = run_name or info["name"]
+        columns["run"] = run_name
+        columns["direction"], columns["model"], columns["condition"] = parse_run_name(run_name)
+        print("added to " + append(store, columns))
+    return summary
+
+
+def sbatch(command, args, script):
+    """Submit a script with sbatch (or a stand in) and return its job id."""
+    output = subprocess.run(shlex.split(command) + ["--parsable"] + args + [script],
+                            check=True, capture_output=True, text=True).stdout
+    return output.strip().split(";")[0]
+
+
+def submit(args):
+    """Plan the shards, then submit the array and a merge job that waits for it."""
+    info = plan(args.workdir, args.dataroot, args.repo, args.name, args.shards, args.test_args, args.phase)
+    workdir = os.path.abspath(args.workdir)
+    fields = {
+        "time": args.time,
+        "account": args.account,
+        "partition": args.partition,
+        "workdir": workdir,
+        "name": args.name,
+        "modules": "\n".join("module load " + module for module in args.modules),
+        "script": os.path.abspath(__file__),
+        "workers": args.workers,
+        "store": "" if args.store is None else " --store %s --run %s" % (
+            shlex.quote(os.path.abspath(args.store)), shlex.quote(args.run or args.name)),
+    }
+    array_script = os.path.join(workdir, "array.slurm")
+    merge_script = os.path.join(workdir, "merge.slurm")
+    with open(array_script, "w") as file:
+        file.write(ARRAY_SCRIPT.format(**fields))
+    with open(merge_script, "w") as file:
+        file.write(MERGE_SCRIPT.format(**fields))
+
+    shards = len(info["shards"])
+    array = sbatch(args.sbatch, ["--array=0-%d" % (shards - 1)], array_script)
+    merge_job = sbatch(args.sbatch, ["--dependency=afterok:" + array], merge_script)
+    print("%d images in %d shards: array job %s, merge job %s" % (info["images"], shards, array, merge_job))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded test.py inference and scoring over a Slurm job array.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def plan_arguments(command):
+        command.add_argument("--workdir", required=True)
+        command.add_argument("--dataroot", required=True, help="dataset folder with a test/ folder")
+        command.add_argument("--repo", required=True, help="pytorch-CycleGAN-and-pix2pix checkout")
+        command.add_argument("--name", required=True, help="experiment name, e.g. ab_night")
+        command.add_argument("--shards", type=int, required=True)
+        command.add_argument("--phase", default="test")
+        command.add_argument("test_args", nargs=argparse.REMAINDER,
+                             help="after --: more test.py arguments, e.g. -- --direction AtoB --model pix2pix")
+
+    plan_arguments(commands.add_parser("plan", help="only split the test set"))
+
+    go = commands.add_parser("submit", help="split the test set and submit the array and merge jobs")
+    plan_arguments(go)
+    go.add_argument("--sbatch", default="sbatch", help="sbatch command, e.g. 'python fake_sbatch.py'")
+    go.add_argument("--account", default="notchpeak-gpu")
+    go.add_argument("--partition", default="notchpeak-gpu")
+    go.add_argument("--time", default="12:00:00")
+    go.add_argument("--modules", nargs="*", default=["miniconda3/latest"])
+    go.add_argument("--workers", type=int, default=4, help="scoring processes per task")
+    go.add_argument("--store", default=None, help="results_store.py store to append the merged scores to")
+    go.add_argument("--run", default=None, help="run name in the store, the experiment name if not given")
+
+    task = commands.add_parser("run", help="run and score one shard")
+    task.add_argument("--workdir", required=True)
+    task.add_argument("--task", type=int, default=None, help="shard, $SLURM_ARRAY_TASK_ID if not given")
+    task.add_argument("--workers", type=int, default=None)
+    task.add_argument("--skip-test", action="store_true", help="only score existing results")
+
+    join = commands.add_parser("merge", help="reduce the shards' scores")
+    join.add_argument("--workdir", required=True)
+    join.add_argument("--store", default=None)
+    join.add_argument("--run", default=None)
+
+    args = parser.parse_args()
+    if getattr(args, "test_args", None) and args.test_args[0] == "--":
+        args.test_args = args.test_args[1:]
+
+    if args.command == "plan":
+        info = plan(args.workdir, args.dataroot, args.repo, args.name, args.shards, args.test_args, args.phase)
+        print("%d images in %d shards" % (info["images"], len(info["shards"])))
+    elif args.command == "submit":
+        submit(args)
+    elif args.command == "run":
+        number = args.task if args.task is not None else int(os.environ["SLURM_ARRAY_TASK_ID"])
+        run(args.workdir, number, args.workers, args.skip_test)
+    else:
+        merge(args.workdir, args.store, args.run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Stand in for sbatch that runs jobs as local subprocesses
+#
+# Understands the part of sbatch that eval_array.py uses, so job array
+# pipelines can be tried on a workstation before going to the cluster:
+#   python fake_sbatch.py [--parsable] [--array=0-3] [--dependency=afterok:ID] script.slurm
+# Jobs run right away and sbatch returns when they are done. Array tasks run in
+# parallel (FAKE_SBATCH_PARALLEL of them at a time, all cores by default), each
+# with SLURM_ARRAY_TASK_ID and SLURM_ARRAY_JOB_ID set and its output in
+# slurm-<job>_<task>.out. Every job's exit codes are kept in .fake_sbatch/ so a
+# later afterok dependency fails like Slurm's would. Other options are ignored.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+STATE = ".fake_sbatch"
+
+
+def task_ids(spec):
+    """Task ids of an --array spec like 0-15, 1,3,5 or 0-15%4 (the limit is ignored)."""
+    ids = []
+    for part in spec.split("%")[0].split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            ids.extend(range(int(first), int(last) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+def job_state(job):
+    path = os.path.join(STATE, job + ".json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def run_task(script, job, task):
+    env = dict(os.environ, SLURM_JOB_ID=job)
+    out = "slurm-%s.out" % job
+    if task is not None:
+        env.update(SLURM_ARRAY_JOB_ID=job, SLURM_ARRAY_TASK_ID=str(task))
+        out = "slurm-%s_%d.out" % (job, task)
+    with open(out, "w") as file:
+        return subprocess.run(["bash", script], env=env, stdout=file, stderr=subprocess.STDOUT).returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Slurm batch scripts as local subprocesses.")
+    parser.add_argument("--parsable", action="store_true")
+    parser.add_argument("--array", default=None)
+    parser.add_argument("--dependency", default=None)
+    parser.add_argument("script")
+    args, _ = parser.parse_known_args()
+
+    os.makedirs(STATE, exist_ok=True)
+    job = str(1000 + len(os.listdir(STATE)))
+
+    if args.dependency is not None:
+        for dependency in args.dependency.split(","):
+            kind, _, ids = dependency.partition(":")
+            for other in ids.split(":"):
+                state = job_state(other)
+                failed = state is None or any(code != 0 for code in state["codes"].values())
+                if kind == "afterok" and failed:
+                    # Slurm would never start this job
+                    with open(os.path.join(STATE, job + ".json"), "w") as file:
+                        json.dump({"codes": {"-": "DependencyNeverSatisfied"}}, file)
+                    print(job if args.parsable else "Submitted batch job " + job)
+                    print("job %s not run: dependency %s failed" % (job, other), file=sys.stderr)
+                    return
+
+    tasks = task_ids(args.array) if args.array is not None else [None]
+    parallel = int(os.environ.get("FAKE_SBATCH_PARALLEL", os.cpu_count()))
+    with ThreadPoolExecutor(parallel) as pool:
+        codes = list(pool.map(lambda task: run_task(args.script, job, task), tasks))
+
+    with open(os.path.join(STATE, job + ".json"), "w") as file:
+        json.dump({"codes": {str(task): code for task, code in zip(tasks, codes)}}, file)
+    print(job if args.parsable else "Submitted batch job " + job)
+
+
+if __name__ == "__main__":
+    main()
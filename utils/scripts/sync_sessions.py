@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# Content-hash manifests and incremental sync of capture sessions
+#
+# Copying sessions from the field laptop to the cluster used to mean copying
+# everything and hoping it arrived intact. This keeps a manifest of every file
+# under a session tree (size, modification time and content hash) in
+# <root>/.manifest.json, and copies only the files whose hash is missing or
+# different at the destination, then hashes them again there:
+#   python sync_sessions.py manifest D:/captures
+#   python sync_sessions.py sync D:/captures /mnt/backup/captures
+#   python sync_sessions.py sync D:/captures u1081622@notchpeak.chpc.utah.edu:dataset/raw
+#   python sync_sessions.py verify /mnt/backup/captures --all
+#
+# Hashing runs on a thread pool (the hash functions release the GIL), and a file
+# is only hashed again when its size or modification time changed, so updating
+# the manifest after adding one session hashes just that session. Hashes are
+# xxh3-128 with xxhash installed, else BLAKE3 with blake3 installed, else
+# hashlib's BLAKE2b; the manifest says which, and keeps it, and the files of a
+# destination manifest made with another one are hashed again with it. For a
+# remote destination the fastest one installed at both ends is used, BLAKE2b if
+# the remote can't be asked, since the remote verify has to hash with it too.
+#
+# A remote destination (host:path) is copied to with rsync, and verified by
+# running this script there over ssh with python3. The copied files are listed
+# as unverified in the destination manifest until verify has hashed them, so a
+# sync that was cut off is caught by the next verify. Files verify finds
+# missing or different are listed as bad, and unverified and bad files are
+# copied again by the next sync. Files only at the destination are reported,
+# never deleted.
+
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST = ".manifest.json"
+BLOCK = 1 << 20
+SKIP_SUFFIXES = (".tmp",)  # half written files (see diskout.py and journal.py)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+def hashers():
+    """Available hash constructors by name, fastest first."""
+    available = {}
+    if xxhash is not None:
+        available["xxh3_128"] = xxhash.xxh3_128
+    if blake3 is not None:
+        available["blake3"] = blake3.blake3
+    available["blake2b"] = lambda: hashlib.blake2b(digest_size=16)
+    return available
+
+
+def file_hash(path, algorithm):
+    digest = hashers()[algorithm]()
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(BLOCK)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan(root):
+    """Relative path to (size, mtime_ns) of every file under root."""
+    files = {}
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and entry.name != MANIFEST and not entry.name.endswith(SKIP_SUFFIXES):
+                    stat = entry.stat()
+                    files[os.path.relpath(entry.path, root).replace(os.sep, "/")] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def load_manifest(root):
+    path = os.path.join(root, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_manifest(root, manifest):
+    path = os.path.join(root, MANIFEST)
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+
+def hash_files(root, paths, algorithm, workers=None):
+    """Relative path to content hash, hashed on a thread pool."""
+    def one(path):
+        return path, file_hash(os.path.join(root, path), algorithm)
+
+    with ThreadPoolExecutor(workers or min(32, (os.cpu_count() or 1) * 2)) as pool:
+        return dict(pool.map(one, paths))
+
+
+def update_manifest(root, algorithm=None, workers=None):
+    """Bring root's manifest up to date; returns it and the number of files hashed.
+
+    Files whose size and modification time match the old manifest keep their
+    hash. Without ``algorithm`` the old manifest's is kept if it is installed,
+    else the fastest installed one is used.
+    """
+    old = load_manifest(root) or {}
+    if algorithm is None:
+        algorithm = old.get("algorithm") if old.get("algorithm") in hashers() else next(iter(hashers()))
+    cached = old.get("files", {}) if old.get("algorithm") == algorithm else {}
+    found = scan(root)
+
+    files = {}
+    stale = []
+    for path, (size, mtime) in found.items():
+        entry = cached.get(path)
+        if entry is not None and entry[0] == size and entry[1] == mtime:
+            files[path] = entry
+        else:
+            stale.append(path)
+    for path, digest in hash_files(root, stale, algorithm, workers).items():
+        files[path] = [found[path][0], found[path][1], digest]
+
+    manifest = {"algorithm": algorithm, "files": files, "unverified": old.get("unverified", []),
+                "bad": old.get("bad", [])}
+    save_manifest(root, manifest)
+    return manifest, len(stale)
+
+
+def diff(source, dest):
+    """Files to copy (new, with another hash, unverified or bad) and files only at the destination."""
+    theirs = dest.get("files", {}) if dest.get("algorithm") == source["algorithm"] else {}
+    suspect = set(dest.get("unverified", [])) | set(dest.get("bad", []))
+    changed = sorted(path for path, entry in source["files"].items()
+                     if path not in theirs or theirs[path][2] != entry[2] or path in suspect)
+    extra = sorted(set(theirs) - set(source["files"]))
+    return changed, extra
+
+
+def verify(root, everything=False, workers=None):
+    """Hash the unverified files (or all of them) again and compare with the manifest.
+
+    Returns the paths that are missing or don't match. The manifest lists them
+    as bad, so the next sync copies them again, and no longer as unverified.
+    """
+    manifest = load_manifest(root)
+    if manifest is None:
+        raise SystemExit("no %s in %s" % (MANIFEST, root))
+    algorithm = manifest["algorithm"]
+    if algorithm not in hashers():
+        raise SystemExit("%s was hashed with %s, which is not installed here" % (root, algorithm))
+    paths = sorted(manifest["files"]) if everything else manifest.get("unverified", [])
+    present = [path for path in paths if os.path.isfile(os.path.join(root, path))]
+    digests = hash_files(root, present, algorithm, workers)
+    bad = [path for path in paths if digests.get(path) != manifest["files"][path][2]]
+    listed = set(manifest.get("bad", []))
+    remaining = sorted((listed - set(paths)) | set(bad))
+    if manifest.get("unverified") or remaining != sorted(listed):
+        manifest["unverified"] = []
+        manifest["bad"] = remaining
+        save_manifest(root, manifest)
+    return len(paths), bad
+
+
+def split_remote(dest):
+    """(host, path) of host:path, (None, dest) of a local folder (C:/ is a Windows drive)."""
+    host, sep, path = dest.partition(":")
+    if not sep or len(host) == 1 or "/" in host or "\\" in host:
+        return None, dest
+    return host, path
+
+
+def run_remote(host, arguments, **kwargs):
+    """Run this script on host with python3, its source sent over stdin."""
+    with open(os.path.abspath(__file__)) as file:
+        script = file.read()
+    return subprocess.run(["ssh", host, "python3 - " + arguments], input=script, text=True, **kwargs)
+
+
+def remote_algorithms(host):
+    """Hash algorithms installed on host, fastest first; just blake2b if it can't be asked."""
+    result = run_remote(host, "algorithms", capture_output=True)
+    names = result.stdout.split() if result.returncode == 0 else []
+    return names or ["blake2b"]
+
+
+def remote_manifest(host, path):
+    result = subprocess.run(["ssh", host, "cat " + shlex.quote(path + "/" + MANIFEST)],
+                            capture_output=True, text=True)
+    return json.loads(result.stdout) if result.returncode == 0 and result.stdout else {}
+
+
+def copy_local(source, dest, paths, workers=None):
+    def one(path):
+        target = os.path.join(dest, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(source, path), target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+    with ThreadPoolExecutor(workers or 8) as pool:
+        list(pool.map(one, paths))
+
+
+def copy_remote(source, host, path, paths):
+    subprocess.run(["ssh", host, "mkdir -p " + shlex.quote(path)], check=True)
+    subprocess.run(["rsync", "-a", "--files-from=-", source + "/", host + ":" + path + "/"],
+                   input="\n".join(paths), text=True, check=True)
+
+
+def sync(source, dest, workers=None, check=True):
+    started = time.perf_counter()
+    host, path = split_remote(dest)
+    algorithm = None
+    if host is not None:
+        theirs = remote_algorithms(host)
+        algorithm = next((name for name in hashers() if name in theirs), "blake2b")
+    manifest, hashed = update_manifest(source, algorithm, workers)
+    print("%s: %d files, %d hashed with %s" % (source, len(manifest["files"]), hashed, manifest["algorithm"]))
+
+    if host is None:
+        theirs = load_manifest(dest) or {}
+    else:
+        theirs = remote_manifest(host, path)
+    if theirs.get("files") and theirs.get("algorithm") != manifest["algorithm"]:
+        # hashed with another algorithm, hash the destination again with this one
+        if host is None:
+            theirs, hashed = update_manifest(dest, manifest["algorithm"], workers)
+        else:
+            run_remote(host, "manifest {} --algorithm {}".format(shlex.quote(path), manifest["algorithm"]),
+                       check=True)
+            theirs = remote_manifest(host, path)
+        print("%s: hashed again with %s" % (dest, manifest["algorithm"]))
+    changed, extra = diff(manifest, theirs)
+    size = sum(manifest["files"][p][0] for p in changed)
+    print("%d files to copy (%.1f MB), %d only at %s" % (len(changed), size / 1e6, len(extra), dest))
+
+    # the destination manifest is written first, listing the new files as
+    # unverified, so an interrupted copy is caught by the next verify
+    files = dict(theirs.get("files", {})) if theirs.get("algorithm") == manifest["algorithm"] else {}
+    files.update((p, manifest["files"][p]) for p in changed)
+    unverified = sorted(set(theirs.get("unverified", [])) | set(changed))
+    bad = sorted(set(theirs.get("bad", [])) - set(changed))
+    theirs = {"algorithm": manifest["algorithm"], "files": files, "unverified": unverified, "bad": bad}
+    if host is None:
+        os.makedirs(dest, exist_ok=True)
+        save_manifest(dest, theirs)
+        copy_local(source, dest, changed, workers)
+    else:
+        subprocess.run(["ssh", host, "mkdir -p {0} && cat > {1}.tmp && mv {1}.tmp {1}".format(
+            shlex.quote(path), shlex.quote(path + "/" + MANIFEST))], input=json.dumps(theirs), text=True, check=True)
+        copy_remote(source, host, path, changed)
+    print("copied in %.1f s" % (time.perf_counter() - started))
+
+    if check:
+        if host is None:
+            checked, bad = verify(dest, workers=workers)
+        else:
+            result = run_remote(host, "verify " + shlex.quote(path))
+            if result.returncode != 0:
+                raise SystemExit("verification at %s failed" % dest)
+            checked, bad = len(unverified), []
+        if bad:
+            raise SystemExit("%d of %d files differ at %s, e.g. %s" % (len(bad), checked, dest, bad[0]))
+        print("verified %d files at %s" % (checked, dest))
+    print("done in %.1f s" % (time.perf_counter() - started))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Content-hash manifests and incremental sync of capture sessions.")
+    parser.add_argument("--workers", type=int, default=None, help="hashing and copying threads")
+    commands = parser.add_subparsers(dest="command", required=True)
+    make = commands.add_parser("manifest", help="create or update the manifest of a session tree")
+    make.add_argument("root")
+    make.add_argument("--algorithm", choices=list(hashers()), default=None)
+    copy = commands.add_parser("sync", help="copy new and changed files to a folder or host:folder")
+    copy.add_argument("source")
+    copy.add_argument("dest")
+    copy.add_argument("--no-verify", action="store_true", help="don't hash the copied files again")
+    check = commands.add_parser("verify", help="hash files again and compare with the manifest")
+    check.add_argument("root")
+    check.add_argument("--all", action="store_true", help="every file, not only the unverified ones")
+    commands.add_parser("algorithms", help="list the hash algorithms installed here, fastest first")
+    args = parser.parse_args()
+
+    if args.command == "manifest":
+        started = time.perf_counter()
+        manifest, hashed = update_manifest(args.root, args.algorithm, args.workers)
+        print("%d files, %d hashed with %s in %.1f s" % (len(manifest["files"]), hashed, manifest["algorithm"],
+                                                       time.perf_counter() - started))
+    elif args.command == "sync":
+        sync(args.source, args.dest, args.workers, not args.no_verify)
+    elif args.command == "algorithms":
+        print(" ".join(hashers()))
+    else:
+        checked, bad = verify(args.root, args.all, args.workers)
+        for path in bad:
+            print("mismatch: " + path)
+        print("%d of %d files verified" % (checked - len(bad), checked))
+        if bad:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()